@@ -82,12 +82,23 @@ struct fi2c_context {
   int bufsize;
 };
 
+// one write and/or read transaction of fi2c_wr_rd_batch
+struct fi2c_xfer {
+  uint8_t slv;
+  uint8_t *wbuf;
+  int wcnt;
+  uint8_t *rbuf;
+  int rcnt;
+};
+
 int fi2c_init(struct fi2c_context *fic, struct ftdi_context *fc);
 int fi2c_open(struct fi2c_context *fic, struct ftdi_common_args *fargs);
 int fi2c_setclock(struct fi2c_context *fic, uint32_t clkhz);
 int fi2c_reset(struct fi2c_context *fic);
 int fi2c_wr_rd(struct fi2c_context *fic, uint8_t *wbuf, int wcnt,
                uint8_t *rbuf, int rcnt);
+int fi2c_wr_rd_batch(struct fi2c_context *fic, struct fi2c_xfer *xfers,
+                     int cnt);
 int fi2c_close(struct fi2c_context *fic);
 
 #ifdef __cplusplus
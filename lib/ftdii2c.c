@@ -10,11 +10,20 @@
 #include "ftdi_common.h"
 #include "ftdii2c.h"
 
+// Sizes of the MPSSE commands queued by the helpers below.
+#define FI2C_CFG_IO_SIZE 3
+#define FI2C_START_CMDS_SIZE (9 * FI2C_CFG_IO_SIZE)
+#define FI2C_STOP_CMDS_SIZE (9 * FI2C_CFG_IO_SIZE)
+#define FI2C_BYTE_OUT_CMDS_SIZE (3 + FI2C_CFG_IO_SIZE + 2 + FI2C_CFG_IO_SIZE)
+#define FI2C_BYTE_IN_CMDS_SIZE (FI2C_CFG_IO_SIZE + 3 + FI2C_CFG_IO_SIZE + 3)
+// Every byte returned by the ftdi (ACK bit or data byte) costs at least this
+// many command bytes, which bounds the bytes returned for a command buffer.
+#define FI2C_MIN_CMDS_PER_RX_BYTE FI2C_BYTE_OUT_CMDS_SIZE
+
 static int fi2c_start_bit_cmds(struct fi2c_context *fic) {
   int i;
 
-  // for now don't allow starts in middle of a command buffer
-  assert(fic->bufcnt == 0);
+  assert(fic->bufcnt + FI2C_START_CMDS_SIZE <= fic->bufsize);
 
   // TODO(tbroch) factor in whether its high speed dev or not
   // guarantee minimum setup time between SDA -> SCL transistions
@@ -71,40 +80,46 @@ static int fi2c_write_cmds(struct fi2c_context *fic) {
   return FI2C_ERR_NONE;
 }
 
-static int fi2c_read_from_ftdi(struct ftdi_context *fc, uint8_t *rdbuf,
-                               unsigned int rdcnt) {
+// like fi2c_read_from_ftdi, but reports in *bytes_read how many bytes were
+// read even if not all were
+static int fi2c_read_some_from_ftdi(struct ftdi_context *fc, uint8_t *rdbuf,
+                                    unsigned int rdcnt,
+                                    unsigned int *bytes_read) {
   int rv = 0;
-  unsigned int bytes_read = 0;
   unsigned int read_attempts = 0;
   uint8_t *buf = rdbuf;
 
-  while ((bytes_read < rdcnt) &&
+  *bytes_read = 0;
+  while ((*bytes_read < rdcnt) &&
          (read_attempts < FI2C_READ_ATTEMPTS)) {
-    rv = ftdi_read_data(fc, buf, (rdcnt - bytes_read));
+    rv = ftdi_read_data(fc, buf, (rdcnt - *bytes_read));
     if (rv < 0) {
       ERROR_FTDI("read of ftdi", fc);
       return FI2C_ERR_FTDI;
     }
     buf += rv;
-    bytes_read += rv;
+    *bytes_read += rv;
     read_attempts++;
-    prn_dbg("bytes read %d of %d\n", bytes_read, rdcnt);
+    prn_dbg("bytes read %d of %d\n", *bytes_read, rdcnt);
   }
 
-  if (bytes_read != rdcnt) {
-    prn_dbg("bytes read %d != %d\n", bytes_read, rdcnt);
+  if (*bytes_read != rdcnt) {
+    prn_dbg("bytes read %d != %d\n", *bytes_read, rdcnt);
     return FI2C_ERR_READ;
   }
   return FI2C_ERR_NONE;
 }
 
-// TODO(tbroch) can we use the WAIT_ON_x cmds to postpone checking and increase
-//              the payload to/from ftdi queues.  At the very least use
-//              WAIT_ON to h/w check the ack for speeds sake
-static int fi2c_send_byte_and_check(struct fi2c_context *fic, uint8_t data) {
-  uint8_t rdbuf_byte;
-  uint8_t *rdbuf = &rdbuf_byte;
+static int fi2c_read_from_ftdi(struct ftdi_context *fc, uint8_t *rdbuf,
+                               unsigned int rdcnt) {
+  unsigned int bytes_read;
 
+  return fi2c_read_some_from_ftdi(fc, rdbuf, rdcnt, &bytes_read);
+}
+
+// clock a byte out then clock in the ACK bit, whose byte is returned by the
+// ftdi once the commands are flushed.  Leaves SDA driven high.
+static void fi2c_byte_out_cmds(struct fi2c_context *fic, uint8_t data) {
   // clk the single byte out
   FI2C_WBUF(fic, FTDI_CMD_MFE_CLK_BIT_OUT);
   FI2C_WBUF(fic, 0x07);
@@ -117,29 +132,41 @@ static int fi2c_send_byte_and_check(struct fi2c_context *fic, uint8_t data) {
   FI2C_WBUF(fic, FTDI_CMD_LRE_CLK_BIT_IN);
   FI2C_WBUF(fic, 0x00);
 
+  // TODO(tbroch) : shouldn't need to pull SDA high here but get strange results
+  // otherwise.  Needs investigation
+  // SCL low, SDA high
+  FI2C_CFG_IO(fic, SDA_POS, (SCL_POS | SDA_POS));
+}
+
+static int fi2c_ack_ok(uint8_t ack) {
+  if ((ack & 0x80) != 0x0) {
+    prn_dbg("ack read 0x%02x != 0x0\n", (ack & 0x80));
+    return 0;
+  }
+  return 1;
+}
+
+static int fi2c_send_byte_and_check(struct fi2c_context *fic, uint8_t data) {
+  uint8_t rdbuf_byte;
+  uint8_t *rdbuf = &rdbuf_byte;
+
+  fi2c_byte_out_cmds(fic, data);
+
   // force rx buffer back to host so you can see ack/noack
   FI2C_WBUF(fic, SEND_IMMEDIATE);
 
   CHECK_FI2C(fic, fi2c_write_cmds(fic), "write cmds for ack check\n");
   prn_dbg("bufcnt after write = %d\n", fic->bufcnt);
 
-  // TODO(tbroch) this is s/w ACK should be doable via h/w WAIT_ON_x
-
   if (fi2c_read_from_ftdi(fic->fc, rdbuf, 1)) {
     ERROR_FTDI("read of ack", fic->fc);
     return FI2C_ERR_FTDI;
   }
 
-  if ((rdbuf[0] & 0x80) != 0x0) {
-    prn_dbg("ack read 0x%02x != 0x0\n", (rdbuf[0] & 0x80));
+  if (!fi2c_ack_ok(rdbuf[0])) {
     return FI2C_ERR_ACK;
   }
   prn_dbg("saw the ack 0x%02x\n", rdbuf[0]);
-
-  // TODO(tbroch) : shouldn't need to pull SDA high here but get strange results
-  // otherwise.  Needs investigation
-  // SCL low, SDA high
-  FI2C_CFG_IO(fic, SDA_POS, (SCL_POS | SDA_POS));
   return FI2C_ERR_NONE;
 }
 
@@ -159,7 +186,7 @@ static int fi2c_wr(struct fi2c_context *fic, uint8_t *wbuf, int wcnt) {
   return FI2C_ERR_NONE;
 }
 
-static int fi2c_rd(struct fi2c_context *fic, uint8_t *rbuf, int rcnt) {
+static void fi2c_rd_cmds(struct fi2c_context *fic, int rcnt) {
   int i;
 
   for (i = 0; i < rcnt; i++) {
@@ -184,6 +211,10 @@ static int fi2c_rd(struct fi2c_context *fic, uint8_t *rbuf, int rcnt) {
       FI2C_WBUF(fic, 0x0);
     }
   }
+}
+
+static int fi2c_rd(struct fi2c_context *fic, uint8_t *rbuf, int rcnt) {
+  fi2c_rd_cmds(fic, rcnt);
   FI2C_WBUF(fic, SEND_IMMEDIATE);
   CHECK_FI2C(fic, fi2c_write_cmds(fic), "FTDI cmd write for read\n");
   if (fic->error)
@@ -271,8 +302,11 @@ int fi2c_reset(struct fi2c_context *fic) {
   return fic->error;
 }
 
-int fi2c_wr_rd(struct fi2c_context *fic, uint8_t *wbuf, int wcnt,
-               uint8_t *rbuf, int rcnt) {
+// Checks the ACK of every byte right after sending it, which costs a USB round
+// trip per byte.  Only used when the batched engine below sees a NACK, as
+// it retries the transaction.
+static int fi2c_wr_rd_bytewise(struct fi2c_context *fic, uint8_t *wbuf,
+                               int wcnt, uint8_t *rbuf, int rcnt) {
   int err = 0;
   int retry_count = 0;
   static int tot_retry_count = 0;
@@ -349,6 +383,158 @@ WR_RD_DONE:
   return fic->error || err;
 }
 
+static int fi2c_xfer_wcnt(struct fi2c_xfer *xfer) {
+  return xfer->wbuf ? xfer->wcnt : 0;
+}
+
+static int fi2c_xfer_rcnt(struct fi2c_xfer *xfer) {
+  return xfer->rbuf ? xfer->rcnt : 0;
+}
+
+static int fi2c_xfer_cmds_size(struct fi2c_xfer *xfer) {
+  int size = 0;
+  int wcnt = fi2c_xfer_wcnt(xfer);
+  int rcnt = fi2c_xfer_rcnt(xfer);
+
+  if (wcnt)
+    size += FI2C_START_CMDS_SIZE + (wcnt + 1) * FI2C_BYTE_OUT_CMDS_SIZE +
+        FI2C_STOP_CMDS_SIZE;
+  if (rcnt)
+    size += FI2C_START_CMDS_SIZE + FI2C_BYTE_OUT_CMDS_SIZE +
+        rcnt * FI2C_BYTE_IN_CMDS_SIZE;
+  return size;
+}
+
+// bytes returned by the ftdi: one per ACK bit then the bytes read
+static int fi2c_xfer_rx_size(struct fi2c_xfer *xfer) {
+  int wcnt = fi2c_xfer_wcnt(xfer);
+  int rcnt = fi2c_xfer_rcnt(xfer);
+
+  return (wcnt ? wcnt + 1 : 0) + (rcnt ? rcnt + 1 : 0);
+}
+
+// queue a whole transaction without checking the ACKs on the way
+static void fi2c_queue_xfer(struct fi2c_context *fic, struct fi2c_xfer *xfer) {
+  int i;
+  int wcnt = fi2c_xfer_wcnt(xfer);
+  int rcnt = fi2c_xfer_rcnt(xfer);
+
+  if (wcnt) {
+    fi2c_start_bit_cmds(fic);
+    fi2c_byte_out_cmds(fic, xfer->slv << 1);
+    for (i = 0; i < wcnt; i++) {
+      fi2c_byte_out_cmds(fic, xfer->wbuf[i]);
+    }
+    fi2c_stop_bit_cmds(fic);
+  }
+  if (rcnt) {
+    fi2c_start_bit_cmds(fic);
+    fi2c_byte_out_cmds(fic, (xfer->slv << 1) | 0x1);
+    fi2c_rd_cmds(fic, rcnt);
+  }
+}
+
+// check the ACKs of a queued transaction and copy the bytes it read
+static int fi2c_check_xfer(struct fi2c_xfer *xfer, uint8_t *rx) {
+  int i;
+  int acks = fi2c_xfer_wcnt(xfer) ? fi2c_xfer_wcnt(xfer) + 1 : 0;
+  int rcnt = fi2c_xfer_rcnt(xfer);
+
+  for (i = 0; i < acks; i++) {
+    if (!fi2c_ack_ok(rx[i]))
+      return FI2C_ERR_ACK;
+  }
+  if (rcnt) {
+    if (!fi2c_ack_ok(rx[acks]))
+      return FI2C_ERR_ACK;
+    memcpy(xfer->rbuf, &rx[acks + 1], rcnt);
+  }
+  return FI2C_ERR_NONE;
+}
+
+static int fi2c_xfer_bytewise(struct fi2c_context *fic,
+                              struct fi2c_xfer *xfer) {
+  fic->slv = xfer->slv;
+  return fi2c_wr_rd_bytewise(fic, xfer->wbuf, xfer->wcnt, xfer->rbuf,
+                             xfer->rcnt);
+}
+
+int fi2c_wr_rd_batch(struct fi2c_context *fic, struct fi2c_xfer *xfers,
+                     int cnt) {
+  uint8_t rxbuf[FI2C_BUF_SIZE / FI2C_MIN_CMDS_PER_RX_BYTE];
+  unsigned int rx_read;
+  unsigned int rx_offset;
+  int first = 0;
+  int last;
+  int cmds_size;
+  int rx_size;
+  int err;
+  int i;
+
+  while (first < cnt) {
+    // as many transactions as fit in the command buffer, SEND_IMMEDIATE
+    // included
+    cmds_size = 1;
+    rx_size = 0;
+    for (last = first; last < cnt; last++) {
+      if (cmds_size + fi2c_xfer_cmds_size(&xfers[last]) > fic->bufsize)
+        break;
+      cmds_size += fi2c_xfer_cmds_size(&xfers[last]);
+      rx_size += fi2c_xfer_rx_size(&xfers[last]);
+    }
+    if (last == first) {
+      prn_dbg("transaction %d too large to batch\n", first);
+      err = fi2c_xfer_bytewise(fic, &xfers[first]);
+      if (err)
+        return err;
+      first++;
+      continue;
+    }
+
+    for (i = first; i < last; i++) {
+      fi2c_queue_xfer(fic, &xfers[i]);
+    }
+    // all the ACKs and bytes read come back in one read
+    FI2C_WBUF(fic, SEND_IMMEDIATE);
+    CHECK_FI2C(fic, fi2c_write_cmds(fic), "(BATCH) FTDI write cmds\n");
+    if (fic->error)
+      return fic->error;
+    if (fi2c_read_some_from_ftdi(fic->fc, rxbuf, rx_size, &rx_read)) {
+      prn_dbg("batch read failed after %d of %d bytes\n", rx_read, rx_size);
+      CHECK_FTDI(ftdi_usb_purge_buffers(fic->fc), "Purge rx/tx buf", fic->fc);
+    }
+
+    // The bytes read come back in order, so the transactions whose ACKs all
+    // came back are done.  The ones NACKed or not fully answered are redone
+    // one by one, in order, after the whole batch ran.
+    rx_offset = 0;
+    for (i = first; i < last; i++) {
+      if (rx_offset + fi2c_xfer_rx_size(&xfers[i]) > rx_read ||
+          fi2c_check_xfer(&xfers[i], &rxbuf[rx_offset])) {
+        prn_dbg("transaction %d failed, retrying bytewise\n", i);
+        err = fi2c_xfer_bytewise(fic, &xfers[i]);
+        if (err)
+          return err;
+      }
+      rx_offset += fi2c_xfer_rx_size(&xfers[i]);
+    }
+    first = last;
+  }
+  return FI2C_ERR_NONE;
+}
+
+int fi2c_wr_rd(struct fi2c_context *fic, uint8_t *wbuf, int wcnt,
+               uint8_t *rbuf, int rcnt) {
+  struct fi2c_xfer xfer;
+
+  xfer.slv = fic->slv;
+  xfer.wbuf = wbuf;
+  xfer.wcnt = wcnt;
+  xfer.rbuf = rbuf;
+  xfer.rcnt = rcnt;
+  return fi2c_wr_rd_batch(fic, &xfer, 1);
+}
+
 int fi2c_close(struct fi2c_context *fic) {
   CHECK_FTDI(ftdi_usb_close(fic->fc), "fic close", fic->fc);
   ftdi_deinit(fic->fc);
@@ -33,7 +33,8 @@ class PollClient(object):
     """
     remote = 'http://%s:%s' % (host, tcp_port)
     # TODO(jchuang): Keep alive in transport layer.
-    self._server = xmlrpclib.ServerProxy(remote, verbose=verbose)
+    self._server = xmlrpclib.ServerProxy(remote, verbose=verbose,
+                                         allow_none=True)
 
   def poll_gpio(self, gpio_port, edge):
     """Long-polls a GPIO port.
@@ -51,6 +52,108 @@ class PollClient(object):
       raise PollClientError('Problem to poll GPIO %s %s %s' %
                             (str(gpio_port), edge, e))
 
+  def wait_any_gpio(self, gpio_ports, edge, timeout=None):
+    """Long-polls several GPIO ports until any of them is edge triggered.
+
+    Args:
+      gpio_ports: list of GPIO ports
+      edge: value in GPIO_EDGE_LIST[]
+      timeout: seconds to wait, or None to wait forever.
+
+    Returns:
+      dict with 'port', 'seq', 'timestamp', 'edge' and 'missed' of the
+      triggered edge, or None on timeout.
+
+    Raises:
+      PollClientError: If error occurs when polling the GPIO ports.
+    """
+    try:
+      return self._server.wait_any_gpio(gpio_ports, edge, timeout)
+    except Exception as e:
+      raise PollClientError('Problem to wait GPIOs %s %s %s' %
+                            (gpio_ports, edge, e))
+
+  def get_gpio_edges(self, gpio_port, count=None):
+    """Gets the recorded edge history of a GPIO port.
+
+    Args:
+      gpio_port: GPIO port
+      count: number of most recent edges to return, or None for all.
+
+    Returns:
+      list of dicts with 'seq', 'timestamp', 'edge' and 'missed', oldest
+      first.
+
+    Raises:
+      PollClientError: If error occurs when querying the GPIO port.
+    """
+    try:
+      return self._server.get_gpio_edges(gpio_port, count)
+    except Exception as e:
+      raise PollClientError('Problem to get edges of GPIO %s %s' %
+                            (str(gpio_port), e))
+
+  def get_gpio_pulse_stats(self, gpio_port, level):
+    """Gets statistics of recorded pulse widths of a GPIO port.
+
+    Args:
+      gpio_port: GPIO port
+      level: 1 for high pulses, 0 for low pulses.
+
+    Returns:
+      dict with 'count', 'min', 'max', 'mean' and 'stdev' in seconds.
+
+    Raises:
+      PollClientError: If error occurs when querying the GPIO port.
+    """
+    try:
+      return self._server.get_gpio_pulse_stats(gpio_port, level)
+    except Exception as e:
+      raise PollClientError('Problem to get pulse stats of GPIO %s %s' %
+                            (str(gpio_port), e))
+
+  def get_gpio_period_stats(self, gpio_port, edge):
+    """Gets statistics of periods between recorded edges of a GPIO port.
+
+    Args:
+      gpio_port: GPIO port
+      edge: value in GPIO_EDGE_LIST[]
+
+    Returns:
+      dict with 'count', 'min', 'max', 'mean' and 'stdev' in seconds.
+
+    Raises:
+      PollClientError: If error occurs when querying the GPIO port.
+    """
+    try:
+      return self._server.get_gpio_period_stats(gpio_port, edge)
+    except Exception as e:
+      raise PollClientError('Problem to get period stats of GPIO %s %s %s' %
+                            (str(gpio_port), edge, e))
+
+  def get_gpio_edge_delay(self, gpio_port_a, edge_a, gpio_port_b, edge_b):
+    """Gets time from the last edge on port A to the next edge on port B.
+
+    Args:
+      gpio_port_a: GPIO port of the reference edge.
+      edge_a: value in GPIO_EDGE_LIST[] for gpio_port_a.
+      gpio_port_b: GPIO port of the following edge.
+      edge_b: value in GPIO_EDGE_LIST[] for gpio_port_b.
+
+    Returns:
+      Delay in seconds, or None if either edge was not recorded.
+
+    Raises:
+      PollClientError: If error occurs when querying the GPIO ports.
+    """
+    try:
+      return self._server.get_gpio_edge_delay(gpio_port_a, edge_a,
+                                              gpio_port_b, edge_b)
+    except Exception as e:
+      raise PollClientError('Problem to get delay GPIO %s %s -> %s %s %s' %
+                            (str(gpio_port_a), edge_a, str(gpio_port_b),
+                             edge_b, e))
+
   def read_gpio(self, gpio_port):
     """Reads current value of a GPIO port.
 
@@ -5,10 +5,12 @@
 """GPIO polling module. It also supports basic GPIO read/write."""
 
 import atexit
+import collections
+import ctypes
+import ctypes.util
 import logging
 import os
 import select
-import socket
 import threading
 
 import poll_common
@@ -20,12 +22,445 @@ _EXPORT_FILE =  os.path.join(_GPIO_ROOT, 'export')
 _UNEXPORT_FILE = os.path.join(_GPIO_ROOT, 'unexport')
 _GPIO_PIN_PATTERN = os.path.join(_GPIO_ROOT, 'gpio%d')
 
+# Default number of edge events kept per GPIO port.
+_EDGE_HISTORY_SIZE = 1024
+
+# Ref: linux/time.h
+_CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                     use_errno=True)
+_librt.clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+
+def monotonic_time():
+  """Returns CLOCK_MONOTONIC time in seconds, at nanosecond resolution.
+
+  Unlike time.time(), it never jumps when the wall clock is adjusted, so
+  differences between two timestamps are safe to use for timing.
+  """
+  ts = _Timespec()
+  if _librt.clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)):
+    errno = ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+  return ts.tv_sec + ts.tv_nsec * 1e-9
+
+# Edge type recorded for the value read right after an edge interrupt.
+_VALUE_TO_EDGE = {
+    0: poll_common.GPIO_EDGE_FALLING,
+    1: poll_common.GPIO_EDGE_RISING
+    }
+
+# Edge which starts a pulse of each level.
+_PULSE_START_EDGES = {
+    0: poll_common.GPIO_EDGE_FALLING,
+    1: poll_common.GPIO_EDGE_RISING
+    }
+
+# Recorded edge types matching each edge a client may wait for.
+_EDGE_MATCHES = {
+    poll_common.GPIO_EDGE_RISING: (poll_common.GPIO_EDGE_RISING,),
+    poll_common.GPIO_EDGE_FALLING: (poll_common.GPIO_EDGE_FALLING,),
+    poll_common.GPIO_EDGE_BOTH: (poll_common.GPIO_EDGE_RISING,
+                                 poll_common.GPIO_EDGE_FALLING)
+    }
+
 
 class PollGpioError(Exception):
   """Exception class for PollGpio."""
   pass
 
 
+# missed is True if the port was found at the value it already had, i.e. the
+# opposite edge and this one came too fast for both to be seen.
+EdgeEvent = collections.namedtuple('EdgeEvent',
+                                   ['seq', 'timestamp', 'edge', 'missed'])
+
+
+class _EdgeQueue(object):
+  """Edge events recorded for one watched GPIO port.
+
+  Attributes:
+    port: GPIO port.
+    value_file: Opened sysfs 'value' file registered to epoll.
+    value: Last value read from value_file.
+    seq: Sequence number of the last recorded event, 0 if none.
+    events: Bounded deque of EdgeEvent, oldest first.
+    error: Message of the error which stopped the watch, None while watched.
+  """
+
+  def __init__(self, port, value_file, value, history_size):
+    self.port = port
+    self.value_file = value_file
+    self.value = value
+    self.seq = 0
+    self.events = collections.deque(maxlen=history_size)
+    self.error = None
+
+  def append(self, timestamp, value):
+    """Records the edge which brought the port to value."""
+    self.seq += 1
+    missed = value == self.value
+    self.value = value
+    self.events.append(EdgeEvent(self.seq, timestamp, _VALUE_TO_EDGE[value],
+                                 missed))
+
+  def find_since(self, seq, edge):
+    """Returns the first event newer than seq matching edge, or None."""
+    matches = _EDGE_MATCHES[edge]
+    for event in self.events:
+      if event.seq > seq and event.edge in matches:
+        return event
+    return None
+
+  def find_after(self, timestamp, edge):
+    """Returns the first event later than timestamp matching edge, or None."""
+    matches = _EDGE_MATCHES[edge]
+    for event in self.events:
+      if event.timestamp > timestamp and event.edge in matches:
+        return event
+    return None
+
+  def find_last(self, edge):
+    """Returns the most recent event matching edge, or None."""
+    matches = _EDGE_MATCHES[edge]
+    for event in reversed(self.events):
+      if event.edge in matches:
+        return event
+    return None
+
+
+def _get_stats(values):
+  """Computes statistics of a list of durations.
+
+  Args:
+    values: list of durations in seconds.
+
+  Returns:
+    dict with 'count', and 'min', 'max', 'mean' and 'stdev' in seconds
+    (the latter are None when values is empty).
+  """
+  stats = {'count': len(values), 'min': None, 'max': None, 'mean': None,
+           'stdev': None}
+  if values:
+    mean = sum(values) / len(values)
+    stats['min'] = min(values)
+    stats['max'] = max(values)
+    stats['mean'] = mean
+    stats['stdev'] = (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5
+  return stats
+
+
+class GpioEdgeEngine(object):
+  """Watches any number of GPIO ports for edges with a single epoll thread.
+
+  Every watched port is armed with 'both' edges in sysfs so that all
+  transitions get recorded; waiters filter the edge they are interested in.
+  Edges are timestamped with CLOCK_MONOTONIC (see monotonic_time()) as soon as
+  epoll returns, so timing is measured server-side without RPC latency.
+
+  Do not create GpioEdgeEngine object directly. Use factory method
+  GpioEdgeEngine.get_instance() to get the shared engine.
+  """
+  _instance = None
+  # Lock around _instance.
+  _instance_lock = threading.Lock()
+
+  @classmethod
+  def get_instance(cls, history_size=None):
+    """Constructs or returns the GpioEdgeEngine object.
+
+    Args:
+      history_size: number of edges kept per port, only used when the engine
+                    is constructed. None for default.
+
+    Returns:
+      GpioEdgeEngine object.
+
+    Raises:
+      PollGpioError: Fail to set up epoll or its thread.
+    """
+    with cls._instance_lock:
+      if not cls._instance:
+        cls._instance = GpioEdgeEngine(history_size or _EDGE_HISTORY_SIZE)
+      return cls._instance
+
+  def __init__(self, history_size):
+    """Constructor.
+
+    Args:
+      history_size: number of edges kept per port.
+
+    Attributes:
+      _history_size: Same as argument 'history_size'.
+      _logger: Logger.
+      _epoll: epoll object all watched 'value' files are registered to.
+      _stop_pipe: Pipe (read fd, write fd) to interrupt epoll in the thread.
+      _queues: Mapping from GPIO port to _EdgeQueue.
+      _fd_queues: Mapping from 'value' file descriptor to _EdgeQueue.
+      _cond: Conditional variable guarding the queues and notifying waiters.
+      _thread: Edge-polling thread.
+
+    Raises:
+      PollGpioError
+    """
+    try:
+      self._history_size = history_size
+      self._logger = logging.getLogger('GpioEdgeEngine')
+      self._epoll = select.epoll()
+      self._stop_pipe = os.pipe()
+      self._epoll.register(self._stop_pipe[0], select.EPOLLIN)
+      self._queues = dict()
+      self._fd_queues = dict()
+      self._cond = threading.Condition()
+      self._thread = threading.Thread(target=self._polling_loop)
+      self._thread.daemon = True
+      self._thread.start()
+      atexit.register(self._cleanup)
+    except Exception as e:
+      raise PollGpioError('Fail to start GPIO edge engine: %s' % e)
+
+  def _cleanup(self):
+    """Stops the polling thread and closes all watched files."""
+    try:
+      os.write(self._stop_pipe[1], '.')
+      self._thread.join(timeout=1.0)
+      if self._thread.is_alive():
+        self._logger.warning('fail to stop edge polling thread')
+      with self._cond:
+        for queue in self._queues.itervalues():
+          queue.value_file.close()
+      self._epoll.close()
+    except Exception as e:
+      logging.error('Fail to clean up GPIO edge engine: %s', e)
+
+  def _polling_loop(self):
+    """Main loop of polling thread."""
+    while True:
+      try:
+        ret = self._epoll.poll()
+      except IOError as e:
+        # Interrupted system call; just retry.
+        self._logger.debug('epoll() interrupted: %s', e)
+        continue
+      timestamp = monotonic_time()
+      self._logger.debug('epoll() returns %s', ret)
+      with self._cond:
+        for fd, _ in ret:
+          if fd == self._stop_pipe[0]:
+            self._logger.debug('stopping thread')
+            return
+          queue = self._fd_queues.get(fd)
+          if not queue:
+            continue
+          # After edge is triggered, re-read from head of 'gpio[N]/value'.
+          # Or epoll() will return immediately next time.
+          try:
+            queue.value_file.seek(0)
+            value = int(queue.value_file.read().strip())
+          except (IOError, ValueError) as e:
+            # Stop watching the port, e.g. unexported, rather than the thread.
+            self._logger.error('fail to read GPIO %d: %s', queue.port, e)
+            self._epoll.unregister(fd)
+            del self._fd_queues[fd]
+            queue.value_file.close()
+            queue.error = str(e)
+            continue
+          queue.append(timestamp, value)
+        self._cond.notifyAll()
+
+  def watch(self, port):
+    """Starts recording edges of a GPIO port, if not watched yet.
+
+    A port whose watch failed is watched again, with a new history.
+
+    Args:
+      port: GPIO port.
+
+    Raises:
+      PollGpioError
+    """
+    with self._cond:
+      if port in self._queues and not self._queues[port].error:
+        return
+      gpio = PollGpio.get_instance(port)
+      try:
+        gpio.assign_edge(poll_common.GPIO_EDGE_BOTH)
+        value_file = open(gpio.get_value_path(), 'r')
+        value = int(value_file.read().strip())
+        self._epoll.register(value_file.fileno(),
+                             select.EPOLLPRI | select.EPOLLERR)
+      except Exception as e:
+        raise PollGpioError('Fail to watch GPIO %d: %s' % (port, e))
+      queue = _EdgeQueue(port, value_file, value, self._history_size)
+      self._queues[port] = queue
+      self._fd_queues[value_file.fileno()] = queue
+      self._logger.debug('watching GPIO port %d', port)
+
+  def wait_any(self, ports, edge, timeout=None):
+    """Waits for any of the GPIO ports being edge triggered.
+
+    Only edges occurring after this call starts are considered.
+
+    Args:
+      ports: list of GPIO ports.
+      edge: value in GPIO_EDGE_LIST[].
+      timeout: seconds to wait, or None to wait forever.
+
+    Returns:
+      (port, EdgeEvent) of the earliest matching edge, or None on timeout.
+
+    Raises:
+      PollGpioError: also if the watch of a port fails while waiting.
+    """
+    if edge not in poll_common.GPIO_EDGE_LIST:
+      raise PollGpioError('Invalid edge %s' % edge)
+    for port in ports:
+      self.watch(port)
+    deadline = None if timeout is None else monotonic_time() + timeout
+    with self._cond:
+      queues = dict((port, self._queues[port]) for port in ports)
+      start_seqs = dict((port, queues[port].seq) for port in ports)
+      while True:
+        found = None
+        for port in ports:
+          if queues[port].error:
+            raise PollGpioError('Fail to watch GPIO %d: %s' %
+                                (port, queues[port].error))
+          event = queues[port].find_since(start_seqs[port], edge)
+          if event and (not found or event.timestamp < found[1].timestamp):
+            found = (port, event)
+        if found:
+          return found
+        if deadline is None:
+          # Wake up periodically so KeyboardInterrupt is not blocked forever.
+          self._cond.wait(1.0)
+          continue
+        remaining = deadline - monotonic_time()
+        if remaining <= 0:
+          return None
+        self._cond.wait(remaining)
+
+  def get_history(self, port, count=None):
+    """Gets the recorded edge events of a GPIO port.
+
+    Args:
+      port: GPIO port.
+      count: number of most recent events to return, or None for all.
+
+    Returns:
+      list of EdgeEvent, oldest first.
+
+    Raises:
+      PollGpioError
+    """
+    self.watch(port)
+    with self._cond:
+      events = list(self._queues[port].events)
+    if count is not None:
+      events = events[-count:] if count > 0 else []
+    return events
+
+  def get_pulse_widths(self, port, level):
+    """Measures the widths of recorded pulses of a GPIO port.
+
+    Only pulses whose both edges are still in the history and with no edge
+    missed in between are measured.
+
+    Args:
+      port: GPIO port.
+      level: 1 for high pulses (rising to falling), 0 for low pulses.
+
+    Returns:
+      list of pulse widths in seconds, oldest first.
+
+    Raises:
+      PollGpioError
+    """
+    if level not in _PULSE_START_EDGES:
+      raise PollGpioError('Invalid pulse level %s' % level)
+    start_edge = _PULSE_START_EDGES[level]
+    events = self.get_history(port)
+    return [end.timestamp - start.timestamp
+            for start, end in zip(events, events[1:])
+            if start.edge == start_edge and end.edge != start_edge and
+            not end.missed]
+
+  def get_periods(self, port, edge):
+    """Measures the periods between consecutive recorded edges of a port.
+
+    Periods during which edges were missed are not measured.
+
+    Args:
+      port: GPIO port.
+      edge: value in GPIO_EDGE_LIST[]; GPIO_EDGE_BOTH measures half periods.
+
+    Returns:
+      list of periods in seconds, oldest first.
+
+    Raises:
+      PollGpioError
+    """
+    if edge not in poll_common.GPIO_EDGE_LIST:
+      raise PollGpioError('Invalid edge %s' % edge)
+    matches = _EDGE_MATCHES[edge]
+    periods = []
+    start = None
+    for event in self.get_history(port):
+      if event.missed:
+        start = None
+      if event.edge in matches:
+        if start:
+          periods.append(event.timestamp - start.timestamp)
+        start = event
+    return periods
+
+  def get_pulse_stats(self, port, level):
+    """Same as get_pulse_widths() but returns statistics of the widths."""
+    return _get_stats(self.get_pulse_widths(port, level))
+
+  def get_period_stats(self, port, edge):
+    """Same as get_periods() but returns statistics of the periods."""
+    return _get_stats(self.get_periods(port, edge))
+
+  def get_edge_delay(self, port_a, edge_a, port_b, edge_b):
+    """Measures time from the last edge on port A to the next edge on port B.
+
+    Typical use is power-good or reset delays, e.g. time from the rising edge
+    of an enable line to the rising edge of its power-good line.
+
+    Args:
+      port_a: GPIO port of the reference edge.
+      edge_a: value in GPIO_EDGE_LIST[] for port_a.
+      port_b: GPIO port of the following edge.
+      edge_b: value in GPIO_EDGE_LIST[] for port_b.
+
+    Returns:
+      Delay in seconds, or None if either edge was not recorded.
+
+    Raises:
+      PollGpioError
+    """
+    for edge in (edge_a, edge_b):
+      if edge not in poll_common.GPIO_EDGE_LIST:
+        raise PollGpioError('Invalid edge %s' % edge)
+    self.watch(port_a)
+    self.watch(port_b)
+    with self._cond:
+      event_a = self._queues[port_a].find_last(edge_a)
+      if not event_a:
+        return None
+      event_b = self._queues[port_b].find_after(event_a.timestamp, edge_b)
+    if not event_b:
+      return None
+    return event_b.timestamp - event_a.timestamp
+
+
 class PollGpio(object):
   """Monitors or controls the status of one GPIO port.
 
@@ -33,7 +468,7 @@ class PollGpio(object):
   PollGpio.get_instance() to get a PollGpio object to use. Otherwise, it'd be
   problematic when two PollGpio objects controlling the same port.
   """
-  # Mapping from GPIO port to (object, edge).
+  # Mapping from GPIO port to object.
   _instances = dict()
   # Lock around _instances.
   _instance_lock = threading.Lock()
@@ -46,12 +481,11 @@ class PollGpio(object):
       }
 
   @classmethod
-  def get_instance(cls, port, edge=None):
+  def get_instance(cls, port):
     """Constructs or returns an existing PollGpio object.
 
     Args:
       port: GPIO port.
-      edge: value in GPIO_EDGE_LIST[], or None for read/write action.
 
     Returns:
       PollGpio object for the port.
@@ -59,23 +493,10 @@ class PollGpio(object):
     Raises:
       PollGpioError: Invalid Operation.
     """
-    # It's possible to support different edge types for one GPIO by setting
-    # edge='both' in sysfs. But it's impractical in real-world use case because
-    # hardware design should already demand one specific edge type.
     with cls._instance_lock:
       if port not in cls._instances:
-        # Create an instance for specified port. If edge is None, this port
-        # could be assigned an edge afterwards.
-        cls._instances[port] = (PollGpio(port), edge)
-      elif cls._instances[port][1] and edge and cls._instances[port][1] != edge:
-        # It's not allowed to assign different polling edge to the same port, but
-        # it has no constraint to do read/write (edge is None).
-        raise PollGpioError('The gpio %d was assigned different edge' % port)
-      elif not cls._instances[port][1]:
-        # If this port instance has not initiated with an edge (only did
-        # read/write before), it can be assigned an edge in this moment.
-        cls._instances[port] = (cls._instances[port][0], edge)
-      return cls._instances[port][0]
+        cls._instances[port] = PollGpio(port)
+      return cls._instances[port]
 
   def __init__(self, port):
     """Constructor.
@@ -85,58 +506,35 @@ class PollGpio(object):
 
     Attributes:
       _port: Same as argument 'port'.
-      _edge: Same as argument 'edge'.
       _logger: Logger.
-      _thread: GPIO-polling thread.
-      _wait_cond: Conditional variable to notify all client threads waiting for
-                  GPIO edge.
-      _stop_sockets: Socket pair to interrupt poll() call in polling thread.
 
     Raises:
       PollGpioError
     """
     try:
       self._port = port
-      self._edge = None  # will be assigned at first-time polling
-
       self._logger = logging.getLogger('PollGpio')
-      self._thread = None  # will be started at first-time polling
-      self._wait_cond = threading.Condition()
-      self._stop_sockets = socket.socketpair()
-
       self._export_sysfs()
       atexit.register(self._cleanup)  # must release system resource
     except Exception as e:
       raise PollGpioError('Fail to __init__ GPIO %d: %s' % (self._port, e))
 
   def _cleanup(self):
-    """Stops the monitor thread and unexport the sysfs interface."""
+    """Unexports the sysfs interface."""
     try:
       self._logger.debug('')
-      self._stop_thread()
       self._unexport_sysfs()
     except Exception as e:
       logging.error('Fail to clean up GPIO %d: %s', self._port, e)
 
-  def _start_thread(self):
-    """Starts polling thread."""
-    self._thread = threading.Thread(target=self._polling_loop)
-    self._thread.daemon = True
-    self._thread.start()
-
-  def _stop_thread(self):
-    """Stops polling thread."""
-    self._stop_sockets[0].send('.')
-    if not self._thread:  # thread wasn't started
-      return
-    self._thread.join(timeout=1.0)
-    if self._thread.is_alive():
-      self._logger.warning('fail to stop thread of GPIO %d' % self._port)
-
   def _get_sysfs_path(self):
     """Gets the path of GPIO sysfs interface."""
     return _GPIO_PIN_PATTERN % self._port
 
+  def get_value_path(self):
+    """Gets the path of GPIO sysfs 'value' file."""
+    return os.path.join(self._get_sysfs_path(), 'value')
+
   def _export_sysfs(self):
     """Exports GPIO sysfs interface."""
     self._logger.debug('export GPIO port %d', self._port)
@@ -144,16 +542,15 @@ class PollGpio(object):
       with open(_EXPORT_FILE, 'w') as f:
         f.write(str(self._port))
 
-  def _assign_edge(self, edge):
+  def assign_edge(self, edge):
     """Writes edge value to GPIO sysfs interface.
 
     Args:
       edge: value in GPIO_EDGE_LIST[]
     """
     self._logger.debug('assign GPIO port %d %s', self._port, edge)
-    self._edge = edge
     with open(os.path.join(self._get_sysfs_path(), 'edge'), 'w') as f:
-      f.write(self._EDGE_VALUES[self._edge])
+      f.write(self._EDGE_VALUES[edge])
 
   def _unexport_sysfs(self):
     """Unexports GPIO sysfs interface."""
@@ -167,7 +564,7 @@ class PollGpio(object):
     Returns:
       (int) 1 for GPIO high, 0 for low.
     """
-    with open(os.path.join(self._get_sysfs_path(), 'value'), 'r') as f:
+    with open(self.get_value_path(), 'r') as f:
       return int(f.read().strip())
 
   def _write_value(self, value):
@@ -179,34 +576,9 @@ class PollGpio(object):
     # Set GPIO direction to output mode.
     with open(os.path.join(self._get_sysfs_path(), 'direction'), 'w') as f:
       f.write('out')
-    with open(os.path.join(self._get_sysfs_path(), 'value'), 'w') as f:
+    with open(self.get_value_path(), 'w') as f:
       f.write(str(value))
 
-  def _polling_loop(self):
-    """Main loop of polling thread."""
-    with open(os.path.join(self._get_sysfs_path(), 'value'), 'r') as f:
-      poll = select.poll()
-      poll.register(f, select.POLLPRI | select.POLLERR)
-      poll.register(self._stop_sockets[1], select.POLLIN | select.POLLERR)
-      stop_flag = False
-      while not stop_flag:
-        # After edge is triggered, re-read from head of 'gpio[N]/value'.
-        # Or poll() will return immediately next time.
-        f.seek(0)
-        f.read()
-        self._logger.debug('poll()-ing on gpio %d', self._port)
-        ret = poll.poll()
-        self._logger.debug('poll() on gpio %d returns %s', self._port, ret)
-        for fd, _ in ret:
-          if fd == f.fileno():
-            self._wait_cond.acquire()
-            self._wait_cond.notifyAll()
-            self._wait_cond.release()
-          if fd == self._stop_sockets[1].fileno():
-            if len(self._stop_sockets[1].recv(1)) > 0:
-              self._logger.debug('stopping thread')
-              stop_flag = True
-
   def poll(self, edge):
     """Waits for a GPIO port being edge triggered.
 
@@ -216,23 +588,9 @@ class PollGpio(object):
     Raises:
       PollGpioError
     """
-    if not self._edge:
-      # Only for the first time polling, assigns edge value to sysfs interface
-      # and starts a new thread.
-      try:
-        self._assign_edge(edge)
-        self._start_thread()
-      except Exception as e:
-        raise PollGpioError(
-            'Fail to start up thread GPIO %d: %s' % (self._port, e))
-    try:
-      self._logger.debug('client starts waiting')
-      self._wait_cond.acquire()
-      self._wait_cond.wait()
-      self._wait_cond.release()
-      self._logger.debug('client finishes waiting')
-    except Exception as e:
-      raise PollGpioError('Fail to poll GPIO %d: %s' % (self._port, e))
+    self._logger.debug('client starts waiting')
+    GpioEdgeEngine.get_instance().wait_any([self._port], edge)
+    self._logger.debug('client finishes waiting')
 
   def read(self):
     """Reads GPIO port value.
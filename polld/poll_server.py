@@ -7,7 +7,7 @@
 import logging
 
 import poll_common
-from poll_gpio import PollGpio, PollGpioError
+from poll_gpio import GpioEdgeEngine, PollGpio, PollGpioError
 
 
 class PolldError(Exception):
@@ -15,12 +15,27 @@ class PolldError(Exception):
   pass
 
 
+def _event_to_dict(event):
+  """Converts an EdgeEvent to a dict transferable via XMLRPC."""
+  return {'seq': event.seq, 'timestamp': event.timestamp, 'edge': event.edge,
+          'missed': event.missed}
+
+
 class Polld(object):
   """Main class for polld daemon."""
 
-  def __init__(self):
-    """Polld constructor."""
+  def __init__(self, edge_history_size=None):
+    """Polld constructor.
+
+    Args:
+      edge_history_size: number of edges recorded per GPIO port, None for
+                         default.
+    """
     self._logger = logging.getLogger('Polld')
+    try:
+      self._engine = GpioEdgeEngine.get_instance(edge_history_size)
+    except PollGpioError as e:
+      raise PolldError('Fail to start GPIO edge engine: %s' % e)
 
   def poll_gpio(self, port, edge):
     """Long-polls a GPIO port.
@@ -30,10 +45,100 @@ class Polld(object):
       edge: value in GPIO_EDGE_LIST[]
     """
     try:
-      PollGpio.get_instance(port, edge).poll(edge)
+      PollGpio.get_instance(port).poll(edge)
     except PollGpioError as e:
       raise PolldError('poll_gpio fail: %s' % e)
 
+  def wait_any_gpio(self, ports, edge, timeout=None):
+    """Long-polls several GPIO ports at once.
+
+    Args:
+      ports: list of GPIO ports
+      edge: value in GPIO_EDGE_LIST[]
+      timeout: seconds to wait, or None to wait forever.
+
+    Returns:
+      dict with 'port', 'seq', 'timestamp' (CLOCK_MONOTONIC seconds), 'edge'
+      and 'missed' (True if edges were missed just before) of the earliest
+      edge triggered after the call, or None on timeout.
+    """
+    try:
+      found = self._engine.wait_any(ports, edge, timeout)
+    except PollGpioError as e:
+      raise PolldError('wait_any_gpio fail: %s' % e)
+    if not found:
+      return None
+    port, event = found
+    result = _event_to_dict(event)
+    result['port'] = port
+    return result
+
+  def get_gpio_edges(self, port, count=None):
+    """Gets the recorded edge history of a GPIO port.
+
+    Recording starts the first time the port is polled or queried.
+
+    Args:
+      port: GPIO port
+      count: number of most recent edges to return, or None for all.
+
+    Returns:
+      list of dicts with 'seq', 'timestamp' (CLOCK_MONOTONIC seconds), 'edge'
+      and 'missed' (True if edges were missed just before), oldest first.
+    """
+    try:
+      events = self._engine.get_history(port, count)
+    except PollGpioError as e:
+      raise PolldError('get_gpio_edges fail: %s' % e)
+    return [_event_to_dict(event) for event in events]
+
+  def get_gpio_pulse_stats(self, port, level):
+    """Gets statistics of recorded pulse widths of a GPIO port.
+
+    Args:
+      port: GPIO port
+      level: 1 for high pulses (rising to falling), 0 for low pulses.
+
+    Returns:
+      dict with 'count', 'min', 'max', 'mean' and 'stdev' in seconds.
+    """
+    try:
+      return self._engine.get_pulse_stats(port, level)
+    except PollGpioError as e:
+      raise PolldError('get_gpio_pulse_stats fail: %s' % e)
+
+  def get_gpio_period_stats(self, port, edge):
+    """Gets statistics of periods between recorded edges of a GPIO port.
+
+    Args:
+      port: GPIO port
+      edge: value in GPIO_EDGE_LIST[]
+
+    Returns:
+      dict with 'count', 'min', 'max', 'mean' and 'stdev' in seconds.
+    """
+    try:
+      return self._engine.get_period_stats(port, edge)
+    except PollGpioError as e:
+      raise PolldError('get_gpio_period_stats fail: %s' % e)
+
+  def get_gpio_edge_delay(self, port_a, edge_a, port_b, edge_b):
+    """Gets time from the last edge on port A to the next edge on port B.
+
+    Args:
+      port_a: GPIO port of the reference edge.
+      edge_a: value in GPIO_EDGE_LIST[] for port_a.
+      port_b: GPIO port of the following edge.
+      edge_b: value in GPIO_EDGE_LIST[] for port_b.
+
+    Returns:
+      Delay in seconds, or None if either edge was not recorded.
+    """
+    try:
+      return self._engine.get_edge_delay(port_a, edge_a, port_b, edge_b)
+    except PollGpioError as e:
+      raise PolldError('get_gpio_edge_delay fail: %s' % e)
+
   def read_gpio(self, port):
     """Reads current value of a GPIO port.
 
@@ -50,6 +50,8 @@ def parse_args():
                     help='hostname to start server on')
   parser.add_option('', '--port', default=poll_common.DEFAULT_PORT, type=int,
                     help='port for server to listen on')
+  parser.add_option('', '--edge-history', default=None, type=int,
+                    help='number of edges recorded per GPIO port')
   parser.set_usage(parser.get_usage() + examples)
   return parser.parse_args()
 
@@ -76,7 +78,7 @@ def real_main():
     logger.fatal(error)
     raise PolldError(error)
 
-  polld = Polld()
+  polld = Polld(options.edge_history)
   server.register_introspection_functions()
   server.register_multicall_functions()
   server.register_instance(polld)
@@ -38,7 +38,8 @@ class SerialClient(object):
       verbose: Enables verbose messaging across xmlrpclib.ServerProxy.
     """
     remote = 'http://%s:%s' % (host, tcp_port)
-    self._server = xmlrpclib.ServerProxy(remote, verbose=verbose)
+    self._server = xmlrpclib.ServerProxy(remote, verbose=verbose,
+                                         allow_none=True)
 
   def send(self, serial_index, command):
     """Sends a command through serial server.
@@ -77,6 +78,34 @@ class SerialClient(object):
       raise SerialClientError(
           'Problem to receive(%d, %d): %s' % (serial_index, num_bytes, e))
 
+  def send_receive(self, serial_index, command, terminator='\n', num_bytes=0,
+                   timeout=None):
+    """Sends a command and receives its response through serial server.
+
+    Args:
+      serial_index: index of serial connections.
+      command: command to send.
+      terminator: string ending the response. None or empty to use num_bytes.
+      num_bytes: number of bytes to receive if no terminator. 0 means
+          receiving what is in the input buffer after the send-receive
+          interval of the server.
+      timeout: seconds to wait for the response. None for server default.
+
+    Returns:
+      Received response.
+
+    Raises:
+      SerialClientError if error occurs.
+    """
+    try:
+      recv = self._server.send_receive(serial_index, command, terminator,
+                                       num_bytes, timeout)
+      logging.info('Receive data: %s', recv)
+      return recv
+    except Exception as e:
+      raise SerialClientError(
+          'Problem to send_receive(%d, %s): %s' % (serial_index, command, e))
+
 
 def parse_args():
   """Parses commandline arguments.
@@ -86,7 +115,7 @@ def parse_args():
   """
   usage = (
     'usage: %prog [options] <function> <serial_index> <arg1 arg2 ...> ...\n'
-    '\t- function is [send, receive].\n'
+    '\t- function is [send, receive, send_receive].\n'
     '\t- serial_index is serial connection index.\n'
     '\t- arg<n> is the function arguments.\n'
     )
@@ -99,6 +128,9 @@ def parse_args():
     '\nExamples:\n'
     '   > %prog send 0 usbc_action usb\n'
     '\tSend command \'usbc_action usb\' to serial connection index 0.\n'
+    '   > %prog send_receive 0 version\n'
+    '\tSend command \'version\' to serial connection index 0 and receive its\n'
+    '\tresponse line.\n'
     )
 
   parser = optparse.OptionParser(usage=usage)
@@ -138,6 +170,8 @@ def call_function(commands, options, sclient):
     sclient.receive(serial_index, int(commands[0]))
   elif function == 'send':
     sclient.send(serial_index, ' '.join(commands))
+  elif function == 'send_receive':
+    sclient.send_receive(serial_index, ' '.join(commands))
   else:
     raise SerialClientError('Invalid function ' + function)
 
@@ -2,14 +2,21 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Serial server."""
+"""Serial server.
+
+Each serial connection is served by its own worker thread with a request
+queue, so requests to one port are serialized while clients of different
+ports (served by a threaded RPC server) proceed in parallel.
+"""
 
 from __future__ import print_function
 import copy
 import glob
 import logging
 import os
+import Queue
 import serial
+import threading
 
 import serial_utils
 
@@ -19,6 +26,49 @@ class SerialServerError(Exception):
   pass
 
 
+class _PortWorker(object):
+  """Runs all requests to one serial connection in a dedicated thread."""
+
+  def __init__(self, name):
+    """Constructor.
+
+    Args:
+      name: name of the worker thread.
+    """
+    self._requests = Queue.Queue()
+    self._thread = threading.Thread(target=self._run, name=name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    """Main loop of the worker thread."""
+    while True:
+      func, args, kwargs, done, result = self._requests.get()
+      try:
+        result['value'] = func(*args, **kwargs)
+      except Exception as e:
+        result['error'] = e
+      finally:
+        done.set()
+
+  def call(self, func, *args, **kwargs):
+    """Queues func(*args, **kwargs) to the worker thread and waits for its result.
+
+    Returns:
+      Return value of func.
+
+    Raises:
+      Any exception raised by func.
+    """
+    done = threading.Event()
+    result = {}
+    self._requests.put((func, args, kwargs, done, result))
+    done.wait()
+    if 'error' in result:
+      raise result['error']
+    return result['value']
+
+
 class SerialServer(object):
   """A server proxy for handling multiple serial connection interfaces."""
 
@@ -31,6 +81,21 @@ class SerialServer(object):
     self._logger = logging.getLogger('SerialServer')
     # Makes connection for all on params_list and stores in a list.
     self._serials = [self._init_serial(**p) for p in params_list]
+    self._workers = [_PortWorker('serial%d' % i)
+                     for i in xrange(len(self._serials))]
+
+  def _get_serial(self, serial_index):
+    """Gets the connection and its worker for a serial index.
+
+    Returns:
+      (SerialDevice, _PortWorker) tuple.
+
+    Raises:
+      SerialServerError if serial_index is out of range.
+    """
+    if not 0 <= serial_index < len(self._serials):
+      raise SerialServerError('index %d out of range' % serial_index)
+    return self._serials[serial_index], self._workers[serial_index]
 
   def send(self, serial_index, command):
     """Sends a command to serial connection.
@@ -42,14 +107,10 @@ class SerialServer(object):
     Raises:
       SerialServerError if it is timeout and fails to send the command.
     """
-    try:
-      serial = self._serials[serial_index]
-    except IndexError:
-      raise SerialServerError('index %d out of range' % serial_index)
-
+    conn, worker = self._get_serial(serial_index)
     try:
       logging.debug('Serial index %d send command: %s', serial_index, command)
-      self._serials[serial_index].Send(command + '\n')
+      worker.call(conn.Send, command + '\n')
     except serial.SerialTimeoutException as e:
       raise SerialServerError('Serial index %d send command: %s fail: %s' %
                               (serial_index, command, e))
@@ -68,19 +129,51 @@ class SerialServer(object):
     Raises:
       SerialServerError if it fails to receive N bytes.
     """
+    conn, worker = self._get_serial(serial_index)
     try:
-      serial = self._serials[serial_index]
-    except IndexError:
-      raise SerialServerError('index %d out of range' % serial_index)
-
-    try:
-      read_data = self._serials[serial_index].Receive(num_bytes)
+      read_data = worker.call(conn.Receive, num_bytes)
       logging.debug('Serial index %d receive: %s', serial_index, read_data)
       return read_data
     except serial.SerialTimeoutException as e:
       raise SerialServerError('Serial index %d receive fail: %s' %
                               (serial_index, e))
 
+  def send_receive(self, serial_index, command, terminator='\n', num_bytes=0,
+                   timeout=None):
+    """Sends a command and receives its response in one request.
+
+    Responses with a terminator or num_bytes are returned as soon as they are
+    complete rather than after the send-receive interval of the connection.
+
+    Args:
+      serial_index: index of serial connection.
+      command: command to send.
+      terminator: string ending the response. None or empty to use num_bytes.
+      num_bytes: number of bytes to receive if no terminator. 0 means
+          receiving what is in the input buffer after the send-receive
+          interval of the connection.
+      timeout: seconds to wait for the response. None for connection default.
+
+    Returns:
+      Received response.
+
+    Raises:
+      SerialServerError if it fails to send the command or receive a response.
+    """
+    conn, worker = self._get_serial(serial_index)
+    try:
+      logging.debug('Serial index %d send command: %s', serial_index, command)
+      read_data = worker.call(conn.SendReceive, command + '\n',
+                              size=num_bytes, terminator=terminator or None,
+                              timeout=timeout,
+                              interval_secs=0 if terminator or num_bytes
+                              else None)
+      logging.debug('Serial index %d receive: %s', serial_index, read_data)
+      return read_data
+    except serial.SerialTimeoutException as e:
+      raise SerialServerError('Serial index %d send_receive %s fail: %s' %
+                              (serial_index, command, e))
+
   def _init_serial(self, **params):
     """Makes serial connection.
 
@@ -92,6 +185,7 @@ class SerialServer(object):
 
           optional fields:
           - port_index: Physical serial port index, e.g. 1-1.
+          - usb_serial: Serial number of the USB serial device.
 
     Returns:
       SerialDevice instance for corresponding parameters.
@@ -103,8 +197,18 @@ class SerialServer(object):
     serial_driver = serial_params.get('driver')
 
     serial_port_index = params.get('port_index')
+    serial_usb_serial = params.get('usb_serial')
+
+    if serial_usb_serial:
+      serial_path = serial_utils.FindTtyByUsbSerial(serial_usb_serial,
+                                                    serial_driver)
+      if not serial_path:
+        raise SerialServerError(
+            'No serial device with driver %r detected with serial %s' %
+            (serial_driver, serial_usb_serial))
+      serial_params['port'] = serial_path
 
-    if serial_port_index:
+    elif serial_port_index:
       serial_path = serial_utils.FindTtyByPortIndex(serial_port_index,
                                                     serial_driver)
       if not serial_path:
@@ -9,16 +9,18 @@
 For some test cases, DUT needs to communicates with fixuture via USB-Serial
 dungle. We provides FindTtyByDriver() to help finding the right
 /dev/tty* path for the given driver; and OpenSerial() to open a serial port.
+Lookups are served from a TtyIndex of /sys/class/tty built once per process.
 
 Provides an interface to communicate w/ a serial device: SerialDevice. See
 class comment for details.
 """
 
 from __future__ import print_function
-import glob
 import logging
 import os
 import re
+import select
+import threading
 # site-packages: dev-python/pyserial
 import serial
 import time
@@ -47,6 +49,132 @@ def OpenSerial(**params):
   return ser
 
 
+# Root of tty class devices in sysfs.
+_SYS_CLASS_TTY = '/sys/class/tty'
+
+# A USB port path component of a sysfs device path, e.g. '1-1.3.2'.
+_USB_PORT_RE = re.compile(r'^\d+-\d+(\.\d+)*$')
+
+
+class TtyEntry(object):
+  """Sysfs attributes of one tty device.
+
+  Attributes:
+    path: /dev/tty* path.
+    driver: driver name of the device, '' if none.
+    interface_protocol: USB interface protocol, '' if none.
+    device_path: resolved sysfs path of the device.
+    port_indexes: set of USB port indexes in device_path, e.g. '1-1.3'.
+    usb_serial: serial number of the USB device, '' if none.
+  """
+
+  def __init__(self, name):
+    """Reads the sysfs attributes of tty device name."""
+    self.path = os.path.join('/dev', name)
+    device_link = os.path.join(_SYS_CLASS_TTY, name, 'device')
+    self.driver = os.path.basename(
+        os.path.realpath(os.path.join(device_link, 'driver')))
+    self.interface_protocol = DeviceInterfaceProtocol(device_link)
+    self.device_path = os.path.realpath(device_link)
+    self.port_indexes = set(c for c in self.device_path.split('/')
+                            if _USB_PORT_RE.match(c))
+    self.usb_serial = _FindUsbSerial(self.device_path)
+
+
+def _FindUsbSerial(device_path):
+  """Finds the serial number of the USB device owning a sysfs device path.
+
+  Returns:
+    The serial number, or '' if not a USB device or it has none.
+  """
+  path = device_path
+  while path not in ('/', '/sys', ''):
+    try:
+      with open(os.path.join(path, 'serial')) as f:
+        return f.read().strip()
+    except IOError:
+      path = os.path.dirname(path)
+  return ''
+
+
+class TtyIndex(object):
+  """Index of tty devices by driver, USB port index and USB serial.
+
+  The index is built once from /sys/class/tty. Each lookup only lists that
+  directory and lstat()s its links, whose inode numbers change when a tty is
+  re-created, to find the ttys added, removed or replaced since; only those
+  have their sysfs attributes re-read.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Mapping from tty name to inode number of its /sys/class/tty link.
+    self._generation = {}
+    # Mapping from tty name to TtyEntry, None for ttys without device.
+    self._entries = {}
+    self._by_driver = {}
+    self._by_port_index = {}
+    self._by_usb_serial = {}
+
+  def _Refresh(self):
+    """Updates the index if ttys were changed. Holds self._lock."""
+    generation = {}
+    try:
+      for name in os.listdir(_SYS_CLASS_TTY):
+        if name.startswith('tty'):
+          generation[name] = os.lstat(os.path.join(_SYS_CLASS_TTY, name)).st_ino
+    except OSError:
+      # A tty vanished while listing; keep the index until the next lookup.
+      return
+    if generation == self._generation:
+      return
+    for name in self._entries.keys():
+      if generation.get(name) != self._generation.get(name):
+        del self._entries[name]
+    for name in generation:
+      if name in self._entries:
+        continue
+      if os.path.exists(os.path.join(_SYS_CLASS_TTY, name, 'device')):
+        self._entries[name] = TtyEntry(name)
+      else:
+        self._entries[name] = None
+    self._generation = generation
+    self._by_driver = {}
+    self._by_port_index = {}
+    self._by_usb_serial = {}
+    for name in sorted(self._entries):
+      entry = self._entries[name]
+      if not entry:
+        continue
+      self._by_driver.setdefault(entry.driver, []).append(entry)
+      for port_index in entry.port_indexes:
+        self._by_port_index.setdefault(port_index, []).append(entry)
+      if entry.usb_serial:
+        self._by_usb_serial.setdefault(entry.usb_serial, []).append(entry)
+
+  def _Lookup(self, table_name, key):
+    """Returns the entries indexed by key in table table_name."""
+    with self._lock:
+      self._Refresh()
+      return list(getattr(self, table_name).get(key, []))
+
+  def ByDriver(self, driver_name):
+    """Returns the TtyEntry list of driver driver_name."""
+    return self._Lookup('_by_driver', driver_name)
+
+  def ByPortIndex(self, port_index):
+    """Returns the TtyEntry list at USB port index port_index."""
+    return self._Lookup('_by_port_index', port_index)
+
+  def ByUsbSerial(self, usb_serial):
+    """Returns the TtyEntry list of the USB device with serial usb_serial."""
+    return self._Lookup('_by_usb_serial', usb_serial)
+
+
+# Index shared by all lookups of this process.
+_tty_index = TtyIndex()
+
+
 def FindTtyByDriver(driver_name, interface_protocol=None, multiple_ports=False):
   """Finds the tty terminal matched to the given driver_name and an optional
   interface protocol.
@@ -72,23 +200,14 @@ def FindTtyByDriver(driver_name, interface_protocol=None, multiple_ports=False):
     If multiple_ports is False, return a list of all matched /dev/tty path; An
         empty list if not found.
   """
-  matched_candidates = []
-  for candidate in glob.glob('/dev/tty*'):
-    device_path = '/sys/class/tty/%s/device' % os.path.basename(candidate)
-    driver_path = os.path.realpath(os.path.join(device_path, 'driver'))
-
-    # Check if driver_name exist at the tail of driver_path.
-    if re.search(driver_name + '$', driver_path):
+  matched_candidates = [
+      entry.path for entry in _tty_index.ByDriver(driver_name)
       if (interface_protocol is None or
-          interface_protocol == DeviceInterfaceProtocol(device_path)):
-        if multiple_ports:
-          matched_candidates.append(candidate)
-        else:
-          return candidate
+          interface_protocol == entry.interface_protocol)]
   if multiple_ports:
     return matched_candidates
   else:
-    return None
+    return matched_candidates[0] if matched_candidates else None
 
 
 def FindTtyByPortIndex(port_index, driver_name=None):
@@ -106,20 +225,30 @@ def FindTtyByPortIndex(port_index, driver_name=None):
   Returns:
     matched /dev/tty path. Return None if no port has been detected.
   """
-  for candidate in glob.glob('/dev/tty*'):
-    device_path = '/sys/class/tty/%s/device' % os.path.basename(candidate)
-    driver_path = os.path.realpath(os.path.join(device_path, 'driver'))
-
-    # If driver_name is given, check if driver_name exists at the tail of
-    # driver_path.
-    if driver_name and not driver_path.endswith(driver_name):
+  for entry in _tty_index.ByPortIndex(port_index):
+    # If driver_name is given, check if driver_name matches the driver.
+    if driver_name and entry.driver != driver_name:
       continue
+    logging.info('Find serial path : %s', entry.path)
+    return entry.path
+  return None
+
+
+def FindTtyByUsbSerial(usb_serial, driver_name=None):
+  """Finds serial port path tty* of the USB device with given serial number.
 
-    device_path = os.path.realpath(device_path)
-    # Check if port_index exists in device_path.
-    if '/%s/' % port_index in device_path:
-      logging.info('Find serial path : %s', candidate)
-      return candidate
+  Args:
+    usb_serial: String for serial number of the USB device.
+    driver_name: String for serial connection driver.
+
+  Returns:
+    matched /dev/tty path. Return None if no port has been detected.
+  """
+  for entry in _tty_index.ByUsbSerial(usb_serial):
+    if driver_name and entry.driver != driver_name:
+      continue
+    logging.info('Find serial path : %s', entry.path)
+    return entry.path
   return None
 
 
@@ -161,23 +290,35 @@ class SerialDevice(object):
 
     # Send 'FID' for getting fixture ID. Return received result. No retry.
     fixture_id = fixture.SendRecv('FID')
+
+    # Send 'V' and read the response line, however long it takes to arrive.
+    version = fixture.SendReceive('V', terminator='\\n')
   """
   def __init__(self, send_receive_interval_secs=0.2, retry_interval_secs=0.5,
-               log=False):
+               inter_byte_timeout_secs=0.05, log=False):
     """Constructor.
 
     Sets intervals between send/receive and between retries.
     Also, setting log to True to emit actions to logging.info.
 
+    Responses of known length or with a terminator are read as soon as they
+    arrive (see ReceiveUntil()), so callers asking for those may pass an
+    interval_secs of 0 to SendReceive().
+
     Args:
       send_receive_interval_secs: interval (seconds) between send-receive.
       retry_interval_secs: interval (seconds) between retrying command.
+      inter_byte_timeout_secs: silence (seconds) on the line that ends a
+          response of unknown length.
       log: True to enable logging.
     """
     self._serial = None
     self._port = ''
+    # Bytes read past a terminator, returned by the next receive.
+    self._pending = ''
     self.send_receive_interval_secs = send_receive_interval_secs
     self.retry_interval_secs = retry_interval_secs
+    self.inter_byte_timeout_secs = inter_byte_timeout_secs
     self.log = log
 
   def __del__(self):
@@ -275,8 +416,11 @@ class SerialDevice(object):
       SerialTimeoutException if it fails to receive N bytes.
     """
     if size == 0:
-      size = self._serial.inWaiting()
-    response = self._serial.read(size)
+      size = len(self._pending) + self._serial.inWaiting()
+    response = self._pending[:size]
+    self._pending = self._pending[size:]
+    if len(response) < size:
+      response += self._serial.read(size - len(response))
     if len(response) == size:
       if self.log:
         logging.info('Successfully received %r', response)
@@ -288,23 +432,97 @@ class SerialDevice(object):
         logging.warning(error_message)
       raise serial.SerialTimeoutException(error_message)
 
+  def ReceiveUntil(self, terminator=None, size=None, timeout=None,
+                   inter_byte_timeout=None):
+    """Receives a response as soon as it is complete.
+
+    The response is complete when terminator is received, when size bytes are
+    received, or, if neither is given, when the line stays silent for
+    inter_byte_timeout seconds after the first byte.
+
+    Args:
+      terminator: string ending the response; it is included in the result.
+      size: number of bytes to receive.
+      timeout: seconds to wait for the whole response. None to use the read
+          timeout of the connection, or to wait without deadline if it has
+          none either.
+      inter_byte_timeout: seconds of silence ending a response without
+          terminator and size. None to use self.inter_byte_timeout_secs.
+
+    Returns:
+      Received bytes.
+
+    Raises:
+      SerialTimeoutException if terminator or size bytes are not received in
+          time, or nothing is received at all.
+    """
+    if timeout is None:
+      timeout = self._serial.getTimeout()
+    if inter_byte_timeout is None:
+      inter_byte_timeout = self.inter_byte_timeout_secs
+    deadline = None if timeout is None else time.time() + timeout
+    response = self._pending
+    self._pending = ''
+    while True:
+      if terminator and terminator in response:
+        end = response.index(terminator) + len(terminator)
+        response, self._pending = response[:end], response[end:]
+        break
+      if size and len(response) >= size:
+        response, self._pending = response[:size], response[size:]
+        break
+      remaining = None if deadline is None else deadline - time.time()
+      if remaining is not None and remaining <= 0:
+        break
+      quiet = response and not terminator and not size
+      if quiet:
+        wait = (inter_byte_timeout if remaining is None else
+                min(remaining, inter_byte_timeout))
+      else:
+        wait = remaining
+      readable, _, _ = select.select([self._serial.fileno()], [], [], wait)
+      if not readable:
+        if quiet:
+          break
+        continue
+      response += self._serial.read(max(1, self._serial.inWaiting()))
+
+    complete = ((terminator and response.endswith(terminator)) or
+                (size and len(response) == size) or
+                (not terminator and not size and response))
+    if not complete:
+      self._pending = response + self._pending
+      error_message = 'Receive until %r (size %r) timeout after %s secs' % (
+          terminator, size, timeout)
+      if self.log:
+        logging.warning(error_message)
+      raise serial.SerialTimeoutException(error_message)
+    if self.log:
+      logging.info('Successfully received %r', response)
+    return response
+
   def FlushBuffer(self):
     """Flushes input/output buffer."""
+    self._pending = ''
     self._serial.flushInput()
     self._serial.flushOutput()
 
   def SendReceive(self, command, size=1, retry=0, interval_secs=None,
-                  suppress_log=False):
+                  suppress_log=False, terminator=None, timeout=None):
     """Sends a command and returns a N bytes response.
 
     Args:
       command: command to send
-      size: number of bytes to receive. 0 means receiving what already in the
-          input buffer.
+      size: number of bytes to receive. 0 means receiving what is in the input
+          buffer once interval_secs have elapsed. Ignored if terminator is
+          given.
       retry: number of retry.
       interval_secs: #seconds to wait between send and receive. If specified,
           overrides self.send_receive_interval_secs.
       suppress_log: True to disable log regardless of self.log value.
+      terminator: if given, receives until this string is received instead.
+      timeout: seconds to wait for the response. None to use the read timeout
+          of the connection.
 
     Returns:
       Received N bytes.
@@ -317,10 +535,15 @@ class SerialDevice(object):
       try:
         self.Send(command)
         if interval_secs is None:
-          time.sleep(self.send_receive_interval_secs)
-        else:
+          interval_secs = self.send_receive_interval_secs
+        if interval_secs:
           time.sleep(interval_secs)
-        response = self.Receive(size)
+        if terminator or size:
+          response = self.ReceiveUntil(terminator=terminator,
+                                       size=None if terminator else size,
+                                       timeout=timeout)
+        else:
+          response = self.Receive(0)
         if not suppress_log and self.log:
           logging.info('Successfully sent %r and received %r', command,
                        response)
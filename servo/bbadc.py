@@ -4,7 +4,12 @@
 
 """Allows creation of ADC interface for beaglebone devices."""
 import glob
+import logging
 import os
+import threading
+import time
+
+import numpy
 
 
 class BBadcError(Exception):
@@ -17,13 +22,20 @@ class BBadcError(Exception):
       msg: string, message describing error in detail
       value: integer, value of error when non-zero status returned.  Default=0
     """
-    super(BBAdcError, self).__init__(msg, value)
+    super(BBadcError, self).__init__(msg, value)
     self.msg = msg
     self.value = value
 
 
 class BBadc(object):
-  """Provides interface to ADC through beaglebone."""
+  """Provides interface to ADC through beaglebone.
+
+  The AIN files are opened once and kept open, each reading rewinds them.
+
+  Instance Variables:
+    _fds: list of the file descriptors of the AIN files, None until opened.
+    _lock: lock serializing the readings of the AIN files.
+  """
 
   ADC_ENABLE_COMMAND = 'echo cape-bone-iio > %s'
   ADC_ENABLE_NODE = '/sys/devices/bone_capemgr.*/slots'
@@ -31,20 +43,93 @@ class BBadc(object):
 
   def __init__(self):
     """Enables ADC drvier."""
+    self._logger = logging.getLogger('BBadc')
     adc_nodes = glob.glob(BBadc.ADC_ENABLE_NODE)
     for adc_node in adc_nodes:
       os.system(BBadc.ADC_ENABLE_COMMAND % adc_node)
+    self._fds = None
+    self._lock = threading.Lock()
+
+  def _open(self):
+    """Open the AIN files, from AIN0 up, if not open yet.
+
+    Raises:
+      BBadcError: If no AIN file is found yet, e.g. while the ADC driver
+          loads, or one can't be opened.  The next reading tries again.
+    """
+    if self._fds is None:
+      adc_in_nodes = sorted(glob.glob(BBadc.ADC_IN_NODE))
+      if not adc_in_nodes:
+        raise BBadcError('No ADC input matching %s' % BBadc.ADC_IN_NODE)
+      self._logger.debug('Opening %s', adc_in_nodes)
+      fds = []
+      try:
+        for adc_in in adc_in_nodes:
+          fds.append(os.open(adc_in, os.O_RDONLY))
+      except OSError as e:
+        for fd in fds:
+          os.close(fd)
+        raise BBadcError('Failed to open %s: %s' % (adc_in, e))
+      self._fds = fds
+    return self._fds
+
+  def close(self):
+    """Close the AIN files."""
+    with self._lock:
+      if self._fds is not None:
+        for fd in self._fds:
+          os.close(fd)
+        self._fds = None
+
+  def _read_fds(self, fds):
+    """Return the list of the values of the AIN files fds."""
+    values = []
+    for fd in fds:
+      # sysfs only produces a new value when read from the start.
+      os.lseek(fd, 0, os.SEEK_SET)
+      values.append(int(os.read(fd, 16), 10))
+    return values
 
   def read(self):
     """Reads ADC values.
 
     Returns:
       ADC inputs from AIN0 to AIN7.
+
+    Raises:
+      BBadcError: If the AIN files can't be opened.
     """
-    buffer = []
-    adc_in_nodes = glob.glob(BBadc.ADC_IN_NODE)
-    for adc_in in adc_in_nodes:
-      with open(adc_in, 'r') as f:
-        buffer.append(int(f.read(), 10))
+    with self._lock:
+      return self._read_fds(self._open())
+
+  def sample(self, count, rate):
+    """Reads ADC values count times at a fixed rate.
+
+    A late reading is made right away, and the next ones keep to the
+    original schedule.
+
+    Args:
+      count: integer, number of readings.
+      rate: float, readings per second.
+
+    Returns:
+      numpy array of count rows, one per reading, of the ADC inputs from AIN0
+      to AIN7.
 
-    return buffer
+    Raises:
+      BBadcError: If count or rate isn't positive, or the AIN files can't be
+          opened.
+    """
+    if count < 1 or rate <= 0:
+      raise BBadcError('Invalid sampling of %s readings at %s Hz' %
+                       (count, rate))
+    with self._lock:
+      fds = self._open()
+      samples = numpy.empty((count, len(fds)), dtype=numpy.int32)
+      start = time.time()
+      for i in xrange(count):
+        delay = start + i / float(rate) - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        samples[i] = self._read_fds(fds)
+    return samples
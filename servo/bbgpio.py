@@ -38,17 +38,29 @@ class BBgpioError(Exception):
 class BBgpio(gpio_interface.GpioInterface):
   """Provides interface to a beaglebone's GPIO.
 
+  The sysfs files of a gpio are opened once and kept open, and the direction
+  and pinmux set on a gpio are remembered so that they are only written when
+  they change.
+
   Instance Variables:
     _exported_gpios : list of gpios exported on the gpio. At exit time they
                       will all be unexported.
     _bbmux_controller : controller to select and setup signals on the
                         beaglebone's pins.
+    _value_fds : dict of the open file descriptors of the value files, by gpio
+                 number.
+    _directions : dict of the directions set (DIR_IN or DIR_OUT), by gpio
+                  number.
+    _muxed : set of (gpio name, muxfile) pinmuxes already set.
   """
 
   def __init__(self):
     self._logger = logging.getLogger('BBGpio')
     self._logger.debug('')
     self._exported_gpios = []
+    self._value_fds = {}
+    self._directions = {}
+    self._muxed = set()
     self._bbmux_controller = None
     if bbmux_controller.use_omapmux():
       self._bbmux_controller = bbmux_controller.BBmuxController()
@@ -69,6 +81,10 @@ class BBgpio(gpio_interface.GpioInterface):
     Raises:
       BBgpioError: If close fails
     """
+    for fd in self._value_fds.itervalues():
+      os.close(fd)
+    self._value_fds = {}
+    self._directions = {}
     for opened_gpio in self._exported_gpios:
       if os.path.exists(GPIO_PIN_PATTERN % opened_gpio):
         with open(UNEXPORT_FILE, 'w') as f:
@@ -80,7 +96,12 @@ class BBgpio(gpio_interface.GpioInterface):
 
     Args:
       gpio_index: GPIO number we want to export.
+
+    Returns:
+      file descriptor of the value file of the gpio, opened once.
     """
+    if gpio_index in self._value_fds:
+      return self._value_fds[gpio_index]
     if not os.path.exists(GPIO_PIN_PATTERN % gpio_index):
       try:
         with open(EXPORT_FILE, 'w') as f:
@@ -90,20 +111,30 @@ class BBgpio(gpio_interface.GpioInterface):
         self._logger.warn('GPIO: %s was already exported.', gpio_index)
       if gpio_index not in self._exported_gpios:
         self._exported_gpios.append(gpio_index)
+    fd = os.open(os.path.join(GPIO_PIN_PATTERN % gpio_index, 'value'),
+                 os.O_RDWR)
+    self._value_fds[gpio_index] = fd
+    return fd
 
-  def _set_direction(self, gpio_path, dir_val):
-    """Set gpio direction.
+  def _set_direction(self, gpio_index, dir_val):
+    """Set gpio direction, unless already set.
+
+    Rewriting 'out' would drive the gpio low before its value is written.
 
     Args:
-      gpio_path : path to the GPIO control directory we care about.
+      gpio_index: GPIO number we care about.
       dir_val   : direction value of the gpio.  dir_val is interpretted as:
                   0    : configure as input
                   1    : configure as output
     """
+    if self._directions.get(gpio_index) == dir_val:
+      return
+    gpio_path = GPIO_PIN_PATTERN % gpio_index
     with open(os.path.join(gpio_path, 'direction'), 'w') as f:
       self._logger.debug('Writing %s to %s/direction', DIR_VAL_MAP[dir_val],
                          gpio_path)
       f.write(DIR_VAL_MAP[dir_val])
+    self._directions[gpio_index] = dir_val
 
   def _set_pinmux(self, gpio_name, muxfile=None):
     """Set pinmux to route this pin as a GPIO
@@ -113,11 +144,14 @@ class BBgpio(gpio_interface.GpioInterface):
       muxfile : used to specify the correct omap_mux muxfile to select this
                 gpio.
     """
+    if (gpio_name, muxfile) in self._muxed:
+      return
     if muxfile:
       self._bbmux_controller.set_muxfile(muxfile, GPIO_MODE_VALUE,
                                          GPIO_SELECT_VALUE)
     else:
       self._bbmux_controller.set_pin_mode(gpio_name, GPIO_MODE_VALUE)
+    self._muxed.add((gpio_name, muxfile))
 
   def wr_rd(self, offset, width, dir_val=None, wr_val=None, chip=None,
             muxfile=None):
@@ -153,24 +187,22 @@ class BBgpio(gpio_interface.GpioInterface):
     if self._bbmux_controller:
       self._set_pinmux(gpio_name, muxfile)
 
-    self._export_gpio(gpio_index)
-    gpio_path = GPIO_PIN_PATTERN % gpio_index
+    fd = self._export_gpio(gpio_index)
 
     if dir_val is None and wr_val is not None:
       dir_val = DIR_OUT
 
     if dir_val is not None:
-      self._set_direction(gpio_path, dir_val)
+      self._set_direction(gpio_index, dir_val)
 
+    # The value file is rewound, sysfs only reads or writes it from its start.
+    os.lseek(fd, 0, os.SEEK_SET)
     if dir_val:
       # This is a write.
-      with open(os.path.join(gpio_path, 'value'), 'w') as f:
-        self._logger.debug('Writing %d to %s/value', wr_val, gpio_path)
-        f.write('%d' % wr_val)
+      self._logger.debug('Writing %d to gpio%d/value', wr_val, gpio_index)
+      os.write(fd, '%d' % wr_val)
     else:
       # This is a read.
-      with open(os.path.join(gpio_path, 'value'), 'r') as f:
-        self._logger.debug('Reading from %s/value', gpio_path)
-        rd_val = int(f.read(), 0)
-        self._logger.debug('Read value: %d.', rd_val)
-        return rd_val
+      rd_val = int(os.read(fd, 16), 0)
+      self._logger.debug('Read value: %d from gpio%d.', rd_val, gpio_index)
+      return rd_val
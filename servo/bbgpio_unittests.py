@@ -79,6 +79,24 @@ class TestBBgpio(mox.MoxTestBase):
       value = f.read()
     self.assertEquals(value, '0')
 
+  def testRepeatedWrites(self):
+    # The pinmux is only set once.
+    self._mock_mux()
+    self.mox.ReplayAll()
+    gpio_controller = bbgpio.BBgpio()
+    gpio_controller.wr_rd(OFFSET, WIDTH, dir_val=1, wr_val=1, chip=CHIP)
+    # Direction is only written when it changes.
+    open(self._direction_file, 'w').close()
+    gpio_controller.wr_rd(OFFSET, WIDTH, dir_val=1, wr_val=0, chip=CHIP)
+    with open(self._direction_file, 'r') as f:
+      self.assertEquals(f.read(), '')
+    with open(self._value_file, 'r') as f:
+      self.assertEquals(f.read(), '0')
+    self.assertEquals(gpio_controller.wr_rd(OFFSET, WIDTH, chip=CHIP), 0)
+    gpio_controller.wr_rd(OFFSET, WIDTH, dir_val=0, chip=CHIP)
+    with open(self._direction_file, 'r') as f:
+      self.assertEquals(f.read(), 'in')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
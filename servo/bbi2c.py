@@ -1,12 +1,24 @@
 # Copyright (c) 2013 The Chromium OS Authors. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
-"""Allows creation of i2c interface for beaglebone devices."""
+"""Allows creation of i2c interface for beaglebone devices.
+
+Transactions go through the kernel i2c-dev interface (/dev/i2c-N) with the
+I2C_RDWR ioctl.  If the device file can't be opened, they fall back to the
+i2cset/i2cget tools, which limits them to 3-byte writes and 2-byte reads.
+"""
+import ctypes
+import fcntl
 import logging
+import os
 import subprocess
 
 import bbmux_controller
 
+# From linux/i2c-dev.h and linux/i2c.h.
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
 
 class BBi2cError(Exception):
   """Class for exceptions of BBi2c."""
@@ -21,16 +33,45 @@ class BBi2cError(Exception):
     self.msg = msg
     self.value = value
 
+
+class I2cMsg(ctypes.Structure):
+  """Defines one message of an I2C_RDWR ioctl, struct i2c_msg."""
+  _fields_ = [('addr', ctypes.c_uint16),
+              ('flags', ctypes.c_uint16),
+              ('len', ctypes.c_uint16),
+              ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+
+class I2cRdwrIoctlData(ctypes.Structure):
+  """Defines the argument of an I2C_RDWR ioctl, struct i2c_rdwr_ioctl_data."""
+  _fields_ = [('msgs', ctypes.POINTER(I2cMsg)),
+              ('nmsgs', ctypes.c_uint32)]
+
+
 class BBi2c(object):
-  """Provide interface to i2c through beaglebone"""
+  """Provide interface to i2c through beaglebone
+
+  Instance Variables:
+    _bus_num: number of the i2c bus.
+    _use_i2c_dev: whether transactions go through i2c-dev.
+    _fd: file descriptor of the i2c-dev device file, None until opened.
+  """
+
+  def __init__(self, interface, use_i2c_dev=True):
+    """BBi2c constructor.
 
-  def __init__(self, interface):
+    Args:
+      interface: dict of the interface, with the 'bus_num' of the i2c bus.
+      use_i2c_dev: use the i2c-dev interface, else the i2cset/i2cget tools.
+    """
     self._logger = logging.getLogger("BBi2c")
     self._interface = interface
     self._bus_num = interface['bus_num']
     # Older kernels utilizing the omap mux starts counting from 1
     if bbmux_controller.use_omapmux():
       self._bus_num += 1
+    self._use_i2c_dev = use_i2c_dev
+    self._fd = None
 
   def open(self):
     """Opens access to FTDI interface as a i2c (MPSSE mode) interface.
@@ -46,7 +87,61 @@ class BBi2c(object):
     Raises:
       BBi2cError: If close fails
     """
-    pass
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def _open_i2c_dev(self):
+    """Open the i2c-dev device file of the bus if not open yet.
+
+    Returns:
+      True if the device file is open, False if transactions have to fall
+      back to the i2c tools.
+    """
+    if self._fd is None and self._use_i2c_dev:
+      path = '/dev/i2c-%d' % self._bus_num
+      try:
+        self._fd = os.open(path, os.O_RDWR)
+      except OSError as e:
+        self._logger.warning('Using i2c tools, failed to open %s: %s', path, e)
+        self._use_i2c_dev = False
+    return self._fd is not None
+
+  def _wr_rd_i2c_dev(self, slv, wlist, rcnt):
+    """Write and/or read a slave i2c device in one I2C_RDWR ioctl.
+
+    The write and the read are separated by a repeated start.
+
+    Args:
+      slv: 7-bit address of the slave device.
+      wlist: list of bytes to write to the slave.
+      rcnt: number of bytes to read from the device.
+
+    Returns:
+      list of bytes read from i2c device.
+
+    Raises:
+      BBi2cError: If the transaction fails.
+    """
+    rcnt = rcnt or 0
+    msgs = (I2cMsg * 2)()
+    nmsgs = 0
+    if wlist:
+      wbuf = (ctypes.c_uint8 * len(wlist))(*wlist)
+      msgs[nmsgs] = I2cMsg(slv, 0, len(wlist), wbuf)
+      nmsgs += 1
+    rbuf = (ctypes.c_uint8 * rcnt)()
+    if rcnt:
+      msgs[nmsgs] = I2cMsg(slv, I2C_M_RD, rcnt, rbuf)
+      nmsgs += 1
+    if not nmsgs:
+      return []
+    try:
+      fcntl.ioctl(self._fd, I2C_RDWR, I2cRdwrIoctlData(msgs, nmsgs))
+    except IOError as e:
+      raise BBi2cError('Failed i2c transaction with slave address: %s wlist: '
+                       '%s rcnt: %d: %s' % (slv, wlist, rcnt, e), e.errno)
+    return list(rbuf)
 
   def setclock(self, speed=100000):
     """Sets i2c clock speed.
@@ -174,14 +269,17 @@ class BBi2c(object):
       slv: 7-bit address of the slave device
       wlist: list of bytes to write to the slave.  If list length is zero its
           just a read.
-      rcnt: number of bytes (0-2) to read from the device. If zero, its just a
-          write.
+      rcnt: number of bytes to read from the device. If zero, its just a
+          write.  Limited to 0-2 bytes without i2c-dev.
 
     Returns:
       list of bytes read from i2c device.
     """
     self._logger.debug('wr_rd. slv: 0x%x, wlist: %s, rcnt: %s', slv, wlist,
                        rcnt)
+    if self._open_i2c_dev():
+      return self._wr_rd_i2c_dev(slv, wlist, rcnt)
+
     address = '0x%02x' % wlist[0]
     if wlist:
       self._write(slv, address, wlist[1:])
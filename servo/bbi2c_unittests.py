@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 """Tests usage of i2c interface for beaglebone devices."""
 import mox
+import os
 import unittest
 
 import bbi2c
@@ -44,7 +45,7 @@ class TestBBi2c(mox.MoxTestBase):
     data = [0x10]
     self.readTestHelper(data)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     result = self.bbi2c.wr_rd(SLAVE_ADDRESS, [DATA_ADDRESS], len(data))
     self.assertEquals(result, data)
 
@@ -52,7 +53,7 @@ class TestBBi2c(mox.MoxTestBase):
     data = [0x10, 0x01]
     self.readTestHelper(data)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     result = self.bbi2c.wr_rd(SLAVE_ADDRESS, [DATA_ADDRESS], len(data))
     self.assertEquals(result, data)
 
@@ -60,27 +61,27 @@ class TestBBi2c(mox.MoxTestBase):
     data = [0x7]
     self.singleWriteTestHelper(data)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     self.bbi2c.wr_rd(SLAVE_ADDRESS, data, 0)
 
   def testTwoByteWrite(self):
     data = [0x7, 0x8]
     self.singleWriteTestHelper(data)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     self.bbi2c.wr_rd(SLAVE_ADDRESS, data, 0)
 
   def testThreeByteWrite(self):
     data = [0x7, 0x8, 0x9]
     self.singleWriteTestHelper(data)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     self.bbi2c.wr_rd(SLAVE_ADDRESS, data, 0)
 
   def testBlockWriteFailure(self):
     data = [0x7, 0x8, 0x9, 0x10, 0x11, 0x12, 0x13]
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     with self.assertRaises(bbi2c.BBi2cError):
       self.bbi2c.wr_rd(SLAVE_ADDRESS, data, 0)
 
@@ -90,10 +91,63 @@ class TestBBi2c(mox.MoxTestBase):
     self.singleWriteTestHelper(wr_data)
     self.readTestHelper(rd_data, send_address=False)
     self.mox.ReplayAll()
-    self.bbi2c = bbi2c.BBi2c({'bus_num': 2})
+    self.bbi2c = bbi2c.BBi2c({'bus_num': 2}, use_i2c_dev=False)
     result = self.bbi2c.wr_rd(SLAVE_ADDRESS, wr_data, len(rd_data))
     self.assertEquals(result, rd_data)
 
 
+class TestBBi2cDev(mox.MoxTestBase):
+
+  def setUp(self):
+    super(TestBBi2cDev, self).setUp()
+    bbi2c.bbmux_controller = self.mox.CreateMockAnything()
+    bbi2c.bbmux_controller.use_omapmux().AndReturn(True)
+    self.mox.StubOutWithMock(bbi2c.os, 'open')
+    self.mox.StubOutWithMock(bbi2c.fcntl, 'ioctl')
+    self._msgs = []
+
+  def _ioctl(self, fd, request, data):
+    """Record the messages of an I2C_RDWR and fill the reads with 0xa0+i."""
+    for msg in data.msgs[:data.nmsgs]:
+      if msg.flags & bbi2c.I2C_M_RD:
+        for i in xrange(msg.len):
+          msg.buf[i] = 0xa0 + i
+      self._msgs.append((msg.addr, msg.flags, msg.buf[:msg.len]))
+
+  def expectIoctl(self):
+    bbi2c.fcntl.ioctl(5, bbi2c.I2C_RDWR, mox.IgnoreArg()).WithSideEffects(
+        self._ioctl)
+
+  def testWriteAndBlockRead(self):
+    bbi2c.os.open('/dev/i2c-3', os.O_RDWR).AndReturn(5)
+    self.expectIoctl()
+    self.expectIoctl()
+    self.mox.ReplayAll()
+    i2c = bbi2c.BBi2c({'bus_num': 2})
+    self.assertEquals([0xa0, 0xa1, 0xa2, 0xa3],
+                      i2c.wr_rd(SLAVE_ADDRESS, [DATA_ADDRESS], 4))
+    self.assertEquals([], i2c.wr_rd(SLAVE_ADDRESS, [0x7, 0x8, 0x9, 0x10], 0))
+    self.assertEquals([(SLAVE_ADDRESS, 0, [DATA_ADDRESS]),
+                       (SLAVE_ADDRESS, bbi2c.I2C_M_RD, [0xa0, 0xa1, 0xa2, 0xa3]),
+                       (SLAVE_ADDRESS, 0, [0x7, 0x8, 0x9, 0x10])], self._msgs)
+
+  def testFailure(self):
+    bbi2c.os.open('/dev/i2c-3', os.O_RDWR).AndReturn(5)
+    bbi2c.fcntl.ioctl(5, bbi2c.I2C_RDWR, mox.IgnoreArg()).AndRaise(
+        IOError(121, 'Remote I/O error'))
+    self.mox.ReplayAll()
+    i2c = bbi2c.BBi2c({'bus_num': 2})
+    with self.assertRaises(bbi2c.BBi2cError):
+      i2c.wr_rd(SLAVE_ADDRESS, [DATA_ADDRESS], 1)
+
+  def testFallbackToTools(self):
+    bbi2c.subprocess = self.mox.CreateMockAnything()
+    bbi2c.os.open('/dev/i2c-3', os.O_RDWR).AndRaise(OSError(2, 'No such file'))
+    bbi2c.subprocess.check_call(['i2cset', '-y', '3', '0x20', '0x07'])
+    self.mox.ReplayAll()
+    i2c = bbi2c.BBi2c({'bus_num': 2})
+    i2c.wr_rd(SLAVE_ADDRESS, [0x7], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
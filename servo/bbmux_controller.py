@@ -7,6 +7,8 @@ import os
 import re
 
 SIGNALS_RE = '^signals'
+# Current value of a mux, at the end of the first part of its name line.
+NAME_RE = r'^name: .* = (0x[0-9a-fA-F]+)\)'
 MUX_ROOT = '/sys/kernel/debug/omap_mux'
 
 
@@ -32,9 +34,15 @@ def use_omapmux():
 class BBmuxController(object):
   """Provides omap mux controls to interfaces that require them.
 
+    The mux files are only read when looking up a pin not found in the files
+    read so far, and a mux is only written when its value changes.
+
     Class Variables:
       _pin_name_map : Map of signal name to pin name.
       _pin_mode_map : Map of signal name to the correct mode to select it.
+      _mux_files_to_scan : Mux files not read yet, None until the first
+                           lookup lists them.
+      _mux_values : Map of mux file name to the value last read or written.
   """
 
 
@@ -42,46 +50,73 @@ class BBmuxController(object):
   # them once, share it amongst the different instances.
   _pin_mode_map = {}
   _pin_name_map = {}
+  _mux_files_to_scan = None
+  _mux_values = {}
 
   def __init__(self):
     self._logger = logging.getLogger('BBmuxController')
     self._logger.debug('')
-    if not BBmuxController._pin_name_map:
-      self._init_pin_maps()
 
-  def _init_pin_maps(self):
-    """Create a map pairing pins to the correct mux control file.
+  def _scan_mux_file(self, mux_file):
+    """Add the signals of a mux file to the pin maps.
 
-    This function goes through each mux file in the omap_mux folder.
     Each file has a signals line listing the signals this mux controls.
 
     For example:
       signals: sig1 | sig2 | sig3 | mmc2_dat6 | NA | NA | NA | gpio0_26
 
     The end result is two maps that for a given signal name we can determine
-    which mux file it belongs to and what is the value to select it.
+    which mux file it belongs to and what is the value to select it.  The name
+    line also gives the current value of the mux, e.g. 0x0037 in:
+      name: gpmc_a9.gpio1_25 (0x44e10844/0x844 = 0x0037), b NA, t NA
+
+    Args:
+      mux_file : name of the mux file in MUX_ROOT.
+    """
+    mux_file_path = os.path.join(MUX_ROOT, mux_file)
+    with open(mux_file_path, 'r') as f:
+      for line in f:
+        match = re.match(NAME_RE, line)
+        if match:
+          BBmuxController._mux_values[mux_file] = int(match.group(1), 16)
+        # Check if this is the signals line.
+        if re.match(SIGNALS_RE, line):
+          # The line starts with 'signals:' which is not a field. So start
+          # counting from -1.
+          control_num = -1
+          for field in line.split():
+            if field is not '|':
+              BBmuxController._pin_mode_map[field] = control_num
+              BBmuxController._pin_name_map[field] = mux_file
+              self._logger.debug('Pin %s in in file %s with mode %s', field,
+                                 self._pin_name_map[field],
+                                 self._pin_mode_map[field])
+              control_num += 1
+
+  def _lookup_pin(self, pin_name):
+    """Read the mux files until finding the one of a pin.
+
+    Args:
+      pin_name : Pin we want to select.
+
+    Returns:
+      tuple (mux file name, value selecting the pin).
+
+    Raises:
+      KeyError: if no mux file has the pin.
     """
     # TODO (sbasi/tbroch) crbug.com/241623 - default these gpios on boot.
-    for mux_file in os.listdir(MUX_ROOT):
-      mux_file_path = os.path.join(MUX_ROOT, mux_file)
-      if os.path.isdir(mux_file_path):
+    if BBmuxController._mux_files_to_scan is None:
+      BBmuxController._mux_files_to_scan = os.listdir(MUX_ROOT)
+    while (pin_name not in BBmuxController._pin_name_map and
+           BBmuxController._mux_files_to_scan):
+      mux_file = BBmuxController._mux_files_to_scan.pop(0)
+      if os.path.isdir(os.path.join(MUX_ROOT, mux_file)):
         # Skip any folders in the mux directory.
         continue
-      with open(mux_file_path, 'r') as f:
-        for line in f:
-          # Check if this is the signals line.
-          if re.match(SIGNALS_RE, line):
-            # The line starts with 'signals:' which is not a field. So start
-            # counting from -1.
-            control_num = -1
-            for field in line.split():
-              if field is not '|':
-                BBmuxController._pin_mode_map[field] = control_num
-                BBmuxController._pin_name_map[field] = mux_file
-                self._logger.debug('Pin %s in in file %s with mode %s', field,
-                                   self._pin_name_map[field],
-                                   self._pin_mode_map[field])
-                control_num += 1
+      self._scan_mux_file(mux_file)
+    return (BBmuxController._pin_name_map[pin_name],
+            BBmuxController._pin_mode_map[pin_name])
 
   def set_muxfile(self, mux, mode_val, sel_val):
     """Allow direct access to the muxfiles.
@@ -98,11 +133,15 @@ class BBmuxController(object):
       sel_val : Signal we want to choose. Should be a 3-bit hex number.
     """
     mode = mode_val * 16 + sel_val
-    mux = os.path.join(MUX_ROOT, mux)
-    with open(mux, 'w') as mux_file:
+    if BBmuxController._mux_values.get(mux) == mode:
+      self._logger.debug('%s already set to 0x%02x', mux, mode)
+      return
+    mux_path = os.path.join(MUX_ROOT, mux)
+    with open(mux_path, 'w') as mux_file:
       # We want to set the Pin Mux to the correct setting + mode.
-      self._logger.debug('Writing 0x%02x to %s', mode, mux)
+      self._logger.debug('Writing 0x%02x to %s', mode, mux_path)
       mux_file.write('0x%02x' % mode)
+    BBmuxController._mux_values[mux] = mode
 
   def set_pin_mode(self, pin_name, mode_val):
     """Select/setup a pin to be used by the Beaglebone.
@@ -115,6 +154,5 @@ class BBmuxController(object):
                  Bit 1: 1=Pull Up 0=Pull Down
                  Bit 0: 1=Pull Enabled 0=Pull Disabled.
     """
-    mux_name = BBmuxController._pin_name_map[pin_name]
-    sel_val = BBmuxController._pin_mode_map[pin_name]
+    (mux_name, sel_val) = self._lookup_pin(pin_name)
     self.set_muxfile(mux_name, mode_val, sel_val)
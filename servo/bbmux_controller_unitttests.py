@@ -15,6 +15,8 @@ FAKE_MUX_FILE = 'mux_file'
 FAKE_MUX_FILE_PATH = '/sys/kernel/debug/omap_mux/mux_file'
 FAKE_MUX_FILE_CONTENTS = ('signals: gpmc_a9 | mii2_rxd2 | rgmii2_rd2 | '
                           'mmc2_dat7 | NA | NA | mcasp0_fsx | gpio1_25')
+FAKE_MUX_FILE_NAME = ('name: gpmc_a9.gpio1_25 (0x44e10844/0x844 = 0x0037), '
+                      'b NA, t NA')
 MUX_MODE = '0x37'
 EXPECTED_PIN_NAME_MAP = {'signals:'   : 'mux_file',
                          'gpmc_a9'    : 'mux_file',
@@ -41,25 +43,22 @@ class TestBBmuxController(mox.MoxTestBase):
   def setUp(self):
     super(TestBBmuxController, self).setUp()
     self.mox.StubOutWithMock(__builtin__, 'open')
+    self.mox.StubOutWithMock(bbmux_controller.os, 'listdir')
+    self.mox.StubOutWithMock(bbmux_controller.os.path, 'isdir')
+    # The pin maps and mux values are class variables, start each test afresh.
+    bbmux_controller.BBmuxController._pin_name_map = {}
+    bbmux_controller.BBmuxController._pin_mode_map = {}
+    bbmux_controller.BBmuxController._mux_files_to_scan = None
+    bbmux_controller.BBmuxController._mux_values = {}
 
-  def testInitialization(self):
-    bbmux_controller.os = self.mox.CreateMockAnything()
-    bbmux_controller.os.path = self.mox.CreateMockAnything()
+  def _readMuxFileHelper(self, contents):
     bbmux_controller.os.listdir(bbmux_controller.MUX_ROOT).AndReturn(
         [FAKE_MUX_FILE])
-    bbmux_controller.os.path.join(bbmux_controller.MUX_ROOT,
-                                  FAKE_MUX_FILE).MultipleTimes().AndReturn(
-                                  FAKE_MUX_FILE_PATH)
-    bbmux_controller.os.path.isdir(mox.IgnoreArg()).MultipleTimes().AndReturn(
-        False)
+    bbmux_controller.os.path.isdir(FAKE_MUX_FILE_PATH).AndReturn(False)
     mux_file = self.mox.CreateMockAnything()
-    mux_file.__enter__().AndReturn([FAKE_MUX_FILE_CONTENTS])
+    mux_file.__enter__().AndReturn(contents)
     mux_file.__exit__(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
     open(FAKE_MUX_FILE_PATH, 'r').AndReturn(mux_file)
-    self.mox.ReplayAll()
-    mux_controller = bbmux_controller.BBmuxController()
-    self.assertEquals(EXPECTED_PIN_NAME_MAP, mux_controller._pin_name_map)
-    self.assertEquals(EXPECTED_PIN_MODE_MAP, mux_controller._pin_mode_map)
 
   def _writeToMuxFileHelper(self):
     mux_file = self.mox.CreateMockAnything()
@@ -69,11 +68,21 @@ class TestBBmuxController(mox.MoxTestBase):
     mux_file.__exit__(mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
 
   def testSetPinMode(self):
-    """Test Selecting and setting a pin."""
+    """Test Selecting and setting a pin, which reads the mux files."""
+    self._readMuxFileHelper([FAKE_MUX_FILE_CONTENTS])
     self._writeToMuxFileHelper()
     self.mox.ReplayAll()
-    # Since testInitialization ran first, BBmuxController should not initialize
-    # its pin maps as they are class variables.
+    mux_controller = bbmux_controller.BBmuxController()
+    mux_controller.set_pin_mode('gpio1_25', 0x3)
+    self.assertEquals(EXPECTED_PIN_NAME_MAP, mux_controller._pin_name_map)
+    self.assertEquals(EXPECTED_PIN_MODE_MAP, mux_controller._pin_mode_map)
+    # Mux files are read once, and not written again for the same mode.
+    bbmux_controller.BBmuxController().set_pin_mode('gpio1_25', 0x3)
+
+  def testSetPinModeAlreadySet(self):
+    """Test the mux isn't written when its current value is the mode."""
+    self._readMuxFileHelper([FAKE_MUX_FILE_NAME, FAKE_MUX_FILE_CONTENTS])
+    self.mox.ReplayAll()
     mux_controller = bbmux_controller.BBmuxController()
     mux_controller.set_pin_mode('gpio1_25', 0x3)
 
@@ -81,10 +90,9 @@ class TestBBmuxController(mox.MoxTestBase):
     """Test Selecting and setting a pin."""
     self._writeToMuxFileHelper()
     self.mox.ReplayAll()
-    # Since testInitialization ran first, BBmuxController should not initialize
-    # its pin maps as they are class variables.
     mux_controller = bbmux_controller.BBmuxController()
     mux_controller.set_muxfile(FAKE_MUX_FILE, 0x3, 0x7)
+    mux_controller.set_muxfile(FAKE_MUX_FILE, 0x3, 0x7)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
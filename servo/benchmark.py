@@ -0,0 +1,14 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Helpers shared by the benchmark scripts."""
+
+import time
+
+
+def measure(func, count):
+  """Return the calls per second of func, called count times."""
+  start = time.time()
+  for _ in xrange(count):
+    func()
+  return count / (time.time() - start)
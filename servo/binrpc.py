@@ -0,0 +1,401 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Compact binary request/response protocol for servod.
+
+XMLRPC spends most of the time of a get or set encoding and parsing XML and
+HTTP headers, which dominates the CPU usage of high-rate clients like power
+loggers.  This protocol is served on the same listeners as XMLRPC: a client
+opens a connection by sending MAGIC, and keeps it open for all its calls.
+
+Every message is a 4-byte big-endian length followed by one encoded value.
+Values are encoded msgpack-style, as a one-byte tag followed by the payload:
+  'N' None, 'T' True, 'F' False
+  'i' 8-byte signed integer, 'd' 8-byte double
+  's' byte string, 'u' UTF-8 unicode string: 4-byte length and the bytes
+  'l' list (or tuple), 'm' dict: 4-byte count and the items (keys, values)
+
+A request is a list whose first item is an OP_* code.  Control names are
+resolved once per connection into integer ids (OP_RESOLVE), which the other
+requests use:
+  [OP_RESOLVE, [names]]   -> list of ids
+  [OP_GET, id]            -> value of the control
+  [OP_SET, id, value]     -> None
+  [OP_GET_MANY, [ids]]    -> list of values
+  [OP_CALL, method, args] -> result of any servod method
+The response is [STATUS_OK, result] or [STATUS_FAULT, message], the message
+being formatted like the faultString of XMLRPC faults.
+"""
+
+import errno
+import socket
+import struct
+import threading
+import xmlrpclib
+
+MAGIC = 'SRVB\x01'
+# First bytes of a connection identifying the protocol, whatever the version.
+MAGIC_PREFIX = MAGIC[:4]
+# Largest message accepted, to catch garbage before allocating for it.
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+OP_RESOLVE = 1
+OP_GET = 2
+OP_SET = 3
+OP_GET_MANY = 4
+OP_CALL = 5
+
+STATUS_OK = 0
+STATUS_FAULT = 1
+
+_LENGTH = struct.Struct('>I')
+_INT = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+_INT_MIN = -(1 << 63)
+_INT_MAX = (1 << 63) - 1
+# Errors of a request on a connection servod closed while it was idle, after
+# which the request is safe to retry as servod didn't receive it.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+
+class BinaryRPCError(Exception):
+  """Exception class for malformed or unencodable messages."""
+
+
+class Fault(xmlrpclib.Fault):
+  """Call which failed in servod, like its XMLRPC counterpart."""
+
+  def __init__(self, message):
+    xmlrpclib.Fault.__init__(self, 1, message)
+
+
+def _encode(value, out):
+  """Append the encoding of value to the list of strings out."""
+  if value is None:
+    out.append('N')
+  elif value is True:
+    out.append('T')
+  elif value is False:
+    out.append('F')
+  elif isinstance(value, (int, long)):
+    if not _INT_MIN <= value <= _INT_MAX:
+      raise BinaryRPCError('Integer out of range: %d' % value)
+    out.append('i' + _INT.pack(value))
+  elif isinstance(value, float):
+    out.append('d' + _DOUBLE.pack(value))
+  elif isinstance(value, str):
+    out.append('s' + _LENGTH.pack(len(value)))
+    out.append(value)
+  elif isinstance(value, unicode):
+    data = value.encode('utf-8')
+    out.append('u' + _LENGTH.pack(len(data)))
+    out.append(data)
+  elif isinstance(value, (list, tuple)):
+    out.append('l' + _LENGTH.pack(len(value)))
+    for item in value:
+      _encode(item, out)
+  elif isinstance(value, dict):
+    out.append('m' + _LENGTH.pack(len(value)))
+    for key, item in value.iteritems():
+      _encode(key, out)
+      _encode(item, out)
+  else:
+    raise BinaryRPCError('Cannot encode %s' % type(value).__name__)
+
+
+def encode(value):
+  """Return the encoding of value, without framing.
+
+  Raises:
+    BinaryRPCError: if value (or an item of it) has an unsupported type.
+  """
+  out = []
+  _encode(value, out)
+  return ''.join(out)
+
+
+def _decode(data, offset):
+  """Decode the value at offset of data.
+
+  Returns:
+    tuple (value, offset following the value)
+  """
+  tag = data[offset]
+  offset += 1
+  if tag == 'N':
+    return None, offset
+  if tag == 'T':
+    return True, offset
+  if tag == 'F':
+    return False, offset
+  if tag == 'i':
+    return _INT.unpack_from(data, offset)[0], offset + _INT.size
+  if tag == 'd':
+    return _DOUBLE.unpack_from(data, offset)[0], offset + _DOUBLE.size
+  (length,) = _LENGTH.unpack_from(data, offset)
+  offset += _LENGTH.size
+  if tag == 's' or tag == 'u':
+    end = offset + length
+    if end > len(data):
+      raise BinaryRPCError('Truncated string')
+    if tag == 'u':
+      return data[offset:end].decode('utf-8'), end
+    return data[offset:end], end
+  if tag == 'l':
+    items = []
+    for _ in xrange(length):
+      item, offset = _decode(data, offset)
+      items.append(item)
+    return items, offset
+  if tag == 'm':
+    items = {}
+    for _ in xrange(length):
+      key, offset = _decode(data, offset)
+      items[key], offset = _decode(data, offset)
+    return items, offset
+  raise BinaryRPCError('Unknown tag %r' % tag)
+
+
+def decode(data):
+  """Return the value encoded in data.
+
+  Raises:
+    BinaryRPCError: if data is not exactly one well-formed value.
+  """
+  try:
+    value, offset = _decode(data, 0)
+  except (IndexError, struct.error, UnicodeDecodeError, TypeError) as e:
+    raise BinaryRPCError('Malformed message: %s' % e)
+  if offset != len(data):
+    raise BinaryRPCError('Trailing bytes in message')
+  return value
+
+
+def send_message(sock, value):
+  """Send value as one message on sock."""
+  data = encode(value)
+  sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def recv_message(rfile):
+  """Read one message from the file object rfile.
+
+  Returns:
+    the decoded value, or None if the peer closed the connection between
+    messages.
+
+  Raises:
+    BinaryRPCError: if the message is truncated or malformed.
+  """
+  header = rfile.read(_LENGTH.size)
+  if not header:
+    return None
+  if len(header) != _LENGTH.size:
+    raise BinaryRPCError('Truncated message header')
+  (length,) = _LENGTH.unpack(header)
+  if length > MAX_MESSAGE_SIZE:
+    raise BinaryRPCError('Message of %d bytes is too large' % length)
+  data = rfile.read(length)
+  if len(data) != length:
+    raise BinaryRPCError('Truncated message')
+  return decode(data)
+
+
+def is_binrpc(sock):
+  """Return True if the peer of a new connection speaks this protocol.
+
+  Nothing is consumed from the socket.
+  """
+  try:
+    return (sock.recv(len(MAGIC_PREFIX), socket.MSG_PEEK | socket.MSG_WAITALL)
+            == MAGIC_PREFIX)
+  except socket.error:
+    return False
+
+
+class _Session(object):
+  """Requests of one connection, dispatched like XMLRPC calls."""
+
+  def __init__(self, dispatch):
+    """Constructor.
+
+    Args:
+      dispatch: function taking (method name, tuple of arguments), e.g.
+          SimpleXMLRPCServer._dispatch.
+    """
+    self._dispatch = dispatch
+    # Names of the controls resolved on this connection, indexed by id.
+    self._names = []
+    self._ids = {}
+
+    self._handlers = {
+        OP_RESOLVE: self._resolve,
+        OP_GET: lambda control_id: self._dispatch(
+            'get', (self._names[control_id],)),
+        OP_SET: lambda control_id, value: self._dispatch(
+            'set', (self._names[control_id], value)),
+        OP_GET_MANY: lambda control_ids: [
+            self._dispatch('get', (self._names[control_id],))
+            for control_id in control_ids],
+        OP_CALL: lambda method, args: self._dispatch(method, tuple(args)),
+    }
+
+  def _resolve(self, names):
+    ids = []
+    for name in names:
+      if name not in self._ids:
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+      ids.append(self._ids[name])
+    return ids
+
+  def handle(self, request):
+    """Return the encoded response to a request."""
+    try:
+      handler = self._handlers[request[0]]
+      return encode([STATUS_OK, handler(*request[1:])])
+    except Exception as e:
+      # Same format as SimpleXMLRPCServer faults, for ServoClientError.
+      return encode([STATUS_FAULT, '%s:%s' % (type(e), e)])
+
+
+def serve_connection(rfile, sock, dispatch):
+  """Serve the requests of a connection until it is closed.
+
+  Args:
+    rfile: file object reading from sock.
+    sock: connected socket, beginning with MAGIC.
+    dispatch: see _Session.
+
+  Raises:
+    BinaryRPCError: if the peer doesn't follow the protocol.
+  """
+  magic = rfile.read(len(MAGIC))
+  if magic != MAGIC:
+    raise BinaryRPCError('Unsupported protocol version %r' % magic)
+  sock.sendall(MAGIC)
+  session = _Session(dispatch)
+  while True:
+    request = recv_message(rfile)
+    if request is None:
+      return
+    if not isinstance(request, list) or not request:
+      raise BinaryRPCError('Malformed request %r' % request)
+    data = session.handle(request)
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+class Connection(object):
+  """Client connection to servod speaking this protocol.
+
+  Control ids are resolved on first use and cached.  Calls are serialized, a
+  connection may be shared by several threads.
+  """
+
+  def __init__(self, address, family=socket.AF_INET, timeout=None):
+    """Constructor.
+
+    Args:
+      address: (host, port) tuple, or path of a Unix domain socket.
+      family: socket.AF_INET or socket.AF_UNIX.
+      timeout: seconds to wait for a response, None to wait forever.
+    """
+    self._address = address
+    self._family = family
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._sock = None
+    self._rfile = None
+    self._ids = {}
+
+  def _connect(self):
+    if self._family == socket.AF_UNIX:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(self._timeout)
+    try:
+      sock.connect(self._address)
+      sock.sendall(MAGIC)
+      rfile = sock.makefile('rb')
+      if rfile.read(len(MAGIC)) != MAGIC:
+        raise BinaryRPCError('Server does not speak the binary protocol')
+    except:
+      sock.close()
+      raise
+    self._sock = sock
+    self._rfile = rfile
+
+  def _disconnect(self):
+    self._rfile.close()
+    self._sock.close()
+    self._sock = None
+    # Ids are only valid on the connection they were resolved on.
+    self._ids = {}
+
+  def close(self):
+    with self._lock:
+      if self._sock:
+        self._disconnect()
+
+  def _request(self, request):
+    """Send a request and return the result, the lock being held.
+
+    Raises:
+      Fault: if the call failed in servod.
+      BinaryRPCError, socket.error: if the connection failed, in which case
+          it is reopened by the next request.
+    """
+    if not self._sock:
+      self._connect()
+    try:
+      send_message(self._sock, request)
+      response = recv_message(self._rfile)
+      if response is None:
+        raise socket.error(errno.ECONNRESET, 'Connection closed by server')
+    except:
+      self._disconnect()
+      raise
+    status, result = response
+    if status != STATUS_OK:
+      raise Fault(result)
+    return result
+
+  def _retry_request(self, build_request):
+    """Make a request, reconnecting once if servod closed an idle connection.
+
+    Args:
+      build_request: function returning the request, called again after
+          reconnecting since control ids are resolved per connection.
+    """
+    with self._lock:
+      reused = self._sock is not None
+      try:
+        return self._request(build_request())
+      except socket.error as e:
+        if not reused or e.errno not in _STALE_ERRNOS:
+          raise
+      return self._request(build_request())
+
+  def _resolve(self, names):
+    """Return the ids of control names, resolving the unknown ones."""
+    unknown = [name for name in set(names) if name not in self._ids]
+    if unknown:
+      ids = self._request([OP_RESOLVE, unknown])
+      self._ids.update(zip(unknown, ids))
+    return [self._ids[name] for name in names]
+
+  def get(self, name):
+    return self._retry_request(lambda: [OP_GET] + self._resolve([name]))
+
+  def set(self, name, value):
+    return self._retry_request(
+        lambda: [OP_SET] + self._resolve([name]) + [value])
+
+  def get_many(self, names):
+    return self._retry_request(
+        lambda: [OP_GET_MANY, self._resolve(names)])
+
+  def call(self, method, *args):
+    return self._retry_request(lambda: [OP_CALL, method, list(args)])
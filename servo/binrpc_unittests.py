@@ -0,0 +1,98 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the encoding and serving of the binary RPC protocol."""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import binrpc
+
+
+class TestEncoding(unittest.TestCase):
+
+  def testRoundTrip(self):
+    for value in [None, True, False, 0, -1, 2**63 - 1, -2**63, 1.5, '',
+                  '\x00\xffbytes', u'caf\xe9', [], [1, [2, 'x']],
+                  {'a': [None, 0.25], 1: u'b'}]:
+      self.assertEqual(value, binrpc.decode(binrpc.encode(value)))
+    self.assertIsInstance(binrpc.decode(binrpc.encode('a')), str)
+    self.assertIsInstance(binrpc.decode(binrpc.encode(u'a')), unicode)
+
+  def testTuplesAreLists(self):
+    self.assertEqual([1, 'a'], binrpc.decode(binrpc.encode((1, 'a'))))
+
+  def testUnencodable(self):
+    self.assertRaises(binrpc.BinaryRPCError, binrpc.encode, 2**63)
+    self.assertRaises(binrpc.BinaryRPCError, binrpc.encode, object())
+
+  def testMalformed(self):
+    data = binrpc.encode(['abc', 1])
+    self.assertRaises(binrpc.BinaryRPCError, binrpc.decode, data[:-1])
+    self.assertRaises(binrpc.BinaryRPCError, binrpc.decode, data + 'N')
+    self.assertRaises(binrpc.BinaryRPCError, binrpc.decode, 'x')
+
+
+class TestConnection(unittest.TestCase):
+
+  def setUp(self):
+    self._tempfolder = tempfile.mkdtemp()
+    path = os.path.join(self._tempfolder, 'sock')
+    self._controls = {'a': '1', 'b': 2.5}
+    self._calls = []
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    self._thread = threading.Thread(target=self._serve, args=(listener,))
+    self._thread.daemon = True
+    self._thread.start()
+    self._conn = binrpc.Connection(path, socket.AF_UNIX, timeout=10)
+
+  def tearDown(self):
+    self._conn.close()
+    self._thread.join()
+    shutil.rmtree(self._tempfolder)
+
+  def _dispatch(self, method, params):
+    self._calls.append((method, params))
+    if method == 'get':
+      return self._controls[params[0]]
+    if method == 'set':
+      self._controls[params[0]] = params[1]
+      return None
+    raise ValueError('No method %s' % method)
+
+  def _serve(self, listener):
+    sock, _ = listener.accept()
+    listener.close()
+    self.assertTrue(binrpc.is_binrpc(sock))
+    rfile = sock.makefile('rb')
+    binrpc.serve_connection(rfile, sock, self._dispatch)
+    rfile.close()
+    sock.close()
+
+  def testGetSet(self):
+    self.assertEqual('1', self._conn.get('a'))
+    self._conn.set('c', [1, None])
+    self.assertEqual([[1, None], 2.5, '1'],
+                     self._conn.get_many(['c', 'b', 'a']))
+    self.assertEqual([('get', ('a',)), ('set', ('c', [1, None])),
+                      ('get', ('c',)), ('get', ('b',)), ('get', ('a',))],
+                     self._calls)
+
+  def testFault(self):
+    self.assertRaises(binrpc.Fault, self._conn.get, 'missing')
+    try:
+      self._conn.call('doc', 'a')
+    except binrpc.Fault as e:
+      self.assertTrue(e.faultString.endswith(':No method doc'))
+    # The connection survives faults.
+    self.assertEqual(2.5, self._conn.get('b'))
+
+
+if __name__ == '__main__':
+  unittest.main()
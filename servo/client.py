@@ -4,11 +4,50 @@
 """Classes and objects for the Servo Client API.
 """
 
+import contextlib
+import errno
+import httplib
 import re
+import socket
+import threading
 import xmlrpclib
 
+import binrpc
+import multiservo
+
 DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 9999
+# Idle connections kept open per ServoClient, i.e. the number of threads
+# which may call servod concurrently without reconnecting.
+DEFAULT_POOL_SIZE = 4
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def _get_unix_socket(host, port):
+  """Return the Unix domain socket of a local servod, None to use TCP.
+
+  Sockets which may not be servod's (see multiservo.is_trusted_socket) or
+  which refuse connections, e.g. left by a servod which crashed, are skipped.
+
+  Args:
+    host: name or IP address of servo server host
+    port: TCP port on which servod is listening on
+  """
+  if host not in LOCAL_HOSTS:
+    return None
+  path = multiservo.get_socket_path(port)
+  if not multiservo.is_trusted_socket(path):
+    return None
+  probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    probe.connect(path)
+  except socket.error as e:
+    if e.errno not in (errno.ECONNREFUSED, errno.ENOENT, errno.EACCES):
+      raise
+    return None
+  finally:
+    probe.close()
+  return path
 
 
 class ServoClientError(Exception):
@@ -50,24 +89,210 @@ class ServoClientError(Exception):
       self.message = text
 
 
+class _KeepAliveConnection(httplib.HTTPConnection):
+  """HTTP connection sending small requests without Nagle delay."""
+
+  def connect(self):
+    httplib.HTTPConnection.connect(self)
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class KeepAliveTransport(xmlrpclib.Transport):
+  """XMLRPC transport reusing one HTTP/1.1 connection for all its requests.
+
+  Only one request may be in flight at a time; see ServerPool for
+  concurrent callers.
+  """
+
+  def make_connection(self, host):
+    if self._connection and host == self._connection[0]:
+      return self._connection[1]
+    chost, self._extra_headers, _ = self.get_host_info(host)
+    self._connection = host, _KeepAliveConnection(chost)
+    return self._connection[1]
+
+
+class _UnixConnection(httplib.HTTPConnection):
+  """HTTP connection over a Unix domain socket."""
+
+  def __init__(self, host, path):
+    httplib.HTTPConnection.__init__(self, host)
+    self._path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self.sock.connect(self._path)
+    except socket.error:
+      self.sock.close()
+      self.sock = None
+      raise
+
+
+class UnixTransport(KeepAliveTransport):
+  """KeepAliveTransport to a servod's Unix domain socket."""
+
+  def __init__(self, path, *args, **kwargs):
+    KeepAliveTransport.__init__(self, *args, **kwargs)
+    self._path = path
+
+  def make_connection(self, host):
+    if self._connection and host == self._connection[0]:
+      return self._connection[1]
+    chost, self._extra_headers, _ = self.get_host_info(host)
+    self._connection = host, _UnixConnection(chost, self._path)
+    return self._connection[1]
+
+
+class ServerPool(object):
+  """Thread-safe pool of xmlrpclib.ServerProxy with persistent connections.
+
+  Calling a method on the pool borrows an idle proxy (or creates one), so
+  each thread has its own connection while sequential calls reuse them.
+  """
+
+  def __init__(self, proxy_factory, pool_size=DEFAULT_POOL_SIZE):
+    """Constructor.
+
+    Args:
+      proxy_factory: function returning a new xmlrpclib.ServerProxy.
+      pool_size: maximum number of idle proxies kept.
+    """
+    self._proxy_factory = proxy_factory
+    self._pool_size = pool_size
+    self._idle = []
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def proxy(self):
+    """Borrows a proxy.  It is discarded if its connection fails."""
+    with self._lock:
+      proxy = self._idle.pop() if self._idle else None
+    if proxy is None:
+      proxy = self._proxy_factory()
+    try:
+      yield proxy
+    except xmlrpclib.Fault:
+      # The server answered, the connection is fine.
+      self._release(proxy)
+      raise
+    except:
+      proxy('close')()
+      raise
+    self._release(proxy)
+
+  def _release(self, proxy):
+    with self._lock:
+      if len(self._idle) < self._pool_size:
+        self._idle.append(proxy)
+        return
+    proxy('close')()
+
+  def __getattr__(self, name):
+    def call(*args):
+      with self.proxy() as proxy:
+        return getattr(proxy, name)(*args)
+    return call
+
+  def close(self):
+    """Closes the idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, []
+    for proxy in idle:
+      proxy('close')()
+
+
 class ServoClient(object):
   """Class to link client to servod via xmlrpc.
 
   Beyond method initialize, the remaining methods (doc_all, doc, get, get_all,
   set) have a corresponding method implmented in servod's server.
+
+  Connections to servod are kept open between calls, and the client may be
+  shared by several threads.  Use multicall() or get_many() to batch several
+  calls in one round trip.  A servod on the local host is reached through its
+  Unix domain socket when it has one.
   """
-  def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+  def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False,
+               pool_size=DEFAULT_POOL_SIZE, unix_socket=True):
     """Constructor for ServoClient Class
 
     Args:
       host: name or IP address of servo server host
       port: TCP port on which servod is listening on
       verbose: enable verbose messaging across xmlrpclib.ServerProxy
+      pool_size: number of idle connections to keep open
+      unix_socket: if True, prefer the Unix domain socket of a local servod
     """
     self._verbose = verbose
     remote = 'http://%s:%s' % (host, port)
-    self._server = xmlrpclib.ServerProxy(remote, verbose=self._verbose,
-                                         allow_none=True)
+    socket_path = unix_socket and _get_unix_socket(host, port)
+    if socket_path:
+      transport_factory = lambda: UnixTransport(socket_path)
+    else:
+      transport_factory = KeepAliveTransport
+    self._server = ServerPool(
+        lambda: xmlrpclib.ServerProxy(remote,
+                                      transport=transport_factory(),
+                                      verbose=self._verbose,
+                                      allow_none=True),
+        pool_size)
+
+  def close(self):
+    """Close the idle connections to servod."""
+    self._server.close()
+
+  def multicall(self, calls):
+    """Make several calls in one round trip.
+
+    Args:
+      calls: list of (method name, tuple of arguments), e.g.
+          [('get', ('ppvar_vbat_mv',)), ('set', ('cold_reset', 'off'))].
+
+    Returns:
+      list of the results of the calls.
+
+    Raises:
+      ServoClientError: If any call fails.  The calls are all made anyway.
+    """
+    with self._server.proxy() as proxy:
+      batch = xmlrpclib.MultiCall(proxy)
+      for method, args in calls:
+        getattr(batch, method)(*args)
+      results = batch()
+    # Faults are raised when their result is accessed.
+    values = []
+    for i, (method, args) in enumerate(calls):
+      try:
+        values.append(results[i])
+      except xmlrpclib.Fault as e:
+        raise ServoClientError("Problem with %s%r" % (method, args), e)
+    return values
+
+  def get_many(self, names):
+    """Get the values of several controls in one round trip.
+
+    Args:
+      names: list of strings, names of controls.
+
+    Returns:
+      list of values, in the order of names.
+
+    Raises:
+      ServoClientError: If error occurs getting a value.
+    """
+    return self.multicall([('get', (name,)) for name in names])
+
+  def set_many(self, names_values):
+    """Set several controls in one round trip, in order.
+
+    Args:
+      names_values: list of (name, value) tuples.
+
+    Raises:
+      ServoClientError: If error occurs setting a value.
+    """
+    self.multicall([('set', (name, value)) for name, value in names_values])
 
   def doc_all(self):
     """Get the doc string for all controls from servo.
@@ -136,6 +361,21 @@ class ServoClient(object):
       raise ServoClientError("Problem with %s" % (controls), e)
     return rv
 
+  def set_get_atomic(self, controls):
+    """Set &| get gpio controls in one transaction of their interface.
+
+    Args:
+      controls: string, controls to set &| get.
+
+    Raises:
+      ServoClientError: If error occurs setting value.
+    """
+    try:
+      rv = self._server.set_get_atomic(controls)
+    except xmlrpclib.Fault as e:
+      raise ServoClientError("Problem with %s" % (controls), e)
+    return rv
+
   def set(self, name, value):
     """Set the value from servo for control name.
 
@@ -154,6 +394,182 @@ class ServoClient(object):
       raise ServoClientError("Problem setting '%s' to '%s'" %
                               (name, value), e)
 
+  def subscribe(self, names, interval_secs=0.1, predicate='change',
+                threshold=None):
+    """Have servod poll controls and queue their changes.
+
+    Args:
+      names: list of strings, names of controls to poll.
+      interval_secs: float, seconds between two polls.
+      predicate: string, 'change', 'above', 'below' or 'equal'.
+      threshold: value compared against for predicates other than 'change'.
+
+    Returns:
+      integer id of the subscription.
+
+    Raises:
+      ServoClientError: If error occurs subscribing.
+    """
+    try:
+      return self._server.subscribe(names, interval_secs, predicate, threshold)
+    except xmlrpclib.Fault as e:
+      raise ServoClientError("Problem subscribing to %s" % names, e)
+
+  def wait_subscription(self, sub_id, timeout_secs=10):
+    """Wait for changes queued for a subscription.
+
+    Args:
+      sub_id: integer id returned by subscribe().
+      timeout_secs: float, maximum seconds to wait.
+
+    Returns:
+      list of [name, value, timestamp] changes, empty on timeout.
+
+    Raises:
+      ServoClientError: If error occurs waiting.
+    """
+    try:
+      return self._server.wait_subscription(sub_id, timeout_secs)
+    except xmlrpclib.Fault as e:
+      raise ServoClientError("Problem waiting subscription %d" % sub_id, e)
+
+  def unsubscribe(self, sub_id):
+    """Stop a subscription.
+
+    Args:
+      sub_id: integer id returned by subscribe().
+
+    Raises:
+      ServoClientError: If error occurs unsubscribing.
+    """
+    try:
+      self._server.unsubscribe(sub_id)
+    except xmlrpclib.Fault as e:
+      raise ServoClientError("Problem unsubscribing %d" % sub_id, e)
+
+  def wait_for(self, name, predicate, threshold, timeout_secs,
+               interval_secs=0.1):
+    """Wait until a control satisfies a predicate, polling on servod side.
+
+    Args:
+      name: string, name of control.
+      predicate: string, 'above', 'below' or 'equal'.
+      threshold: value compared against.
+      timeout_secs: float, maximum seconds to wait.
+      interval_secs: float, seconds between two polls on servod.
+
+    Returns:
+      value of the control satisfying the predicate, or None on timeout.
+
+    Raises:
+      ServoClientError: If error occurs subscribing.
+    """
+    sub_id = self.subscribe([name], interval_secs, predicate, threshold)
+    try:
+      events = self.wait_subscription(sub_id, timeout_secs)
+    finally:
+      self.unsubscribe(sub_id)
+    if events:
+      return events[0][1]
+    return None
+
   def hwinit(self):
     """Initialize the controls."""
     self._server.hwinit()
+
+
+class BinaryServoClient(object):
+  """Client of servod speaking the compact binary protocol (see binrpc).
+
+  Gets and sets cost a fraction of the CPU of their XMLRPC counterparts on
+  both sides, which matters to high-rate clients like power loggers.  Other
+  servod methods are reached through call().  Calls are made on one
+  persistent connection and serialized.
+  """
+  def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_socket=True,
+               timeout=None):
+    """Constructor for BinaryServoClient Class
+
+    Args:
+      host: name or IP address of servo server host
+      port: TCP port on which servod is listening on
+      unix_socket: if True, prefer the Unix domain socket of a local servod
+      timeout: seconds to wait for a response, None to wait forever
+    """
+    socket_path = unix_socket and _get_unix_socket(host, port)
+    if socket_path:
+      self._conn = binrpc.Connection(socket_path, socket.AF_UNIX, timeout)
+    else:
+      self._conn = binrpc.Connection((host, port), timeout=timeout)
+
+  def close(self):
+    """Close the connection to servod."""
+    self._conn.close()
+
+  def call(self, method, *args):
+    """Call a servod method.
+
+    Args:
+      method: string, name of the method, e.g. 'doc'.
+      args: arguments of the method.
+
+    Returns:
+      the result of the method.
+
+    Raises:
+      ServoClientError: If the call fails.
+    """
+    try:
+      return self._conn.call(method, *args)
+    except binrpc.Fault as e:
+      raise ServoClientError("Problem with %s%r" % (method, args), e)
+
+  def get(self, name):
+    """Get the value from servo for control name.
+
+    Args:
+      name: string, name of control to get value for.
+
+    Returns:
+     value currently set on control name
+
+    Raises:
+      ServoClientError: If error occurs getting value.
+    """
+    try:
+      return self._conn.get(name)
+    except binrpc.Fault as e:
+      raise ServoClientError("Problem getting '%s'" % name, e)
+
+  def get_many(self, names):
+    """Get the values of several controls in one round trip.
+
+    Args:
+      names: list of strings, names of controls.
+
+    Returns:
+      list of values, in the order of names.
+
+    Raises:
+      ServoClientError: If error occurs getting a value.
+    """
+    try:
+      return self._conn.get_many(names)
+    except binrpc.Fault as e:
+      raise ServoClientError("Problem getting %s" % ', '.join(names), e)
+
+  def set(self, name, value):
+    """Set the value from servo for control name.
+
+    Args:
+      name: string, name of control to set.
+      value: string, value to set control to.
+
+    Raises:
+      ServoClientError: If error occurs setting value.
+    """
+    try:
+      self._conn.set(name, value)
+    except binrpc.Fault as e:
+      raise ServoClientError("Problem setting '%s' to '%s'" %
+                              (name, value), e)
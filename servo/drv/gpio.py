@@ -58,12 +58,7 @@ class gpio(hw_driver.HwDriver):
       gpioError: if no offset in param dict
     """
     self._logger.debug("")
-    (offset, width) = self._get_common_params()
-
-    is_output = 1
-    if self._io_type == 'PU':
-      if value == 1:
-        is_output = 0
+    (offset, width, is_output, value) = self.field(value)
 
     if hasattr(self._interface, 'gpio_wr_rd'):
       self._interface.gpio_wr_rd(offset, width, is_output, value)
@@ -71,6 +66,38 @@ class gpio(hw_driver.HwDriver):
       self._interface.wr_rd(offset, width, is_output, value, chip=self._chip,
                             muxfile=self._muxfile)
 
+  def get_fields_func(self):
+    """Return the function of the interface accessing several gpios at once.
+
+    See ftdigpio.Fgpio.wr_rd_fields.
+
+    Returns:
+      function taking a list of fields as returned by field() and returning
+      the values read like get does, or None if the interface can only access
+      one gpio at a time.
+    """
+    if hasattr(self._interface, 'gpio_wr_rd'):
+      return getattr(self._interface, 'gpio_wr_rd_fields', None)
+    return getattr(self._interface, 'wr_rd_fields', None)
+
+  def field(self, value=None):
+    """Return the (offset, width, dir_val, wr_val) field of this control.
+
+    Args:
+      value: integer value to write to gpio, None to only read it
+
+    Raises:
+      gpioError: if no offset in param dict
+    """
+    (offset, width) = self._get_common_params()
+    if value is None:
+      return (offset, width, None, None)
+    is_output = 1
+    if self._io_type == 'PU':
+      if value == 1:
+        is_output = 0
+    return (offset, width, is_output, value)
+
   def _get_common_params(self):
     """Get common parameters for gpio control
 
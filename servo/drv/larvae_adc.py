@@ -5,12 +5,22 @@
 """ADC driver.
 
 It returns Larvae's ADC sensors' value (AIN0 to AIN6).
+
+Without subtype, a control returns one reading.  Subtypes sample the inputs
+'samples' times at 'rate' Hz:
+  avg: the average of the readings of each input.
+  window: the readings, oldest first.
 """
 
 # servo libs
 import hw_driver
 
 
+# Default sampling of the avg and window subtypes.
+DEFAULT_SAMPLES = 16
+DEFAULT_RATE = 1000
+
+
 class larvaeAdc(hw_driver.HwDriver):
   """Reads ADC inputs."""
 
@@ -24,5 +34,21 @@ class larvaeAdc(hw_driver.HwDriver):
     Returns:
       ADC values from AIN0 to AIN6.
     """
+    if 'subtype' in self._params:
+      return super(larvaeAdc, self).get()
     buffer = self._interface.read()
     return buffer[0:7]
+
+  def _sample(self):
+    """Returns the numpy array of the readings of AIN0 to AIN6."""
+    samples = int(self._params.get('samples', DEFAULT_SAMPLES))
+    rate = float(self._params.get('rate', DEFAULT_RATE))
+    return self._interface.sample(samples, rate)[:, 0:7]
+
+  def _Get_avg(self):
+    """Returns the average of the readings of each input, AIN0 to AIN6."""
+    return self._sample().mean(axis=0).tolist()
+
+  def _Get_window(self):
+    """Returns the list of the readings of AIN0 to AIN6, oldest first."""
+    return self._sample().tolist()
@@ -90,6 +90,9 @@ def _parse_args():
 
   parser.add_option("-d", "--debug", help="enable debug messages",
                     action="store_true", default=False)
+  parser.add_option("--tcp", help="connect over TCP even if servod listens "
+                    "on a local Unix domain socket", action="store_true",
+                    default=False)
 
   multiservo.add_multiservo_parser_options(parser)
   parser.set_usage(parser.get_usage() + examples)
@@ -340,7 +343,8 @@ def real_main():
     sys.exit(-1)
 
   sclient = client.ServoClient(host=options.server, port=options.port,
-                               verbose=options.verbose)
+                               verbose=options.verbose,
+                               unix_socket=not options.tcp)
   global _start_time
   _start_time = time.time()
 
@@ -93,11 +93,19 @@ class EC3PO(uart.Uart):
     console_process.daemon = True
     # Start the console.
     console_process.start()
+    self._console_process = console_process
     self._logger.info('%s', os.ttyname(user_pty))
     self._logger.debug('Console: %s', self._console)
     self._pty = os.ttyname(user_pty)
     self._cmd_pipe_int = cmd_pipe_interactive
 
+  def close(self):
+    """Stops the interpreter and console processes."""
+    self._logger.debug('close')
+    for process in (self.itpr_process, self._console_process):
+      process.terminate()
+      process.join()
+
   def get_pty(self):
     """Gets the path of the served PTY."""
     self._logger.debug('get_pty')
@@ -4,11 +4,17 @@
 """Defines common structures for use with c libraries related to FTDI devices.
 """
 import ctypes
+import time
+
 import servo_interfaces
 
 
 MAX_FTDI_INTERFACES_PER_DEVICE = 4
 
+# Seconds the pins driven by an interface are trusted to read back as driven
+# before being read from the hardware again.
+SHADOW_SECS = 1.0
+
 (DEFAULT_VID, DEFAULT_PID) = servo_interfaces.SERVO_ID_DEFAULTS[0]
 
 (INTERFACE_TYPE_ANY, INTERFACE_TYPE_GPIO, INTERFACE_TYPE_I2C,
@@ -110,3 +116,107 @@ class Gpio(ctypes.Structure):
   _fields_ = [("value", ctypes.c_ubyte),
               ("direction", ctypes.c_ubyte),
               ("mask", ctypes.c_ubyte)]
+
+
+def merge_gpio_fields(gpio, fields):
+  """Merge the writes of several GPIO fields into one Gpio structure.
+
+  Args:
+    gpio: Gpio structure to fill.
+    fields: list of (offset, width, dir_val, wr_val) tuples, as the arguments
+        of the wr_rd methods of the GPIO interfaces.  Fields whose dir_val or
+        wr_val is None are only read.  Later fields override earlier ones.
+
+  Returns:
+    True if a field is written, in which case gpio holds the combined mask,
+    direction and value, False otherwise.
+  """
+  mask = direction = value = 0
+  for offset, width, dir_val, wr_val in fields:
+    if dir_val is None or wr_val is None:
+      continue
+    field_mask = ((1 << width) - 1) << offset
+    mask |= field_mask
+    direction &= ~field_mask
+    if dir_val:
+      direction |= field_mask
+    value = (value & ~field_mask) | ((wr_val << offset) & field_mask)
+  gpio.mask = mask
+  gpio.direction = direction
+  gpio.value = value
+  return mask != 0
+
+
+class GpioShadow(object):
+  """Shadow of the pins of a GPIO port, to skip redundant pin reads.
+
+  The C libraries keep the direction and value driven on the port in the Gpio
+  structure of their context.  Pins driven as outputs read back as driven, so
+  reads of output pins are answered from that state and only reads of input
+  pins go to the hardware, or reads of output pins once the last hardware read
+  is older than max_age.
+
+  Between begin_snapshot and end_snapshot, the port is read at most once and
+  that read is reused for all the pins, e.g. for all the controls of a
+  request.
+
+  Instance Variables:
+    max_age: seconds output pins are trusted without reading them.
+    _state: Gpio structure of the C context, with the driven direction & value.
+    _pins: integer value of the port at the last hardware read, None if the
+        port has to be read.
+    _time: time of the last hardware read.
+    _snapshots: number of snapshots in progress.
+  """
+
+  def __init__(self, state, max_age=SHADOW_SECS):
+    self.max_age = max_age
+    self._state = state
+    self._pins = None
+    self._time = 0
+    self._snapshots = 0
+
+  def need_read(self, mask, new_gpio=None):
+    """Return True if reading the pins of mask requires a hardware read.
+
+    Args:
+      mask: integer mask of the pins read.
+      new_gpio: Gpio structure written along with the read, None if none.
+    """
+    if self._pins is None:
+      return True
+    direction = self._state.direction
+    if new_gpio is not None:
+      # Pins released as inputs read as pulled, not as they were driven.
+      if new_gpio.mask & ~new_gpio.direction & direction:
+        return True
+      direction = ((new_gpio.direction & new_gpio.mask) |
+                   (direction & ~new_gpio.mask))
+    if self._snapshots:
+      return False
+    if mask & ~direction:
+      return True
+    return time.time() - self._time > self.max_age
+
+  def update(self, pins):
+    """Record the value of the port read from the hardware."""
+    self._pins = pins
+    self._time = time.time()
+
+  def invalidate(self):
+    """Forget the port value, e.g. after a failed access."""
+    self._pins = None
+
+  def pins(self):
+    """Return the value of the port from the last read and the driven pins."""
+    direction = self._state.direction
+    return ((self._pins & ~direction) | (self._state.value & direction)) & 0xff
+
+  def begin_snapshot(self):
+    """Read the port at most once until end_snapshot."""
+    if not self._snapshots:
+      self._pins = None
+    self._snapshots += 1
+
+  def end_snapshot(self):
+    self._snapshots -= 1
@@ -0,0 +1,103 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the shadow of the pins of ftdi GPIO ports."""
+import time
+import unittest
+
+import ftdi_common
+
+
+class FakeClock(object):
+  """Stands for the time module, with a time set by the test."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):
+    return self.now
+
+
+def make_gpio(direction, value, mask=0xff):
+  gpio = ftdi_common.Gpio()
+  gpio.direction = direction
+  gpio.value = value
+  gpio.mask = mask
+  return gpio
+
+
+class TestGpioShadow(unittest.TestCase):
+
+  def setUp(self):
+    self._clock = FakeClock()
+    ftdi_common.time = self._clock
+    # Pins 0-3 driven as outputs to 0x5, pins 4-7 inputs.
+    self._state = make_gpio(0x0f, 0x05)
+    self._shadow = ftdi_common.GpioShadow(self._state)
+
+  def tearDown(self):
+    ftdi_common.time = time
+
+  def test_first_read(self):
+    self.assertTrue(self._shadow.need_read(0x01))
+    self._shadow.update(0xa0)
+    self.assertFalse(self._shadow.need_read(0x01))
+    self._shadow.invalidate()
+    self.assertTrue(self._shadow.need_read(0x01))
+
+  def test_outputs_from_state(self):
+    self._shadow.update(0xaa)
+    self.assertFalse(self._shadow.need_read(0x0f))
+    self.assertTrue(self._shadow.need_read(0x10))
+    # Driven pins read as driven, whatever the hardware read.
+    self.assertEqual(self._shadow.pins(), 0xa5)
+
+  def test_max_age(self):
+    self._shadow.update(0xa0)
+    self._clock.now += self._shadow.max_age - 0.1
+    self.assertFalse(self._shadow.need_read(0x0f))
+    self._clock.now += 0.2
+    self.assertTrue(self._shadow.need_read(0x0f))
+
+  def test_new_outputs(self):
+    self._shadow.update(0xa0)
+    # Pin 4 driven along with the read.
+    self.assertFalse(self._shadow.need_read(0x10, make_gpio(0x10, 0x10,
+                                                            0x10)))
+
+  def test_released_as_input(self):
+    self._shadow.update(0xa0)
+    # Pin 0 released reads as pulled, even for a read of other pins.
+    self.assertTrue(self._shadow.need_read(0x02, make_gpio(0x00, 0x00, 0x01)))
+
+  def test_snapshot(self):
+    self._shadow.update(0xa0)
+    self._shadow.begin_snapshot()
+    self.assertTrue(self._shadow.need_read(0x01))
+    self._shadow.update(0xa0)
+    # Input pins and old reads are taken from the snapshot.
+    self._clock.now += 2 * self._shadow.max_age
+    self.assertFalse(self._shadow.need_read(0x10))
+    self.assertFalse(self._shadow.need_read(0x10, make_gpio(0x01, 0x01,
+                                                            0x01)))
+    # But not pins released as inputs since.
+    self.assertTrue(self._shadow.need_read(0x02, make_gpio(0x00, 0x00, 0x01)))
+    # Nested snapshots keep the read.
+    self._shadow.begin_snapshot()
+    self.assertFalse(self._shadow.need_read(0x10))
+    self._shadow.end_snapshot()
+    self._shadow.end_snapshot()
+    self.assertTrue(self._shadow.need_read(0x10))
+
+  def test_cbus_nibble(self):
+    # Only the low nibble is wired, and read, on CBUS interfaces.
+    self._state = make_gpio(0x03, 0x01, 0x0f)
+    self._shadow = ftdi_common.GpioShadow(self._state)
+    self._shadow.update(0x0c)
+    self.assertEqual(self._shadow.pins(), 0x0d)
+    self.assertFalse(self._shadow.need_read(0x03))
+    self.assertTrue(self._shadow.need_read(0x04))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -44,6 +44,7 @@ class Fgpio(gpio_interface.GpioInterface):
     _gpio: _gpio: Instance of ftdi_common.GPIO()
     _fc: FTDI Context object.
     _fgc: FgpioContext object.
+    _shadow: ftdi_common.GpioShadow of the pins of the interface.
   """
 
   def __init__(self, vendor=ftdi_common.DEFAULT_VID,
@@ -75,6 +76,7 @@ class Fgpio(gpio_interface.GpioInterface):
     self._gpio = ftdi_common.Gpio()
     self._fc = ftdi_common.FtdiContext()
     self._fgc = FgpioContext()
+    self._shadow = ftdi_common.GpioShadow(self._fgc.gpio)
     # initialize
     if self._flib.ftdi_init(ctypes.byref(self._fc)):
       raise FgpioError("doing ftdi_init")
@@ -129,20 +131,77 @@ class Fgpio(gpio_interface.GpioInterface):
     Returns:
       integer value from reading the gpio value ( masked & aligned )
     """
-    rd_val = ctypes.c_ubyte()
-    self._gpio.mask = (pow(2, width) - 1) << offset
-    if wr_val is not None and dir_val is not None:
+    mask = (pow(2, width) - 1) << offset
+    self._gpio.mask = mask
+    written = wr_val is not None and dir_val is not None
+    if written:
       self._gpio.direction = self._gpio.mask if dir_val else 0
       self._gpio.value = wr_val << offset
-      self._lib.fgpio_wr_rd(ctypes.byref(self._fgc), ctypes.byref(self._gpio),
-                            ctypes.byref(rd_val),
-                            ftdi_common.INTERFACE_TYPE_GPIO)
-    else:
-      self._lib.fgpio_wr_rd(ctypes.byref(self._fgc), 0, ctypes.byref(rd_val),
-                            ftdi_common.INTERFACE_TYPE_GPIO)
-    self._logger.debug("dir:%s val:%s returned %d" %
-                       (str(dir_val), str(wr_val), rd_val.value))
-    return (rd_val.value & self._gpio.mask) >> offset
+    rd_val = self._wr_rd(written, mask)
+    self._logger.debug("dir:%s val:%s returned %d", dir_val, wr_val, rd_val)
+    return (rd_val & mask) >> offset
+
+  def wr_rd_fields(self, fields):
+    """Write and/or read several GPIO fields in one transaction.
+
+    The fields written are applied with a single write of the port, so they
+    change together, then the pins are read once for all the fields.
+
+    Args:
+      fields: list of (offset, width, dir_val, wr_val) tuples, see wr_rd.
+          Fields whose dir_val or wr_val is None are only read.
+
+    Returns:
+      list of integer values read from the fields ( masked & aligned )
+    """
+    mask = 0
+    for offset, width, _, _ in fields:
+      mask |= ((1 << width) - 1) << offset
+    written = ftdi_common.merge_gpio_fields(self._gpio, fields)
+    rd_val = self._wr_rd(written, mask)
+    self._logger.debug("fields:%s returned %d", fields, rd_val)
+    return [(rd_val >> offset) & ((1 << width) - 1)
+            for offset, width, _, _ in fields]
+
+  def _wr_rd(self, written, mask):
+    """Write self._gpio if written and return the value of the port.
+
+    The pins are only read from the hardware when the shadow of the port
+    can't tell their value, see ftdi_common.GpioShadow.
+
+    Args:
+      written: boolean, whether self._gpio holds a write.
+      mask: integer mask of the pins whose value is returned.
+
+    Returns:
+      integer value of the port, exact for the pins of mask.
+
+    Raises:
+      FgpioError: If the write or read fails
+    """
+    new_gpio = self._gpio if written else None
+    read = self._shadow.need_read(mask, new_gpio)
+    if not written and not read:
+      return self._shadow.pins()
+    rd_val = ctypes.c_ubyte()
+    err = self._lib.fgpio_wr_rd(ctypes.byref(self._fgc),
+                                ctypes.byref(self._gpio) if written else None,
+                                ctypes.byref(rd_val) if read else None,
+                                ftdi_common.INTERFACE_TYPE_GPIO)
+    if err:
+      self._shadow.invalidate()
+      raise FgpioError("doing fgpio_wr_rd", err)
+    if not read:
+      return self._shadow.pins()
+    self._shadow.update(rd_val.value)
+    return rd_val.value
+
+  def begin_snapshot(self):
+    """Read the pins at most once until end_snapshot, see GpioShadow."""
+    self._shadow.begin_snapshot()
+
+  def end_snapshot(self):
+    self._shadow.end_snapshot()
 
 
 def test():
@@ -39,6 +39,18 @@ class Fi2cContext(ctypes.Structure):
               ("bufsize", ctypes.c_int)]
 
 
+class Fi2cXfer(ctypes.Structure):
+  """Defines one transaction of fi2c_wr_rd_batch.
+
+  Declared in ftdii2c.h and named fi2c_xfer.
+  """
+  _fields_ = [("slv", ctypes.c_ubyte),
+              ("wbuf", ctypes.POINTER(ctypes.c_ubyte)),
+              ("wcnt", ctypes.c_int),
+              ("rbuf", ctypes.POINTER(ctypes.c_ubyte)),
+              ("rcnt", ctypes.c_int)]
+
+
 class Fi2c(object):
   """Provide interface to libftdii2c c-library via python ctypes module.
   """
@@ -82,6 +94,10 @@ class Fi2c(object):
       raise Fi2cError("fi2c_init", err)
 
     self._i2c_mask = ~self._fic.gpio.mask
+    # Preallocated write and read buffers of wr_rd, by size.
+    self._wbufs = {}
+    self._rbufs = {}
+    self._shadow = ftdi_common.GpioShadow(self._fic.gpio)
 
   def __del__(self):
     """Fi2c destructor.
@@ -123,40 +139,144 @@ class Fi2c(object):
     if self._lib.fi2c_setclock(ctypes.byref(self._fic), speed):
       raise Fi2cError("fi2c_setclock")
 
+  def _get_buf(self, pool, size):
+    """Return the preallocated buffer of size bytes of pool.
+
+    wr_rd is called at high rates with the same few sizes, creating ctypes
+    arrays for every call costs as much as the USB transfers.
+    """
+    buf = pool.get(size)
+    if buf is None:
+      buf = pool[size] = (ctypes.c_ubyte * size)()
+    return buf
+
+  def _load_wbuf(self, wdata):
+    """Return a ctypes array holding the bytes of wdata.
+
+    Args:
+      wdata: bytes to write as a list of integers, str, bytearray or
+          memoryview.  A bytearray is used in place, other types are copied
+          in a preallocated buffer.
+    """
+    wcnt = len(wdata)
+    if isinstance(wdata, bytearray):
+      return (ctypes.c_ubyte * wcnt).from_buffer(wdata)
+    wbuf = self._get_buf(self._wbufs, wcnt)
+    if isinstance(wdata, memoryview):
+      wdata = wdata.tobytes()
+    if isinstance(wdata, str):
+      ctypes.memmove(wbuf, wdata, wcnt)
+    else:
+      wbuf[:] = wdata
+    return wbuf
+
+  def _wr_rd(self, slv, wdata, rbuf, rcnt):
+    """Write and/or read a slave i2c device from/to ctypes buffers.
+
+    Args:
+      slv: 7-bit address of the slave device
+      wdata: bytes to write, see _load_wbuf
+      rbuf: ctypes array of at least rcnt bytes receiving the bytes read
+      rcnt: number of bytes to read from the device
+
+    Raises:
+      Fi2cError: if the transfer fails
+    """
+    self._fic.slv = slv
+    wbuf = self._load_wbuf(wdata)
+    debug = self._logger.isEnabledFor(logging.DEBUG)
+    if debug:
+      for i, wval in enumerate(wbuf):
+        self._logger.debug("wbuf[%i] = 0x%02x", i, wval)
+
+    err = self._lib.fi2c_wr_rd(ctypes.byref(self._fic), wbuf, len(wbuf),
+                               rbuf, rcnt)
+    if err:
+      err_str = "slave:0x%02x wr:%s rcnt:%d err:%s" % (slv, list(wbuf), rcnt,
+                                                        err)
+      raise Fi2cError("fi2c_wr_rd", err_str)
+
+    if debug:
+      for i in xrange(rcnt):
+        self._logger.debug("rbuf[%i] = 0x%02x", i, rbuf[i])
+
   def wr_rd(self, slv, wlist, rcnt):
     """Write and/or read a slave i2c device.
 
     Args:
       slv: 7-bit address of the slave device
-      wlist: list of bytes to write to the slave.  If list length is zero its
-          just a read
+      wlist: bytes to write to the slave, as a list of integers, str,
+          bytearray or memoryview.  If its length is zero its just a read
       rcnt: number of bytes to read from the device.  If zero, its just a write
 
     Returns:
-      list of c_ubyte's read from i2c device.
+      list of integers read from i2c device.
     """
-    self._logger.debug("")
-    self._fic.slv = slv
-    wcnt = len(wlist)
-    wbuf_type = ctypes.c_ubyte * wcnt
-    wbuf = wbuf_type()
-    for i in xrange(wcnt):
-      wbuf[i] = wlist[i]
-
-    rbuf_type = ctypes.c_ubyte * rcnt
-    rbuf = rbuf_type()
-    for i, wval in enumerate(wbuf):
-      self._logger.debug("wbuf[%i] = 0x%02x" % (i, wval))
-
-    err = self._lib.fi2c_wr_rd(ctypes.byref(self._fic), ctypes.byref(wbuf),
-                               wcnt, ctypes.byref(rbuf), rcnt)
-    if err:
-      err_str = "slave:0x%02x wr:%s rcnt:%d err:%s" % (slv, wlist, rcnt, err)
-      raise Fi2cError("fi2c_wr_rd", err_str)
+    rbuf = self._get_buf(self._rbufs, rcnt)
+    self._wr_rd(slv, wlist, rbuf, rcnt)
+    return rbuf[:]
 
-    for i, rval in enumerate(rbuf):
-      self._logger.debug("rbuf[%i] = 0x%02x" % (i, rval))
-    return list(rbuf)
+  def wr_rd_into(self, slv, wdata, rbuf):
+    """Write and/or read a slave i2c device, reading into a buffer.
+
+    Args:
+      slv: 7-bit address of the slave device
+      wdata: bytes to write, see wr_rd
+      rbuf: bytearray or writable memoryview receiving len(rbuf) bytes read
+          from the device.  A bytearray is filled in place.
+    """
+    rcnt = len(rbuf)
+    if isinstance(rbuf, bytearray):
+      self._wr_rd(slv, wdata, (ctypes.c_ubyte * rcnt).from_buffer(rbuf), rcnt)
+    else:
+      buf = self._get_buf(self._rbufs, rcnt)
+      self._wr_rd(slv, wdata, buf, rcnt)
+      rbuf[:] = ctypes.string_at(buf, rcnt)
+
+  def wr_rd_batch(self, transactions):
+    """Write and/or read slave i2c devices in as few USB round trips as possible.
+
+    The transactions are queued together and their ACKs checked at once.  The
+    ones ACKed are done.  A transaction NACKed, or whose ACKs didn't all come
+    back because the USB read failed, is retried byte by byte like wr_rd
+    does, once the whole batch ran.  It thus may run twice, after the later
+    transactions of the batch: the bytes it wrote before the NACK are
+    written twice.  Transactions ACKed are never made again.
+
+    Args:
+      transactions: list of (slv, wlist, rcnt) tuples, see wr_rd.
+
+    Returns:
+      list of the lists of bytes read by each transaction.
+
+    Raises:
+      Fi2cError: if a transaction fails
+    """
+    if self._logger.isEnabledFor(logging.DEBUG):
+      self._logger.debug("%d transactions", len(transactions))
+    xfers = (Fi2cXfer * len(transactions))()
+    rbufs = []
+    for xfer, (slv, wlist, rcnt) in zip(xfers, transactions):
+      if isinstance(wlist, memoryview):
+        wlist = wlist.tobytes()
+      if isinstance(wlist, (str, bytearray)):
+        wbuf = (ctypes.c_ubyte * len(wlist)).from_buffer_copy(wlist)
+      else:
+        wbuf = (ctypes.c_ubyte * len(wlist))(*wlist)
+      rbuf = (ctypes.c_ubyte * rcnt)()
+      rbufs.append(rbuf)
+      xfer.slv = slv
+      xfer.wbuf = wbuf
+      xfer.wcnt = len(wlist)
+      xfer.rbuf = rbuf
+      xfer.rcnt = rcnt
+
+    err = self._lib.fi2c_wr_rd_batch(ctypes.byref(self._fic), xfers,
+                                     len(transactions))
+    if err:
+      raise Fi2cError("fi2c_wr_rd_batch", "transactions:%s err:%s" %
+                      (transactions, err))
+    return [list(rbuf) for rbuf in rbufs]
 
   def gpio_wr_rd(self, offset, width, dir_val=None, wr_val=None):
     """Write and/or read GPIO controls
@@ -184,25 +304,83 @@ class Fi2c(object):
     Raises:
       Fi2cError: if gpio's mask would interfere with i2c's bits
     """
-    rd_val = ctypes.c_ubyte()
-    self._gpio.mask = (pow(2, width) - 1) << offset
+    mask = (pow(2, width) - 1) << offset
+    self._gpio.mask = mask
     if self._gpio.mask & self._i2c_mask:
       raise Fi2cError("gpio mask violates i2c mask")
-    if wr_val is not None and dir_val is not None:
+    written = wr_val is not None and dir_val is not None
+    if written:
       self._gpio.direction = self._gpio.mask
       self._gpio.value = wr_val << offset
-      self._gpiolib.fgpio_wr_rd(ctypes.byref(self._fic),
-                                ctypes.byref(self._gpio),
-                                ctypes.byref(rd_val),
-                                ftdi_common.INTERFACE_TYPE_I2C)
-    else:
-      self._gpiolib.fgpio_wr_rd(ctypes.byref(self._fic), 0,
-                                ctypes.byref(rd_val),
-                                ftdi_common.INTERFACE_TYPE_I2C)
-    self._logger.debug("mask:0x%x val:%s returned %d" %
-                       (self._gpio.mask, str(wr_val), rd_val.value))
-    return (rd_val.value & self._gpio.mask) >> offset
+    rd_val = self._gpio_wr_rd(written, mask)
+    self._logger.debug("mask:0x%x val:%s returned %d", mask, wr_val, rd_val)
+    return (rd_val & mask) >> offset
+
+  def gpio_wr_rd_fields(self, fields):
+    """Write and/or read several spare GPIO fields in one transaction.
+
+    See gpio_wr_rd and ftdigpio.Fgpio.wr_rd_fields.
+
+    Args:
+      fields: list of (offset, width, dir_val, wr_val) tuples, see
+          gpio_wr_rd.  Fields whose dir_val or wr_val is None are only read.
+
+    Returns:
+      list of integer values read from the fields ( masked & aligned )
+
+    Raises:
+      Fi2cError: if a gpio's mask would interfere with i2c's bits
+    """
+    for offset, width, _, _ in fields:
+      if (((1 << width) - 1) << offset) & self._i2c_mask:
+        raise Fi2cError("gpio mask violates i2c mask")
+    # Like gpio_wr_rd, written fields are always driven.
+    wr_fields = [(offset, width, 1 if dir_val is not None else None, wr_val)
+                 for offset, width, dir_val, wr_val in fields]
+    mask = 0
+    for offset, width, _, _ in fields:
+      mask |= ((1 << width) - 1) << offset
+    written = ftdi_common.merge_gpio_fields(self._gpio, wr_fields)
+    rd_val = self._gpio_wr_rd(written, mask)
+    self._logger.debug("fields:%s returned %d", fields, rd_val)
+    return [(rd_val >> offset) & ((1 << width) - 1)
+            for offset, width, _, _ in fields]
+
+  def _gpio_wr_rd(self, written, mask):
+    """Write self._gpio if written and return the value of the port.
+
+    See ftdigpio.Fgpio._wr_rd.
+
+    Raises:
+      Fi2cError: If the write or read fails
+    """
+    new_gpio = self._gpio if written else None
+    read = self._shadow.need_read(mask, new_gpio)
+    if not written and not read:
+      return self._shadow.pins()
+    rd_val = ctypes.c_ubyte()
+    err = self._gpiolib.fgpio_wr_rd(ctypes.byref(self._fic),
+                                    ctypes.byref(self._gpio) if written
+                                    else None,
+                                    ctypes.byref(rd_val) if read else None,
+                                    ftdi_common.INTERFACE_TYPE_I2C)
+    if err:
+      self._shadow.invalidate()
+      raise Fi2cError("fgpio_wr_rd", err)
+    if not read:
+      return self._shadow.pins()
+    self._shadow.update(rd_val.value)
+    return rd_val.value
+
+  def begin_snapshot(self):
+    """Read the spare gpios at most once until end_snapshot.
+
+    See ftdi_common.GpioShadow.
+    """
+    self._shadow.begin_snapshot()
 
+  def end_snapshot(self):
+    self._shadow.end_snapshot()
 
 def test():
   """Test code.
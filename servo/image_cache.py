@@ -0,0 +1,270 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Host-wide cache of downloaded recovery images.
+
+Several servods of a lab host often flash the same build to their DUTs. The
+cache makes them share one download: images are stored under a key derived
+from their URL and HTTP validators (ETag, or Last-Modified and size), and the
+entries are protected by file locks so that concurrent servod processes wait
+for an ongoing download instead of starting their own.
+
+The first consumer reads the image while it is being downloaded (the data is
+teed into the cache), so caching adds no latency to a single transfer. The
+entry is shared with other servods as soon as the download completes, not when
+the consumer is done with it. Least recently used entries are evicted once the
+cache exceeds its size limit.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import urllib2
+
+
+DEFAULT_CACHE_DIR = '/var/lib/servod/image_cache'
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024 * 1024
+
+_IMAGE_SUFFIX = '.img'
+_LOCK_SUFFIX = '.lock'
+_TMP_SUFFIX = '.tmp'
+# Bytes read at once when downloading the rest of an image the consumer
+# stopped reading early.
+_DRAIN_SIZE = 1024 * 1024
+
+
+class ImageCacheError(Exception):
+  """Exception class for ImageCache."""
+
+
+class _HeadRequest(urllib2.Request):
+  """HTTP HEAD request."""
+
+  def get_method(self):
+    return 'HEAD'
+
+
+class _TeeReader(object):
+  """File-like object copying what is read from src into a cache file.
+
+  Reads must not overlap: the data would be copied out of order. An
+  overlapping read raises IOError, which keeps the image out of the cache.
+
+  Attributes:
+    complete: True once src was read to its end.
+    size: number of bytes read so far.
+  """
+
+  def __init__(self, src, cache_file, on_complete):
+    """Constructor.
+
+    Args:
+      src: file-like object to read.
+      cache_file: file to copy the data read into.
+      on_complete: function called once src was read to its end.
+    """
+    self._src = src
+    self._cache_file = cache_file
+    self._on_complete = on_complete
+    self._read_lock = threading.Lock()
+    self.complete = False
+    self.size = 0
+
+  def read(self, size):
+    if not self._read_lock.acquire(False):
+      raise IOError('Overlapping reads of the image stream')
+    try:
+      data = self._src.read(size)
+      if data:
+        self._cache_file.write(data)
+        self.size += len(data)
+      elif not self.complete:
+        self.complete = True
+        self._on_complete()
+      return data
+    finally:
+      self._read_lock.release()
+
+  def close(self):
+    self._src.close()
+
+
+class ImageCache(object):
+  """Cache of images downloaded over HTTP, shared by all servods of a host."""
+
+  def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Constructor.
+
+    Args:
+      cache_dir: directory holding the cached images.
+      max_bytes: size above which least recently used images are evicted.
+
+    Raises:
+      ImageCacheError: if cache_dir can't be created.
+    """
+    self._logger = logging.getLogger('ImageCache')
+    self._cache_dir = cache_dir
+    self._max_bytes = max_bytes
+    try:
+      os.makedirs(cache_dir)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise ImageCacheError('Failed to create %s: %s' % (cache_dir, e))
+
+  def _get_key(self, url):
+    """Derives the cache key of url from its HTTP validators.
+
+    Returns:
+      the key, or None if the server provides neither ETag nor Last-Modified
+      (or the HEAD request fails), as a new image at the same URL couldn't be
+      told from the cached one.
+    """
+    try:
+      info = urllib2.urlopen(_HeadRequest(url)).info()
+    except (IOError, ValueError) as e:
+      self._logger.debug('HEAD %s failed: %s', url, e)
+      return None
+    validator = info.getheader('ETag')
+    if not validator and info.getheader('Last-Modified'):
+      validator = '%s/%s' % (info.getheader('Last-Modified'),
+                             info.getheader('Content-Length', ''))
+    if not validator:
+      return None
+    return hashlib.sha1('%s\n%s' % (url, validator)).hexdigest()
+
+  def _urlopen(self, url):
+    """Opens url for download.
+
+    Returns:
+      tuple (file-like object, size in bytes or None if unknown).
+
+    Raises:
+      ImageCacheError: if url can't be opened.
+    """
+    try:
+      src = urllib2.urlopen(url)
+      size = src.info().getheader('Content-Length')
+      return src, int(size) if size else None
+    except (IOError, ValueError) as e:
+      raise ImageCacheError('Failed to open %s: %s' % (url, e))
+
+  def _get_path(self, key, suffix):
+    return os.path.join(self._cache_dir, key + suffix)
+
+  @contextlib.contextmanager
+  def open(self, url):
+    """Opens an image through the cache.
+
+    On a hit, the cached file is read while holding a shared lock on its entry
+    so it can't be evicted meanwhile. On a miss, the URL is read and teed into
+    the cache while holding an exclusive lock, on which other processes
+    wanting the same image wait. The entry is committed, and the lock made
+    shared, as soon as the image was read to its end; if the consumer stops
+    reading early (e.g. at the image member of a tarball), the rest is
+    downloaded once it is done. Images without HTTP validators bypass the
+    cache.
+
+    Args:
+      url: http(s) URL of the image.
+
+    Yields:
+      tuple (file-like object, size in bytes or None if unknown).
+
+    Raises:
+      ImageCacheError: if the image can't be downloaded.
+    """
+    key = self._get_key(url)
+    if key is None:
+      self._logger.info('Not caching image of %s: no ETag or Last-Modified',
+                        url)
+      src, size = self._urlopen(url)
+      try:
+        yield src, size
+      finally:
+        src.close()
+      return
+    image_path = self._get_path(key, _IMAGE_SUFFIX)
+    with open(self._get_path(key, _LOCK_SUFFIX), 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_SH)
+      try:
+        if not os.path.exists(image_path):
+          fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(image_path):
+          # Let other readers in, while keeping the entry from eviction.
+          fcntl.flock(lock_file, fcntl.LOCK_SH)
+          self._logger.info('Using cached image of %s', url)
+          os.utime(image_path, None)
+          with open(image_path, 'rb') as image_file:
+            yield image_file, os.fstat(image_file.fileno()).st_size
+          return
+
+        self._logger.info('Caching image of %s', url)
+        src, size = self._urlopen(url)
+        tmp_path = self._get_path(key, _TMP_SUFFIX)
+        tmp_file = open(tmp_path, 'wb')
+
+        def commit():
+          """Moves the downloaded image into the cache and lets readers in."""
+          tmp_file.close()
+          if size is not None and tee.size != size:
+            self._logger.warning('Not caching incomplete image of %s', url)
+            return
+          try:
+            os.rename(tmp_path, image_path)
+          except OSError as e:
+            self._logger.warning('Failed to cache image of %s: %s', url, e)
+            return
+          fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+        try:
+          tee = _TeeReader(src, tmp_file, commit)
+          yield tee, size
+          try:
+            while not tee.complete:
+              tee.read(_DRAIN_SIZE)
+          except (IOError, ValueError) as e:
+            self._logger.warning('Not caching image of %s: %s', url, e)
+        finally:
+          tmp_file.close()
+          src.close()
+          if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    self._evict()
+
+  def _evict(self):
+    """Removes least recently used images until the cache fits max_bytes.
+
+    Images in use by any process (locked entries) are skipped.
+    """
+    entries = []
+    for name in os.listdir(self._cache_dir):
+      if not name.endswith(_IMAGE_SUFFIX):
+        continue
+      try:
+        stat = os.stat(os.path.join(self._cache_dir, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name[:-len(_IMAGE_SUFFIX)]))
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+      if total <= self._max_bytes:
+        break
+      with open(self._get_path(key, _LOCK_SUFFIX), 'a') as lock_file:
+        try:
+          fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+          continue
+        try:
+          os.remove(self._get_path(key, _IMAGE_SUFFIX))
+          total -= size
+          self._logger.info('Evicted cached image %s', key)
+        except OSError:
+          pass
+        finally:
+          fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,198 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the recovery image cache against a local HTTP server."""
+import BaseHTTPServer
+import os
+import shutil
+import SimpleHTTPServer
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import image_cache
+import image_writer
+
+
+IMAGE_SIZE = 3 * 1024 * 1024 + 123
+
+
+class _CountingHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  """Serves the current directory and counts GET requests."""
+  gets = 0
+  validators = True
+
+  def do_HEAD(self):
+    if not _CountingHandler.validators:
+      self.send_error(405)
+      return
+    SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+
+  def do_GET(self):
+    _CountingHandler.gets += 1
+    SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestImageCache(unittest.TestCase):
+
+
+  def setUp(self):
+    self._tempfolder = tempfile.mkdtemp()
+    self._www = os.path.join(self._tempfolder, 'www')
+    os.mkdir(self._www)
+    self._cwd = os.getcwd()
+    os.chdir(self._www)
+    self._image = os.urandom(IMAGE_SIZE)
+    self._write_image('image.bin', self._image)
+    _CountingHandler.gets = 0
+    _CountingHandler.validators = True
+    self._server = BaseHTTPServer.HTTPServer(('localhost', 0),
+                                             _CountingHandler)
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    self._cache_dir = os.path.join(self._tempfolder, 'cache')
+    self._cache = image_cache.ImageCache(self._cache_dir)
+
+  def tearDown(self):
+    self._server.shutdown()
+    self._server.server_close()
+    os.chdir(self._cwd)
+    shutil.rmtree(self._tempfolder)
+
+  def _write_image(self, name, data):
+    with open(os.path.join(self._www, name), 'wb') as f:
+      f.write(data)
+
+  def _url(self, name):
+    return 'http://localhost:%d/%s' % (self._server.server_port, name)
+
+  def _read(self, url, size=None):
+    with self._cache.open(url) as (src, total_size):
+      self.assertEquals(total_size, IMAGE_SIZE)
+      if size is None:
+        return src.read(IMAGE_SIZE + 1)
+      return src.read(size)
+
+  def _cached_images(self):
+    return [n for n in os.listdir(self._cache_dir) if n.endswith('.img')]
+
+  def testDownloadOnce(self):
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(_CountingHandler.gets, 1)
+    self.assertEquals(len(self._cached_images()), 1)
+
+  def testFailedReadNotCached(self):
+    def fail():
+      with self._cache.open(self._url('image.bin')) as (src, _):
+        src.read(1024)
+        raise IOError('consumer failed')
+    self.assertRaises(IOError, fail)
+    self.assertEquals(self._cached_images(), [])
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(_CountingHandler.gets, 2)
+
+  def testEarlyStopCached(self):
+    self.assertEquals(self._read(self._url('image.bin'), 1024),
+                      self._image[:1024])
+    self.assertEquals(len(self._cached_images()), 1)
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(_CountingHandler.gets, 1)
+
+  def testSharedOnceDownloaded(self):
+    with self._cache.open(self._url('image.bin')) as (src, _):
+      self.assertEquals(src.read(IMAGE_SIZE + 1), self._image)
+      self.assertEquals(src.read(1), '')
+      # Would wait for the first consumer if the entry were still locked.
+      self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(_CountingHandler.gets, 1)
+
+  def testChangedImageDownloadedAgain(self):
+    self._read(self._url('image.bin'))
+    new_image = os.urandom(IMAGE_SIZE)
+    self._write_image('image.bin', new_image)
+    # Make sure Last-Modified changes.
+    os.utime(os.path.join(self._www, 'image.bin'), (0, 0))
+    self.assertEquals(self._read(self._url('image.bin')), new_image)
+    self.assertEquals(_CountingHandler.gets, 2)
+
+  def testEvictLeastRecentlyUsed(self):
+    self._cache = image_cache.ImageCache(self._cache_dir, IMAGE_SIZE * 2)
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+      self._write_image(name, self._image)
+      self._read(self._url(name))
+      # Make sure the next image is more recent.
+      for image in self._cached_images():
+        path = os.path.join(self._cache_dir, image)
+        os.utime(path, (os.stat(path).st_mtime - 10,) * 2)
+    self.assertEquals(len(self._cached_images()), 2)
+    self._read(self._url('b.bin'))
+    self._read(self._url('c.bin'))
+    self.assertEquals(_CountingHandler.gets, 3)
+
+  def testNoValidatorsNotCached(self):
+    _CountingHandler.validators = False
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(self._read(self._url('image.bin')), self._image)
+    self.assertEquals(_CountingHandler.gets, 2)
+    self.assertEquals(self._cached_images(), [])
+
+  def testOverlappingReadsRefused(self):
+    entered = threading.Event()
+    release = threading.Event()
+
+    class BlockingSource(object):
+      def read(self, size):
+        entered.set()
+        release.wait()
+        return 'x' * size
+
+    cache_file = tempfile.TemporaryFile()
+    tee = image_cache._TeeReader(BlockingSource(), cache_file, lambda: None)
+    reader = threading.Thread(target=tee.read, args=(4,))
+    reader.start()
+    entered.wait()
+    self.assertRaises(IOError, tee.read, 4)
+    release.set()
+    reader.join()
+    self.assertEquals(tee.size, 4)
+    cache_file.close()
+
+  def testImageWriterThroughCache(self):
+    device = os.path.join(self._tempfolder, 'device')
+    open(device, 'w').close()
+    writer = image_writer.ImageWriter(cache=self._cache)
+    for _ in xrange(2):
+      writer.write(self._url('image.bin'), device)
+      with open(device, 'rb') as f:
+        self.assertEquals(f.read(), self._image)
+    self.assertEquals(_CountingHandler.gets, 1)
+
+  def testTarballImageNotLastCached(self):
+    image = os.path.join(self._tempfolder, 'image.bin')
+    readme = os.path.join(self._tempfolder, 'README')
+    with open(image, 'wb') as f:
+      f.write(self._image)
+    with open(readme, 'w') as f:
+      f.write('after the image')
+    tar = tarfile.open(os.path.join(self._www, 'image.tar'), 'w')
+    tar.add(image, 'chromiumos_recovery_image.bin')
+    tar.add(readme, 'README')
+    tar.close()
+    device = os.path.join(self._tempfolder, 'device')
+    open(device, 'w').close()
+    writer = image_writer.ImageWriter(cache=self._cache)
+    for _ in xrange(2):
+      writer.write(self._url('image.tar'), device)
+      with open(device, 'rb') as f:
+        self.assertEquals(f.read(), self._image)
+    self.assertEquals(_CountingHandler.gets, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
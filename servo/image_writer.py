@@ -0,0 +1,681 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Streaming writer of recovery images onto the servo USB stick.
+
+The image is read (from a file or an HTTP URL) by a reader thread into a
+small pool of large page-aligned buffers, while the calling thread writes the
+filled buffers to the block device, opened with O_DIRECT where supported. Only
+the target device is flushed at the end.
+
+In delta mode, the image is compared chunk by chunk against what the device
+already holds, known from a persisted manifest of chunk hashes or by reading
+the device back, and only differing chunks are written.
+
+Compressed images (gzip, xz or bzip2, recognized by their magic bytes) are
+decompressed on the fly by an external decompressor process, and the image of
+a tarball is extracted from the decompressed stream, so they never hit the
+host disk uncompressed.
+"""
+
+import contextlib
+import distutils.spawn
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import Queue
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import urllib2
+
+import image_cache
+
+
+# Alignment of O_DIRECT writes (and of the buffers).
+BLOCK_SIZE = 4096
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_NUM_BUFFERS = 4
+
+HTTP_PREFIXES = ('http://', 'https://')
+
+# Granularity of delta writes, a divisor of the buffer size.
+CHUNK_SIZE = 1024 * 1024
+MANIFEST_DIR = '/var/lib/servod/image_manifests'
+_DISK_BY_ID_DIR = '/dev/disk/by-id'
+
+# Decompressors of compressed images, by compression format, in order of
+# preference (parallel implementations first).
+DECOMPRESSORS = {
+    'gzip': ['pigz', 'gzip'],
+    'xz': ['xz'],
+    'bzip2': ['pbzip2', 'bzip2'],
+}
+_COMPRESSION_MAGICS = [
+    ('gzip', '\x1f\x8b'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('bzip2', 'BZh'),
+]
+# Bytes written to a decompressor at once.
+_FEED_SIZE = 1024 * 1024
+_COMPRESSION_MAGIC_SIZE = max(len(magic) for _, magic in _COMPRESSION_MAGICS)
+# Location of the ustar magic in a tar header, to recognize tarballs.
+_TAR_MAGIC_OFFSET = 257
+_TAR_MAGIC = 'ustar'
+_TAR_IMAGE_SUFFIX = '.bin'
+
+# States reported by ImageWriter.get_progress().
+STATE_IDLE = 'idle'
+STATE_WRITING = 'writing'
+STATE_SYNCING = 'syncing'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+
+class ImageWriterError(Exception):
+  """Exception class for ImageWriter."""
+
+
+def open_source(image_path):
+  """Opens an image for reading.
+
+  Args:
+    image_path: path or http(s) URL of the image.
+
+  Returns:
+    tuple (file-like object, size in bytes or None if unknown).
+
+  Raises:
+    ImageWriterError: if the image can't be opened.
+  """
+  try:
+    if image_path.startswith(HTTP_PREFIXES):
+      src = urllib2.urlopen(image_path)
+      size = src.info().getheader('Content-Length')
+      return src, int(size) if size else None
+    src = open(image_path, 'rb')
+    return src, os.fstat(src.fileno()).st_size
+  except (IOError, OSError, ValueError) as e:
+    raise ImageWriterError('Failed to open %s: %s' % (image_path, e))
+
+
+def get_device_id(device):
+  """Gets a name identifying the disk behind a block device across re-plugs.
+
+  Returns:
+    name of the /dev/disk/by-id link to device (which includes the disk serial
+    number), or the basename of device if there is none.
+  """
+  real_device = os.path.realpath(device)
+  try:
+    names = sorted(os.listdir(_DISK_BY_ID_DIR))
+  except OSError:
+    names = []
+  # Prefer usb- links, which are the ones of the servo USB stick.
+  for name in sorted(names, key=lambda n: not n.startswith('usb-')):
+    if os.path.realpath(os.path.join(_DISK_BY_ID_DIR, name)) == real_device:
+      return name
+  return os.path.basename(real_device)
+
+
+class ChunkManifest(object):
+  """Hashes of the CHUNK_SIZE chunks last written to a device.
+
+  Attributes:
+    device_id: see get_device_id().
+    hashes: list of hex digests, chunk i at byte offset i * CHUNK_SIZE.
+  """
+
+  def __init__(self, device_id, hashes=None):
+    self.device_id = device_id
+    self.hashes = hashes or []
+
+  @staticmethod
+  def _get_path(device_id):
+    return os.path.join(MANIFEST_DIR, device_id + '.json')
+
+  @classmethod
+  def load(cls, device_id):
+    """Loads the manifest of device_id, empty if none or unreadable."""
+    try:
+      with open(cls._get_path(device_id)) as f:
+        data = json.load(f)
+      if data.get('chunk_size') == CHUNK_SIZE:
+        return cls(device_id, data['hashes'])
+    except (IOError, ValueError, KeyError):
+      pass
+    return cls(device_id)
+
+  def save(self):
+    """Persists the manifest; failures are only logged."""
+    path = self._get_path(self.device_id)
+    try:
+      if not os.path.isdir(MANIFEST_DIR):
+        os.makedirs(MANIFEST_DIR)
+      with open(path + '.tmp', 'w') as f:
+        json.dump({'chunk_size': CHUNK_SIZE, 'hashes': self.hashes}, f)
+      os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+      logging.warning('Failed to save image manifest %s: %s', path, e)
+
+  def remove(self):
+    """Removes the persisted manifest, e.g. before a device is overwritten."""
+    try:
+      os.remove(self._get_path(self.device_id))
+    except OSError:
+      pass
+
+  def set(self, index, digest):
+    """Records the hash of chunk index."""
+    if index >= len(self.hashes):
+      self.hashes.extend([None] * (index + 1 - len(self.hashes)))
+    self.hashes[index] = digest
+
+  def get(self, index):
+    """Returns the recorded hash of chunk index, or None."""
+    return self.hashes[index] if index < len(self.hashes) else None
+
+
+def _fill(src, buf):
+  """Reads from src until buf is full or src is exhausted.
+
+  Returns:
+    number of bytes stored at the start of buf.
+  """
+  size = len(buf)
+  offset = 0
+  while offset < size:
+    data = src.read(size - offset)
+    if not data:
+      break
+    buf[offset:offset + len(data)] = data
+    offset += len(data)
+  return offset
+
+
+def get_compression(header):
+  """Identifies the compression format of an image from its first bytes.
+
+  Returns:
+    key of DECOMPRESSORS, or None if the image isn't compressed.
+  """
+  for compression, magic in _COMPRESSION_MAGICS:
+    if header.startswith(magic):
+      return compression
+  return None
+
+
+def get_decompress_command(compression):
+  """Returns the command line decompressing stdin to stdout.
+
+  Raises:
+    ImageWriterError: if no decompressor is installed.
+  """
+  for program in DECOMPRESSORS[compression]:
+    path = distutils.spawn.find_executable(program)
+    if path:
+      return [path, '-dc']
+  raise ImageWriterError('No %s decompressor found, tried %s' %
+                         (compression, ', '.join(DECOMPRESSORS[compression])))
+
+
+class _CountingReader(object):
+  """File-like object reporting the number of bytes read from src."""
+
+  def __init__(self, src, callback):
+    self._src = src
+    self._callback = callback
+
+  def read(self, size):
+    data = self._src.read(size)
+    self._callback(len(data))
+    return data
+
+
+class _PeekReader(object):
+  """File-like object allowing to look at the start of src before reading."""
+
+  def __init__(self, src):
+    self._src = src
+    self._head = ''
+
+  def peek(self, size):
+    """Returns up to size bytes from the start of src, without consuming."""
+    while len(self._head) < size:
+      data = self._src.read(size - len(self._head))
+      if not data:
+        break
+      self._head += data
+    return self._head[:size]
+
+  def read(self, size):
+    if self._head:
+      data, self._head = self._head[:size], self._head[size:]
+      return data
+    return self._src.read(size)
+
+
+class _Decompressor(object):
+  """File-like object decompressing src through an external process.
+
+  A feeder thread copies src into the process, so reading the source (e.g.
+  from the network), decompressing and writing the device all overlap.
+  Python 2 has no lzma module, and the external tools are faster anyway.
+  """
+
+  def __init__(self, src, command):
+    self._logger = logging.getLogger('ImageWriter')
+    self._command = command
+    self._src = src
+    self._stderr = tempfile.TemporaryFile()
+    self._proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=self._stderr,
+                                  close_fds=True)
+    self._feed_error = None
+    self._feeder = threading.Thread(target=self._feed, name='image_feeder')
+    self._feeder.daemon = True
+    self._feeder.start()
+
+  def _feed(self):
+    """Feeder thread: copies src to the stdin of the process."""
+    try:
+      while True:
+        data = self._src.read(_FEED_SIZE)
+        if not data:
+          break
+        self._proc.stdin.write(data)
+    except Exception as e:
+      # EPIPE if the process died or was killed, reported by read() or moot.
+      self._feed_error = e
+    finally:
+      try:
+        self._proc.stdin.close()
+      except IOError:
+        pass
+
+  def read(self, size):
+    data = self._proc.stdout.read(size)
+    if not data:
+      self._check()
+    return data
+
+  def _check(self):
+    """Checks that the whole source was decompressed successfully."""
+    self._feeder.join()
+    if self._proc.wait():
+      self._stderr.seek(0)
+      raise ImageWriterError('%s exited with %d: %s' %
+                             (os.path.basename(self._command[0]),
+                              self._proc.returncode,
+                              self._stderr.read().strip()))
+    if self._feed_error:
+      raise ImageWriterError('Failed to read image: %s' % self._feed_error)
+
+  def close(self):
+    """Stops the decompression, e.g. if the device write failed."""
+    if self._proc.poll() is None:
+      self._proc.kill()
+    self._proc.stdout.close()
+    self._proc.wait()
+    # The feeder ends once its read of src returns, on the write to the killed
+    # process.  It must be done before anyone else reads src, e.g. the image
+    # cache downloading the rest of the image.
+    self._feeder.join()
+    self._stderr.close()
+
+
+class ImageWriter(object):
+  """Writes images to a block device through a reader/writer pipeline.
+
+  One ImageWriter serves one servod; get_progress() may be called from another
+  thread while write() is running.
+  """
+
+  def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE,
+               num_buffers=DEFAULT_NUM_BUFFERS, cache=None):
+    """Constructor.
+
+    Args:
+      buffer_size: bytes per buffer, a multiple of BLOCK_SIZE.
+      num_buffers: number of buffers in flight between reader and writer.
+      cache: image_cache.ImageCache to download URLs through, or None.
+    """
+    if buffer_size % BLOCK_SIZE:
+      raise ImageWriterError('Buffer size %d not a multiple of %d' %
+                             (buffer_size, BLOCK_SIZE))
+    self._logger = logging.getLogger('ImageWriter')
+    self._buffer_size = buffer_size
+    self._num_buffers = num_buffers
+    self._cache = cache
+    self._progress_lock = threading.Lock()
+    self._progress = {}
+    self._reset_progress(None, None)
+    self._update_progress(state=STATE_IDLE, start_time=None)
+
+  def _reset_progress(self, image_path, device):
+    """Starts reporting a new transfer."""
+    with self._progress_lock:
+      self._progress = {
+          'state': STATE_WRITING,
+          'image_path': image_path,
+          'device': device,
+          'total_bytes': None,
+          'compression': None,
+          'bytes_read': 0,
+          'bytes_decompressed': 0,
+          'bytes_written': 0,
+          'bytes_skipped': 0,
+          'start_time': time.time(),
+          'end_time': None,
+          'error': None,
+      }
+
+  def _update_progress(self, **kwargs):
+    """Updates fields of the current transfer report."""
+    with self._progress_lock:
+      for key, value in kwargs.iteritems():
+        if key.startswith('add_'):
+          self._progress[key[4:]] += value
+        else:
+          self._progress[key] = value
+
+  def get_progress(self):
+    """Reports the current or last transfer.
+
+    Returns:
+      dict with 'state', 'image_path', 'device', 'total_bytes' (of the
+      source, None if unknown), 'compression' (None if uncompressed),
+      'bytes_read' (from the source), 'bytes_decompressed' (if compressed),
+      'bytes_written', 'bytes_skipped' (already up to date on the device),
+      'elapsed_secs', 'read_mb_per_sec', 'decompress_mb_per_sec' (if
+      compressed), 'mb_per_sec' (of device progress) and 'error'. Values that
+      are None are omitted, so it can be returned across XMLRPC.
+    """
+    with self._progress_lock:
+      progress = dict(self._progress)
+    if not progress['compression']:
+      progress['bytes_decompressed'] = None
+    if progress['start_time']:
+      end_time = progress['end_time'] or time.time()
+      elapsed = end_time - progress['start_time']
+      progress['elapsed_secs'] = elapsed
+      done = progress['bytes_written'] + progress['bytes_skipped']
+      for key, count in (('read_mb_per_sec', progress['bytes_read']),
+                         ('decompress_mb_per_sec',
+                          progress['bytes_decompressed']),
+                         ('mb_per_sec', done)):
+        if count is not None:
+          progress[key] = (count / (1024.0 * 1024) / elapsed
+                           if elapsed > 0 else 0.0)
+    # XMLRPC integers are 32 bits; images are bigger than that.
+    for key in ('total_bytes', 'bytes_read', 'bytes_decompressed',
+                'bytes_written', 'bytes_skipped'):
+      if progress[key] is not None:
+        progress[key] = float(progress[key])
+    return dict((k, v) for k, v in progress.iteritems() if v is not None)
+
+  def _read_loop(self, src, free, full):
+    """Reader thread: fills free buffers from src and queues them to full.
+
+    Queues (buffer, length) tuples, then None at end of image, or an exception
+    on failure.
+    """
+    try:
+      while True:
+        buf = free.get()
+        if buf is None:
+          # Writer gave up.
+          return
+        length = _fill(src, buf)
+        if not length:
+          full.put(None)
+          return
+        self._update_progress(add_bytes_decompressed=length)
+        full.put((buf, length))
+    except Exception as e:
+      full.put(e)
+
+  def _open_device(self, device):
+    """Opens device for writing, with O_DIRECT if supported.
+
+    Returns:
+      tuple (fd, direct) where direct tells whether O_DIRECT is in use.
+    """
+    flags = os.O_WRONLY
+    direct = getattr(os, 'O_DIRECT', 0)
+    if direct:
+      try:
+        return os.open(device, flags | direct), True
+      except OSError as e:
+        if e.errno != errno.EINVAL:
+          raise
+        self._logger.debug('O_DIRECT not supported by %s', device)
+    return os.open(device, flags), False
+
+  def _write_chunk(self, fd, buf, length, direct):
+    """Writes the first length bytes of buf to fd.
+
+    Returns:
+      whether O_DIRECT is still in use; it is turned off for the unaligned
+      tail of an image.
+    """
+    if direct and length % BLOCK_SIZE:
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+      direct = False
+    offset = 0
+    while offset < length:
+      offset += os.write(fd, buffer(buf, offset, length - offset))
+    return direct
+
+  def _write_delta(self, fd, read_fd, buf, length, offset, manifest, direct):
+    """Writes the chunks of buf which differ from the device.
+
+    A chunk is known to match if its hash is in manifest or, without manifest
+    (read_fd is not None), if reading the device back returns the same bytes.
+    Every chunk is hashed, to record it in manifest.
+
+    Args:
+      fd: device file descriptor to write to.
+      read_fd: device file descriptor to read back from, None to trust
+          manifest.
+      buf: buffer holding the image data.
+      length: number of bytes of image data in buf.
+      offset: device offset of buf, a multiple of CHUNK_SIZE.
+      manifest: ChunkManifest of the device, updated with the new hashes.
+      direct: whether fd uses O_DIRECT.
+
+    Returns:
+      whether O_DIRECT is still in use, see _write_chunk().
+    """
+    for start in xrange(0, length, CHUNK_SIZE):
+      size = min(CHUNK_SIZE, length - start)
+      data = buf[start:start + size]
+      index = (offset + start) / CHUNK_SIZE
+      digest = hashlib.sha1(data).hexdigest()
+      if read_fd is None:
+        same = manifest.get(index) == digest
+      else:
+        os.lseek(read_fd, offset + start, os.SEEK_SET)
+        same = os.read(read_fd, size) == data
+      manifest.set(index, digest)
+      if same:
+        self._update_progress(add_bytes_skipped=size)
+        continue
+      os.lseek(fd, offset + start, os.SEEK_SET)
+      direct = self._write_chunk(fd, buffer(buf, start, size), size, direct)
+      self._update_progress(add_bytes_written=size)
+    return direct
+
+  def write(self, image_path, device, delta=False, trust_manifest=False):
+    """Writes an image to a device.
+
+    Args:
+      image_path: path or http(s) URL of the image, possibly compressed or a
+          compressed tarball of a .bin image.
+      device: path of the block device.
+      delta: if True, only write the chunks differing from the device.
+      trust_manifest: in delta mode, if True, compare against the persisted
+          manifest of the device rather than reading the device back. Only
+          safe if nothing else wrote to the device since the manifest was
+          saved.
+
+    Raises:
+      ImageWriterError: if the transfer fails.
+    """
+    if delta and self._buffer_size % CHUNK_SIZE:
+      raise ImageWriterError('Buffer size %d not a multiple of %d' %
+                             (self._buffer_size, CHUNK_SIZE))
+    self._reset_progress(image_path, device)
+    try:
+      with self._open_image(image_path) as src:
+        self._write(image_path, src, device, delta, trust_manifest)
+    except (ImageWriterError, image_cache.ImageCacheError) as e:
+      if self.get_progress()['state'] != STATE_FAILED:
+        self._update_progress(state=STATE_FAILED, error=str(e),
+                              end_time=time.time())
+      raise ImageWriterError(str(e))
+
+  @contextlib.contextmanager
+  def _open_source(self, image_path):
+    """Opens an image for reading, through the cache for URLs.
+
+    Yields:
+      tuple (file-like object, size in bytes or None if unknown).
+    """
+    if self._cache and image_path.startswith(HTTP_PREFIXES):
+      with self._cache.open(image_path) as source:
+        yield source
+    else:
+      src, size = open_source(image_path)
+      try:
+        yield src, size
+      finally:
+        src.close()
+
+  @contextlib.contextmanager
+  def _open_image(self, image_path):
+    """Opens the raw image, decompressing and extracting it as needed.
+
+    Yields:
+      file-like object returning the bytes to write to the device.
+    """
+    with self._open_source(image_path) as (src, total_bytes):
+      self._update_progress(total_bytes=total_bytes)
+      src = _PeekReader(_CountingReader(
+          src, lambda count: self._update_progress(add_bytes_read=count)))
+      compression = get_compression(src.peek(_COMPRESSION_MAGIC_SIZE))
+      if not compression:
+        yield self._open_tar_image(src)
+        return
+      self._update_progress(compression=compression)
+      command = get_decompress_command(compression)
+      self._logger.info('Decompressing %s with %s', image_path, command[0])
+      decompressor = _Decompressor(src, command)
+      try:
+        yield self._open_tar_image(_PeekReader(decompressor))
+      finally:
+        decompressor.close()
+
+  def _open_tar_image(self, src):
+    """Returns the image of src if it is a tarball, else src itself.
+
+    The first regular member of the tarball named *.bin is the image; the
+    tarball is read as a stream, so members before it are skipped without
+    being stored.
+
+    Args:
+      src: _PeekReader of the (decompressed) image.
+
+    Raises:
+      ImageWriterError: if src is a tarball without image.
+    """
+    header = src.peek(_TAR_MAGIC_OFFSET + len(_TAR_MAGIC))
+    if header[_TAR_MAGIC_OFFSET:] != _TAR_MAGIC:
+      return src
+    try:
+      tar = tarfile.open(fileobj=src, mode='r|')
+      for member in tar:
+        if member.isfile() and member.name.endswith(_TAR_IMAGE_SUFFIX):
+          self._logger.info('Writing %s from tarball', member.name)
+          return tar.extractfile(member)
+    except tarfile.TarError as e:
+      raise ImageWriterError('Failed to read tarball: %s' % e)
+    raise ImageWriterError('No *%s image in tarball' % _TAR_IMAGE_SUFFIX)
+
+  def _write(self, image_path, src, device, delta, trust_manifest):
+    """Writes an image from an opened source. See write()."""
+    read_fd = None
+    manifest = ChunkManifest(get_device_id(device))
+    if delta and trust_manifest:
+      manifest = ChunkManifest.load(manifest.device_id)
+    # The device is about to be modified: a stale manifest must not survive
+    # a failed or non-delta transfer.
+    manifest.remove()
+    if not delta:
+      manifest = None
+    free = Queue.Queue()
+    full = Queue.Queue()
+    buffers = [mmap.mmap(-1, self._buffer_size)
+               for _ in xrange(self._num_buffers)]
+    for buf in buffers:
+      free.put(buf)
+    reader = threading.Thread(target=self._read_loop, args=(src, free, full),
+                              name='image_reader')
+    reader.daemon = True
+    started = False
+    fd = None
+    try:
+      fd, direct = self._open_device(device)
+      if delta and not trust_manifest:
+        read_fd = os.open(device, os.O_RDONLY)
+      reader.start()
+      started = True
+      offset = 0
+      while True:
+        item = full.get()
+        if item is None:
+          break
+        if isinstance(item, Exception):
+          raise item
+        buf, length = item
+        if delta:
+          direct = self._write_delta(fd, read_fd, buf, length, offset,
+                                     manifest, direct)
+        else:
+          direct = self._write_chunk(fd, buf, length, direct)
+          self._update_progress(add_bytes_written=length)
+        offset += length
+        free.put(buf)
+      self._update_progress(state=STATE_SYNCING)
+      os.fdatasync(fd)
+      if manifest:
+        del manifest.hashes[(offset + CHUNK_SIZE - 1) / CHUNK_SIZE:]
+        manifest.save()
+      self._update_progress(state=STATE_DONE, end_time=time.time())
+      progress = self.get_progress()
+      self._logger.info('Wrote %d bytes (%d up to date) to %s in %.1fs '
+                        '(%.1f MB/s, read %.1f MB/s)',
+                        progress['bytes_written'], progress['bytes_skipped'],
+                        device, progress['elapsed_secs'],
+                        progress['mb_per_sec'], progress['read_mb_per_sec'])
+    except Exception as e:
+      self._update_progress(state=STATE_FAILED, error=str(e),
+                            end_time=time.time())
+      # Unblock the reader if it waits for a buffer.
+      free.put(None)
+      raise ImageWriterError('Failed to write %s to %s: %s' %
+                             (image_path, device, e))
+    finally:
+      if fd is not None:
+        os.close(fd)
+      if read_fd is not None:
+        os.close(read_fd)
+      if started:
+        reader.join(1.0)
@@ -0,0 +1,109 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the delta writes and decompression of the image writer."""
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import image_writer
+
+
+IMAGE_SIZE = 3 * image_writer.CHUNK_SIZE + 123
+
+
+class TestImageWriter(unittest.TestCase):
+
+  def setUp(self):
+    self._tempfolder = tempfile.mkdtemp()
+    self._manifest_dir = image_writer.MANIFEST_DIR
+    image_writer.MANIFEST_DIR = os.path.join(self._tempfolder, 'manifests')
+    self._device = os.path.join(self._tempfolder, 'device')
+    open(self._device, 'w').close()
+    self._image = os.urandom(IMAGE_SIZE)
+    self._writer = image_writer.ImageWriter()
+
+  def tearDown(self):
+    image_writer.MANIFEST_DIR = self._manifest_dir
+    shutil.rmtree(self._tempfolder)
+
+  def _write_file(self, name, data):
+    path = os.path.join(self._tempfolder, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def _write(self, path, **kwargs):
+    self._writer.write(path, self._device, **kwargs)
+    return self._writer.get_progress()
+
+  def _device_data(self):
+    with open(self._device, 'rb') as f:
+      return f.read()
+
+  def _changed_image(self):
+    offset = image_writer.CHUNK_SIZE + 10
+    return self._image[:offset] + 'changed' + self._image[offset + 7:]
+
+  def testDeltaReadBack(self):
+    self._write(self._write_file('a.bin', self._image))
+    image = self._changed_image()
+    progress = self._write(self._write_file('b.bin', image), delta=True)
+    self.assertEquals(self._device_data(), image)
+    self.assertEquals(progress['bytes_written'], image_writer.CHUNK_SIZE)
+    self.assertEquals(progress['bytes_skipped'],
+                      IMAGE_SIZE - image_writer.CHUNK_SIZE)
+
+  def testDeltaTrustManifest(self):
+    self._write(self._write_file('a.bin', self._image), delta=True)
+    image = self._changed_image()
+    progress = self._write(self._write_file('b.bin', image), delta=True,
+                           trust_manifest=True)
+    self.assertEquals(self._device_data(), image)
+    self.assertEquals(progress['bytes_written'], image_writer.CHUNK_SIZE)
+
+  def testFullWriteRemovesManifest(self):
+    self._write(self._write_file('a.bin', self._image), delta=True)
+    self._write(self._write_file('b.bin', self._changed_image()))
+    # Without manifest, the whole image is compared and written again.
+    progress = self._write(self._write_file('a.bin', self._image), delta=True,
+                           trust_manifest=True)
+    self.assertEquals(self._device_data(), self._image)
+    self.assertEquals(progress['bytes_written'], IMAGE_SIZE)
+
+  def testGzip(self):
+    path = os.path.join(self._tempfolder, 'image.bin.gz')
+    f = gzip.open(path, 'wb')
+    f.write(self._image)
+    f.close()
+    progress = self._write(path)
+    self.assertEquals(self._device_data(), self._image)
+    self.assertEquals(progress['compression'], 'gzip')
+
+  def testTarball(self):
+    readme = self._write_file('README', 'not the image')
+    image = self._write_file('image.bin', self._image)
+    path = os.path.join(self._tempfolder, 'image.tar.gz')
+    tar = tarfile.open(path, 'w:gz')
+    tar.add(readme, 'README')
+    tar.add(image, 'chromiumos_recovery_image.bin')
+    tar.close()
+    self._write(path)
+    self.assertEquals(self._device_data(), self._image)
+
+  def testTarballWithoutImage(self):
+    readme = self._write_file('README', 'not the image')
+    path = os.path.join(self._tempfolder, 'image.tar')
+    tar = tarfile.open(path, 'w')
+    tar.add(readme, 'README')
+    tar.close()
+    self.assertRaises(image_writer.ImageWriterError, self._write, path)
+    self.assertEquals(self._writer.get_progress()['state'],
+                      image_writer.STATE_FAILED)
+
+
+if __name__ == '__main__':
+  unittest.main()
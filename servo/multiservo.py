@@ -3,13 +3,60 @@
 # found in the LICENSE file.
 """Common code for multiservo operation support"""
 
+import errno
 import os
+import stat
 
 if os.getuid():
   DEFAULT_RC_FILE = '/home/%s/.servodrc' % os.getenv('USER', '')
 else:
   DEFAULT_RC_FILE = '/home/%s/.servodrc' % os.getenv('SUDO_USER', '')
 
+# Besides its TCP port, servod listens for local clients on a Unix domain
+# socket named after the port in this directory, which only the servod user
+# may write to.
+SOCKET_DIR = '/var/run/servod'
+
+
+def get_socket_path(port):
+  """Return the path of the Unix domain socket of the servod on port."""
+  return os.path.join(SOCKET_DIR, 'servod_%d.sock' % int(port))
+
+
+def make_socket_dir():
+  """Create SOCKET_DIR if needed, making sure no other user may write to it.
+
+  Raises:
+    OSError: if SOCKET_DIR can't be created, or another user controls it.
+  """
+  try:
+    os.makedirs(SOCKET_DIR, 0755)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  dir_stat = os.lstat(SOCKET_DIR)
+  if (not stat.S_ISDIR(dir_stat.st_mode) or
+      dir_stat.st_uid != os.geteuid() or
+      dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+    raise OSError(errno.EPERM, '%s not a directory only writable by uid %d' %
+                  (SOCKET_DIR, os.geteuid()))
+
+
+def is_trusted_socket(path):
+  """Return True if path is a socket created by the owner of its directory.
+
+  Only then may clients trust it to be servod's, see make_socket_dir().
+  """
+  try:
+    dir_stat = os.lstat(os.path.dirname(path))
+    sock_stat = os.lstat(path)
+  except OSError:
+    return False
+  return (stat.S_ISDIR(dir_stat.st_mode) and
+          not dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and
+          stat.S_ISSOCK(sock_stat.st_mode) and
+          sock_stat.st_uid == dir_stat.st_uid)
+
 
 def add_multiservo_parser_options(parser):
   """Add common options descriptors to the parser object
@@ -0,0 +1,49 @@
+#!/usr/bin/env python2
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Compare the register reads per second of bbi2c's i2c-dev and tools paths.
+
+Reads a register of a slave on a BeagleBone i2c bus the way INA drivers
+sample it (write of the register pointer then read), through the i2c-dev
+ioctl and through the i2cset/i2cget subprocesses.
+
+See usage ( -h ) for more details
+"""
+
+import logging
+import optparse
+
+from servo import bbi2c
+from servo import benchmark
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-d', '--debug', help='enable debug messages',
+                    action='store_true', default=False)
+  parser.add_option('-b', '--bus', type=int, default=2,
+                    help='bus_num of the i2c interface, as in servo_interfaces')
+  parser.add_option('--slave', type=int, default=0x40,
+                    help='7-bit address of the slave')
+  parser.add_option('--reg', type=int, default=0x2,
+                    help='register to read')
+  parser.add_option('-n', '--count', type=int, default=100,
+                    help='number of reads per measurement')
+  (options, _) = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO)
+  rates = {}
+  for name, use_i2c_dev in (('i2c-dev', True), ('i2c tools', False)):
+    i2c = bbi2c.BBi2c({'bus_num': options.bus}, use_i2c_dev=use_i2c_dev)
+    try:
+      rates[name] = benchmark.measure(
+          lambda: i2c.wr_rd(options.slave, [options.reg], 2), options.count)
+    finally:
+      i2c.close()
+    print '%-10s %10.0f reads/s' % (name, rates[name])
+  print '%-10s %9.1fx' % ('speedup', rates['i2c-dev'] / rates['i2c tools'])
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Measure the register reads per second of an FTDI i2c interface.
+
+Reads a register of a slave the way INA drivers sample it (write of the
+register pointer then read), through each input/output path of
+ftdii2c.Fi2c and through batches.  Running it with --debug shows the cost of
+debug logging.
+
+See usage ( -h ) for more details
+"""
+
+import logging
+import optparse
+
+from servo import benchmark
+from servo import ftdi_common
+from servo import ftdii2c
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('-d', '--debug', help='enable debug messages',
+                    action='store_true', default=False)
+  parser.add_option('-v', '--vendor', help='vendor id of ftdi device',
+                    default=ftdi_common.DEFAULT_VID, type=int)
+  parser.add_option('-p', '--product', help='product id of ftdi device',
+                    default=ftdi_common.DEFAULT_PID, type=int)
+  parser.add_option('-i', '--interface', help='ftdi interface to use',
+                    type=int, default=2)
+  parser.add_option('-s', '--serialname', default=None, type=str,
+                    help='device serialname stored in eeprom')
+  parser.add_option('--slave', type=int, default=0x40,
+                    help='7-bit address of the slave')
+  parser.add_option('--reg', type=int, default=0x2,
+                    help='register to read')
+  parser.add_option('--rcnt', type=int, default=2,
+                    help='bytes to read from the register')
+  parser.add_option('-n', '--count', type=int, default=1000,
+                    help='number of calls per measurement')
+  parser.add_option('-b', '--batch', type=int, default=10,
+                    help='register reads per batch')
+  (options, _) = parser.parse_args()
+
+  logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO)
+  fobj = ftdii2c.Fi2c(options.vendor, options.product, options.interface,
+                      options.serialname)
+  fobj.open()
+  fobj.setclock(100000)
+
+  slv = options.slave
+  rcnt = options.rcnt
+  wlist = [options.reg]
+  wstr = chr(options.reg)
+  wbytes = bytearray(wstr)
+  rbuf = bytearray(rcnt)
+  batch = [(slv, wlist, rcnt)] * options.batch
+  paths = [
+      ('wr_rd(list)', lambda: fobj.wr_rd(slv, wlist, rcnt), 1),
+      ('wr_rd(str)', lambda: fobj.wr_rd(slv, wstr, rcnt), 1),
+      ('wr_rd_into(bytearray)', lambda: fobj.wr_rd_into(slv, wbytes, rbuf), 1),
+      ('wr_rd_batch(%d)' % options.batch, lambda: fobj.wr_rd_batch(batch),
+       options.batch),
+  ]
+  try:
+    for name, func, reads in paths:
+      rate = benchmark.measure(func, options.count) * reads
+      print '%-24s %10.0f reads/s' % (name, rate)
+  finally:
+    fobj.close()
+
+
+if __name__ == '__main__':
+  main()
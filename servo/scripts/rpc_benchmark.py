@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Compare the calls per second of servod's XMLRPC and binary protocols.
+
+Gets the given controls of a running servod in a loop, once through
+client.ServoClient and once through client.BinaryServoClient, one control per
+call and then all of them per call.  Pick cheap controls (e.g. config-only
+ones) to measure the protocols rather than the hardware.
+
+See usage ( -h ) for more details
+"""
+
+import optparse
+
+from servo import benchmark
+from servo import client
+
+
+def main():
+  parser = optparse.OptionParser(usage='usage: %prog [options] control...')
+  parser.add_option('-s', '--server', default=client.DEFAULT_HOST,
+                    help='host of servod')
+  parser.add_option('-p', '--port', type=int, default=client.DEFAULT_PORT,
+                    help='port of servod')
+  parser.add_option('-n', '--count', type=int, default=1000,
+                    help='number of calls per measurement')
+  parser.add_option('--tcp', action='store_true', default=False,
+                    help='use TCP even if servod has a Unix domain socket')
+  (options, controls) = parser.parse_args()
+  if not controls:
+    parser.error('No control to get')
+
+  clients = [
+      ('xmlrpc', client.ServoClient(host=options.server, port=options.port,
+                                    unix_socket=not options.tcp)),
+      ('binary', client.BinaryServoClient(host=options.server,
+                                          port=options.port,
+                                          unix_socket=not options.tcp)),
+  ]
+  rates = {}
+  for name, servo_client in clients:
+    # Warm up connections and control ids.
+    servo_client.get_many(controls)
+    rates[name, 'get'] = benchmark.measure(
+        lambda: [servo_client.get(control) for control in controls],
+        options.count) * len(controls)
+    rates[name, 'get_many'] = benchmark.measure(
+        lambda: servo_client.get_many(controls), options.count)
+    servo_client.close()
+
+  print '%-10s %14s %14s' % ('', 'gets/s', 'get_many/s')
+  for name, _ in clients:
+    print '%-10s %14.0f %14.0f' % (name, rates[name, 'get'],
+                                   rates[name, 'get_many'])
+  print '%-10s %13.1fx %13.1fx' % (
+      'speedup', rates['binary', 'get'] / rates['xmlrpc', 'get'],
+      rates['binary', 'get_many'] / rates['xmlrpc', 'get_many'])
+
+
+if __name__ == '__main__':
+  main()
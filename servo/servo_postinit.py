@@ -8,10 +8,10 @@ import logging
 import os
 import re
 import subprocess
-import usb
 
 import servo_interfaces
 import system_config
+import usb_discovery
 
 
 POST_INIT = collections.defaultdict(dict)
@@ -21,6 +21,7 @@ class UsbHierarchy(object):
   """A helper class to analyze the sysfs hierarchy of USB devices."""
 
   USB_SYSFS_PATH = '/sys/bus/usb/devices'
+  BLOCK_SYSFS_PATH = '/sys/block'
   CHILD_RE = re.compile(r'\d+-\d+(\.\d+){1,}\Z')
   BUS_FILE = 'busnum'
   DEV_FILE = 'devnum'
@@ -44,7 +45,8 @@ class UsbHierarchy(object):
     We are only going to be concerned with the roothub, hub port and port.
     We are going to create a hierarchy where each device will store the usb
     sysfs path of its roothub and hub port.  We will also grab the device's
-    bus and device number to help correlate to a usb.core.Device object.
+    bus and device number to help correlate to a usb_discovery.UsbDevice
+    object.
 
     We will walk through each dir and only match on device dirs
     (e.g. '1-2.4') and ignore config.interface dirs.  When we get a hit, we'll
@@ -82,7 +84,7 @@ class UsbHierarchy(object):
     """Return the USB sysfs path of the supplied usb_device's parent.
 
     Args:
-      usb_device: usb.core.Device object.
+      usb_device: usb_discovery.UsbDevice object.
 
     Returns:
       SysFS path string of parent of the supplied usb device.
@@ -94,8 +96,8 @@ class UsbHierarchy(object):
     """Check if the given two USB devices share the same parent.
 
     Args:
-      usb_device1: usb.core.Device object.
-      usb_device2: usb.core.Device object.
+      usb_device1: usb_discovery.UsbDevice object.
+      usb_device2: usb_discovery.UsbDevice object.
 
     Returns:
       True if they share the same parent; otherwise, False.
@@ -105,6 +107,63 @@ class UsbHierarchy(object):
     return (usb_parent1 and usb_parent2
             and usb_parent1 == usb_parent2)
 
+  def get_usb_path(self, vendor, product, serial=None):
+    """Return the USB sysfs path of a device behind a hub.
+
+    Args:
+      vendor: USB vendor id.
+      product: USB product id.
+      serial: serial number string, or None to accept any.
+
+    Returns:
+      SysFS path string (e.g. '1-2.4') of the one matching device, or None if
+      none or several match.
+    """
+    matches = [d.usb_path for d in usb_discovery.find_devices(vendor, product)
+               if (not serial or d.serial == serial) and d.usb_path and
+               self.CHILD_RE.match(d.usb_path)]
+    return matches[0] if len(matches) == 1 else None
+
+  @staticmethod
+  def get_parent_hub_path(usb_path):
+    """Return the USB sysfs path of the hub of usb_path ('1-2' for '1-2.4')."""
+    return '.'.join(usb_path.split('.')[:-1])
+
+  def get_servo_paths(self, hub_path):
+    """Return the USB sysfs paths of the servo devices behind a hub.
+
+    Args:
+      hub_path: USB sysfs path of the hub, e.g. '1-2'.
+
+    Returns:
+      Sorted list of USB sysfs paths, e.g. ['1-2.1'].
+    """
+    servo_ids = servo_interfaces.SERVO_ID_DEFAULTS
+    return sorted(d.usb_path for d in usb_discovery.find_devices()
+                  if d.usb_path and d.usb_path.startswith(hub_path + '.') and
+                  (d.idVendor, d.idProduct) in servo_ids)
+
+  def get_block_devices(self, hub_path):
+    """Return the block devices of the USB disks behind a hub.
+
+    The sysfs path of a disk (/sys/block/sdX) resolves to a path containing
+    the USB devices it is attached through, e.g.
+    .../usb1/1-2/1-2.1/1-2.1:1.0/host6/target6:0:0/6:0:0:0/block/sdb
+
+    Args:
+      hub_path: USB sysfs path of the hub, e.g. '1-2'.
+
+    Returns:
+      Sorted list of device paths, e.g. ['/dev/sdb'].
+    """
+    devices = []
+    for name in os.listdir(self.BLOCK_SYSFS_PATH):
+      real_path = os.path.realpath(os.path.join(self.BLOCK_SYSFS_PATH, name))
+      if any(part.startswith(hub_path + '.') for part in real_path.split('/')
+             if self.CHILD_RE.match(part)):
+        devices.append('/dev/' + name)
+    return sorted(devices)
+
 
 class BasePostInit(object):
   """Base Class for Post Init classes."""
@@ -139,25 +198,24 @@ class ServoV4PostInit(BasePostInit):
       vid_pid_list: List of tuple (vid, pid).
 
     Returns:
-      List of usb.core.Device objects.
+      List of usb_discovery.UsbDevice objects.
     """
     all_devices = []
     for vid, pid in vid_pid_list:
-      devs = usb.core.find(idVendor=vid, idProduct=pid, find_all=True)
-      if devs:
-        all_devices.extend(devs)
+      all_devices.extend(usb_discovery.find_devices(vid, pid))
     return all_devices
 
   def get_servo_v4_usb_device(self):
-    """Return associated servo v4 usb.core.Device object.
+    """Return associated servo v4 usb_discovery.UsbDevice object.
 
     Returns:
-      servo v4 usb.core.Device object associated with the servod instance.
+      servo v4 usb_discovery.UsbDevice object associated with the servod
+      instance.
     """
     servo_v4_candidates = self._get_all_usb_devices(
         servo_interfaces.SERVO_V4_DEFAULTS)
     for d in servo_v4_candidates:
-      d_serial = usb.util.get_string(d, 256, d.iSerialNumber)
+      d_serial = d.serial
       if (not self.servod._serialnames[self.servod.MAIN_SERIAL] or
           d_serial == self.servod._serialnames[self.servod.MAIN_SERIAL]):
         return d
@@ -167,7 +225,7 @@ class ServoV4PostInit(BasePostInit):
     """Return all servo micros detected.
 
     Returns:
-      List of servo micro devices as usb.core.Device objects.
+      List of servo micro devices as usb_discovery.UsbDevice objects.
     """
     return self._get_all_usb_devices(servo_interfaces.SERVO_MICRO_DEFAULTS)
 
@@ -175,7 +233,7 @@ class ServoV4PostInit(BasePostInit):
     """Return all CCD USB devices detected.
 
     Returns:
-      List of CCD USB devices as usb.core.Device objects.
+      List of CCD USB devices as usb_discovery.UsbDevice objects.
     """
     return self._get_all_usb_devices(servo_interfaces.CCD_DEFAULTS)
 
@@ -205,23 +263,23 @@ class ServoV4PostInit(BasePostInit):
     """Add the servo serial number.
 
     Args:
-      servo_usb: usb.core.Device object that represents the new detected
-          servo we should be checking against.
+      servo_usb: usb_discovery.UsbDevice object that represents the new
+          detected servo we should be checking against.
       servo_serial_key: Key to the servo serial dict.
     """
-    serial = usb.util.get_string(servo_usb, 256, servo_usb.iSerialNumber)
+    serial = servo_usb.serial
     self.servod._serialnames[servo_serial_key] = serial
 
   def init_servo_interfaces(self, servo_usb):
     """Initialize the new servo interfaces.
 
     Args:
-      servo_usb: usb.core.Device object that represents the new detected
-          servo we should be checking against.
+      servo_usb: usb_discovery.UsbDevice object that represents the new
+          detected servo we should be checking against.
     """
     vendor = servo_usb.idVendor
     product = servo_usb.idProduct
-    serial = usb.util.get_string(servo_usb, 256, servo_usb.iSerialNumber)
+    serial = servo_usb.serial
     servo_interface = servo_interfaces.INTERFACE_DEFAULTS[vendor][product]
 
     self.servod.init_servo_interfaces(vendor, product, serial,
@@ -10,12 +10,11 @@ import imp
 import logging
 import os
 import random
-import shutil
 import SimpleXMLRPCServer
 import subprocess
 import tempfile
+import threading
 import time
-import urllib
 
 # TODO(tbroch) deprecate use of relative imports
 from drv.hw_driver import HwDriverError
@@ -29,16 +28,26 @@ import ftdii2c
 import ftdi_common
 import ftdiuart
 import i2cbus
+import image_cache
+import image_writer
 import keyboard_handlers
 import servo_interfaces
 import servo_postinit
 import stm32gpio
 import stm32i2c
 import stm32uart
+import subscription
+import uevent
 
 
 MAX_I2C_CLOCK_HZ = 100000
 
+# Driver package and driver classes by driver name, shared by all Servod
+# objects of the process.
+_drv_pkg = None
+_drv_classes = {}
+_drv_classes_lock = threading.Lock()
+
 # It takes about 16-17 seconds for the entire probe usb device method,
 # let's wait double plus some buffer.
 _MAX_USB_LOCK_WAIT = 40
@@ -50,7 +59,6 @@ class Servod(object):
   """Main class for Servo debug/controller Daemon."""
   _USB_DETECTION_DELAY = 10
   _USB_POWEROFF_DELAY = 2
-  _HTTP_PREFIX = "http://"
   _USB_J3 = "usb_mux_sel1"
   _USB_J3_TO_SERVO = "servo_sees_usbkey"
   _USB_J3_TO_DUT = "dut_sees_usbkey"
@@ -163,6 +171,23 @@ class Servod(object):
     self._syscfg = config
     # Hold the last image path so we can reduce downloads to the usb device.
     self._image_path = None
+    try:
+      cache = image_cache.ImageCache()
+    except image_cache.ImageCacheError as e:
+      self._logger.warning('Recovery images will not be cached: %s', e)
+      cache = None
+    self._image_writer = image_writer.ImageWriter(cache=cache)
+    # Whether the USB stick holds what the image writer last recorded in its
+    # chunk manifest, i.e. it wasn't handed to the DUT since.
+    self._usbkey_manifest_valid = False
+    # Block device of the USB stick found by probe_host_usb_dev, valid until
+    # the stick is switched or the kernel reports block device changes.
+    self._usbkey_dev = ''
+    try:
+      self._usbkey_monitor = uevent.UeventMonitor(['block'])
+    except uevent.UeventError as e:
+      self._logger.info('USB stick probes will not be cached: %s', e)
+      self._usbkey_monitor = None
     # list of objects (Fi2c, Fgpio) to physical interfaces (gpio, i2c) that ftdi
     # interfaces are mapped to
     self._interface_list = []
@@ -172,6 +197,13 @@ class Servod(object):
     self._board = board
     self._version = version
     self._usbkm232 = usbkm232
+    # Serializes control accesses, as RPCs and subscription polling may be
+    # served from different threads.
+    self._lock = threading.RLock()
+    # Serializes the multi-step USB stick RPCs (probe, download, mount), which
+    # the threaded RPC server may otherwise run concurrently.
+    self._usbkey_lock = threading.RLock()
+    self._subscriptions = subscription.SubscriptionManager(self.get)
     # Seed the random generator with the serial to differentiate from other
     # servod processes.
     random.seed(serialname if serialname else time.time())
@@ -236,6 +268,31 @@ class Servod(object):
     for interface in self._interface_list:
       del(interface)
 
+  def close(self):
+    """Stop the threads of this servod and release its interfaces.
+
+    Needed when the process outlives the servod, e.g. when the supervisor
+    stops the servod of an unplugged servo.
+    """
+    self._subscriptions.stop()
+    if self._usbkey_monitor:
+      self._usbkey_monitor.close()
+      self._usbkey_monitor = None
+    with self._lock:
+      closed = set()
+      for interface in self._interface_list:
+        close = getattr(interface, 'close', None)
+        if not close or id(interface) in closed:
+          continue
+        closed.add(id(interface))
+        try:
+          close()
+        except NotImplementedError:
+          pass
+        except Exception as e:
+          self._logger.warning("Failed to close interface %s: %s",
+                               interface, e)
+
   def _init_ftdi_dummy(self, vendor, product, serialname, interface):
     """Dummy interface for ftdi devices.
 
@@ -509,6 +566,28 @@ class Servod(object):
         output = s
     return output
 
+  def _get_drv_class(self, drv_name):
+    """Get the class of a driver, loading the driver package only once.
+
+    Args:
+      drv_name: string name of driver module, e.g. 'ina2xx'
+
+    Returns:
+      driver class
+    """
+    global _drv_pkg
+    with _drv_classes_lock:
+      if drv_name not in _drv_classes:
+        if not _drv_pkg:
+          servo_pkg = imp.load_module('servo', *imp.find_module('servo'))
+          _drv_pkg = imp.load_module('drv',
+                                     *imp.find_module('drv',
+                                                      servo_pkg.__path__))
+        drv_module = getattr(_drv_pkg, drv_name)
+        _drv_classes[drv_name] = getattr(drv_module,
+                                         self._camel_case(drv_name))
+      return _drv_classes[drv_name]
+
   def _get_param_drv(self, control_name, is_get=True):
     """Get access to driver for a given control.
 
@@ -553,13 +632,7 @@ class Servod(object):
       index = int(interface_id) - 1
       interface = self._interface_list[index]
 
-    servo_pkg = imp.load_module('servo', *imp.find_module('servo'))
-    drv_pkg = imp.load_module('drv',
-                              *imp.find_module('drv', servo_pkg.__path__))
-    drv_name = params['drv']
-    drv_module = getattr(drv_pkg, drv_name)
-    drv_class = getattr(drv_module, self._camel_case(drv_name))
-    drv = drv_class(interface, params)
+    drv = self._get_drv_class(params['drv'])(interface, params)
     if control_name not in self._drv_dict:
       self._drv_dict[control_name] = {}
     if is_get:
@@ -708,9 +781,79 @@ class Servod(object):
       self._switch_usbkey(mux_direction)
     return ''
 
+  def _usbkey_visible(self):
+    """Return whether the USB stick is powered and muxed to the host."""
+    return (self.get(self._USB_J3) == self._USB_J3_TO_SERVO and
+            self.get(self._USB_J3_PWR) == self._USB_J3_PWR_ON)
+
+  def _probe_usbkey_sysfs(self):
+    """Find the USB stick from the sysfs topology, without touching it.
+
+    The USB stick port sits on the same hub as the servo USB device, so the
+    stick is the one disk behind that hub.  Only meaningful while the stick is
+    visible to the host, and if no other servo is behind the hub: the hub may
+    then be a host hub, with the sticks of the other servos behind it too.
+
+    Returns:
+      USB disk path if one and only one disk is behind the servo hub, and the
+      servo is the only one behind it, otherwise an empty string.
+    """
+    try:
+      hierarchy = servo_postinit.UsbHierarchy()
+      usb_path = hierarchy.get_usb_path(self._vendor, self._product,
+                                        self._serialnames[self.MAIN_SERIAL])
+      if not usb_path:
+        return ''
+      hub_path = hierarchy.get_parent_hub_path(usb_path)
+      servo_paths = hierarchy.get_servo_paths(hub_path)
+      if servo_paths != [usb_path]:
+        self._logger.debug('Servos behind the servo hub: %s', servo_paths)
+        return ''
+      devices = hierarchy.get_block_devices(hub_path)
+    except OSError as e:
+      self._logger.debug('Failed to walk sysfs: %s', e)
+      return ''
+    self._logger.debug('Disks behind the servo hub: %s', devices)
+    if len(devices) == 1:
+      return devices[0]
+    return ''
+
   def probe_host_usb_dev(self, timeout=_MAX_USB_LOCK_WAIT):
     """Probe the USB disk device plugged in the servo from the host side.
 
+    While the stick is visible to the host, it is found from the sysfs USB
+    topology.  Otherwise, or if that is ambiguous, it is found by
+    power-cycling it and looking for the disk which appears, see
+    _probe_usbkey_power_cycle().  The result is cached until the stick is
+    switched or the kernel reports a block device change.
+
+    Args:
+      timeout: Timeout to wait for blocking other servod processes.
+
+    Returns:
+      USB disk path if one and only one USB disk path is found, otherwise an
+      empty string.
+    """
+    with self._usbkey_lock:
+      if (self._usbkey_dev and self._usbkey_monitor and
+          not self._usbkey_monitor.changed() and
+          os.path.exists(self._usbkey_dev)):
+        return self._usbkey_dev
+      self._usbkey_dev = ''
+      visible = self._usbkey_visible()
+      usb_dev = self._probe_usbkey_sysfs() if visible else ''
+      if not usb_dev:
+        self._logger.info('Power-cycling the USB stick to find it')
+        usb_dev = self._probe_usbkey_power_cycle(timeout)
+      if visible and self._usbkey_monitor:
+        # Forget the events of our own probing.
+        self._usbkey_monitor.changed()
+        self._usbkey_dev = usb_dev
+      return usb_dev
+
+  def _probe_usbkey_power_cycle(self, timeout):
+    """Probe the USB disk device by power-cycling it.
+
     Method can fail by:
     1) Having multiple servos connected and returning incorrect /dev/sdX of
        another servo unless _USB_LOCK_FILE exists on the servo host.  If that
@@ -731,6 +874,9 @@ class Servod(object):
 
       original_value = self.get(self._USB_J3)
       original_usb_power = self.get(self._USB_J3_PWR)
+      # The DUT only sees the stick for the short power-cycled probe window
+      # below, not long enough to have used it.
+      manifest_valid = self._usbkey_manifest_valid
       # Make the host unable to see the USB disk.
       if (original_usb_power == self._USB_J3_PWR_ON and
           original_value != self._USB_J3_TO_DUT):
@@ -747,6 +893,8 @@ class Servod(object):
       if original_usb_power != self._USB_J3_PWR_ON:
         self.set(self._USB_J3_PWR, self._USB_J3_PWR_OFF)
         time.sleep(self._USB_POWEROFF_DELAY)
+      if original_value != self._USB_J3_TO_DUT:
+        self._usbkey_manifest_valid = manifest_valid
 
       # Subtract the two sets to find the usb device.
       diff_set = has_usb_set - no_usb_set
@@ -755,14 +903,23 @@ class Servod(object):
       else:
         return ''
 
-  def download_image_to_usb(self, image_path, probe_timeout=_MAX_USB_LOCK_WAIT):
+  def download_image_to_usb(self, image_path, probe_timeout=_MAX_USB_LOCK_WAIT,
+                            delta=True):
     """Download image and save to the USB device found by probe_host_usb_dev.
     If the image_path is a URL, it will download this url to the USB path;
     otherwise it will simply copy the image_path's contents to the USB path.
+    Images compressed with gzip, xz or bzip2, and compressed tarballs of a .bin
+    image, are decompressed on the fly.
+
+    In delta mode, only the chunks of the image differing from what the USB
+    device holds are written.  They are found from the chunk manifest saved by
+    the last transfer if the stick wasn't handed to the DUT since, otherwise
+    by reading the device back.
 
     Args:
       image_path: path or url to the recovery image.
       probe_timeout: timeout for the probe to take.
+      delta: if True, skip writing chunks already on the USB device.
 
     Returns:
       True|False: True if process completed successfully, False if error
@@ -770,46 +927,56 @@ class Servod(object):
       Can't return None because XMLRPC doesn't allow it. PTAL at tbroch's
       comment at the end of set().
     """
-    self._logger.debug("image_path(%s)" % image_path)
-    self._logger.debug("Detecting USB stick device...")
-    usb_dev = self.probe_host_usb_dev(timeout=probe_timeout)
-    if not usb_dev:
-      self._logger.error("No usb device connected to servo")
-      return False
-
-    # Let's check if we downloaded this last time and if so assume the image is
-    # still on the usb device and return True.
-    if self._image_path == image_path:
-      self._logger.debug("Image already on USB device, skipping transfer")
+    with self._usbkey_lock:
+      self._logger.debug("image_path(%s)" % image_path)
+      self._logger.debug("Detecting USB stick device...")
+      usb_dev = self.probe_host_usb_dev(timeout=probe_timeout)
+      if not usb_dev:
+        self._logger.error("No usb device connected to servo")
+        return False
+
+      # Let's check if we downloaded this last time and if so assume the image
+      # is still on the usb device and return True.
+      if self._image_path == image_path:
+        self._logger.debug("Image already on USB device, skipping transfer")
+        return True
+
+      # Forget the last image until the new one is fully written.
+      self._image_path = None
+      trust_manifest = self._usbkey_manifest_valid
+      self._usbkey_manifest_valid = False
+      try:
+        self._image_writer.write(image_path, usb_dev, delta=delta,
+                                 trust_manifest=trust_manifest)
+      except image_writer.ImageWriterError as e:
+        self._logger.error("Failed to transfer image to USB device: %s", e)
+        return False
+      except BaseException as e:
+        self._logger.error("Unexpected exception downloading %s to %s: %s",
+                           image_path, usb_dev, str(e))
+        return False
+      finally:
+        # We just plastered the partition table for a block device.
+        # Pass or fail, we mustn't go without telling the kernel about
+        # the change, or it will punish us with sporadic, hard-to-debug
+        # failures.  The writer already flushed the device itself.
+        subprocess.call(["blockdev", "--rereadpt", usb_dev])
+      self._image_path = image_path
+      self._usbkey_manifest_valid = delta
       return True
 
-    try:
-      if image_path.startswith(self._HTTP_PREFIX):
-        self._logger.debug("Image path is a URL, downloading image")
-        urllib.urlretrieve(image_path, usb_dev)
-      else:
-        shutil.copyfile(image_path, usb_dev)
-    except IOError as e:
-      self._logger.error("Failed to transfer image to USB device: %s ( %s ) ",
-                         e.strerror, e.errno)
-      return False
-    except urllib.ContentTooShortError:
-      self._logger.error("Failed to download URL: %s to USB device: %s",
-                         image_path, usb_dev)
-      return False
-    except BaseException as e:
-      self._logger.error("Unexpected exception downloading %s to %s: %s",
-                         image_path, usb_dev, str(e))
-      return False
-    finally:
-      # We just plastered the partition table for a block device.
-      # Pass or fail, we mustn't go without telling the kernel about
-      # the change, or it will punish us with sporadic, hard-to-debug
-      # failures.
-      subprocess.call(["sync"])
-      subprocess.call(["blockdev", "--rereadpt", usb_dev])
-    self._image_path = image_path
-    return True
+  def get_image_write_progress(self):
+    """Report the progress of the current or last download_image_to_usb.
+
+    Returns:
+      dict with 'state' (idle, writing, syncing, done or failed),
+      'image_path', 'device', 'total_bytes' (if known), 'compression' (if
+      compressed), 'bytes_read', 'bytes_decompressed' (if compressed),
+      'bytes_written', 'bytes_skipped', 'elapsed_secs', 'read_mb_per_sec',
+      'decompress_mb_per_sec' (if compressed), 'mb_per_sec' and 'error' (if
+      failed).
+    """
+    return self._image_writer.get_progress()
 
   def make_image_noninteractive(self):
     """Makes the recovery image noninteractive.
@@ -825,58 +992,145 @@ class Servod(object):
       True|False: True if process completed successfully, False if error
                   occurred.
     """
-    result = True
-    usb_dev = self.probe_host_usb_dev()
-    if not usb_dev:
-      self._logger.error("No usb device connected to servo")
-      return False
-    # Create TempDirectory
-    tmpdir = tempfile.mkdtemp()
-    if tmpdir:
-      # Mount drive to tmpdir.
-      partition_1 = "%s1" % usb_dev
-      rc = subprocess.call(["mount", partition_1, tmpdir])
-      if rc == 0:
-        # Create file 'non_interactive'
-        non_interactive_file = os.path.join(tmpdir, "non_interactive")
-        try:
-          open(non_interactive_file, "w").close()
-        except IOError as e:
-          self._logger.error("Failed to create file %s : %s ( %d )",
-                             non_interactive_file, e.strerror, e.errno)
+    with self._usbkey_lock:
+      result = True
+      usb_dev = self.probe_host_usb_dev()
+      if not usb_dev:
+        self._logger.error("No usb device connected to servo")
+        return False
+      # Mounting writes to the stick behind the back of the chunk manifest.
+      self._usbkey_manifest_valid = False
+      # Create TempDirectory
+      tmpdir = tempfile.mkdtemp()
+      if tmpdir:
+        # Mount drive to tmpdir.
+        partition_1 = "%s1" % usb_dev
+        rc = subprocess.call(["mount", partition_1, tmpdir])
+        if rc == 0:
+          # Create file 'non_interactive'
+          non_interactive_file = os.path.join(tmpdir, "non_interactive")
+          try:
+            open(non_interactive_file, "w").close()
+          except IOError as e:
+            self._logger.error("Failed to create file %s : %s ( %d )",
+                               non_interactive_file, e.strerror, e.errno)
+            result = False
+          except BaseException as e:
+            self._logger.error("Unexpected Exception creating file %s : %s",
+                               non_interactive_file, str(e))
+            result = False
+          # Unmount drive regardless if file creation worked or not.
+          rc = subprocess.call(["umount", partition_1])
+          if rc != 0:
+            self._logger.error("Failed to unmount USB Device")
+            result = False
+        else:
+          self._logger.error("Failed to mount USB Device")
           result = False
+
+        # Delete tmpdir. May throw exception if 'umount' failed.
+        try:
+          os.rmdir(tmpdir)
+        except OSError as e:
+          self._logger.error("Failed to remove temp directory %s : %s",
+                             tmpdir, str(e))
+          return False
         except BaseException as e:
-          self._logger.error("Unexpected Exception creating file %s : %s",
-                             non_interactive_file, str(e))
-          result = False
-        # Unmount drive regardless if file creation worked or not.
-        rc = subprocess.call(["umount", partition_1])
-        if rc != 0:
-          self._logger.error("Failed to unmount USB Device")
-          result = False
+          self._logger.error("Unexpected Exception removing tempdir %s : %s",
+                             tmpdir, str(e))
+          return False
       else:
-        self._logger.error("Failed to mount USB Device")
-        result = False
+        self._logger.error("Failed to create temp directory.")
+        return False
+      return result
+
+  def _get_gpio_batch(self, cmds, sets=False):
+    """Find the gpio controls at the beginning of cmds accessible at once.
+
+    Controls qualify if they use the gpio driver itself on the same interface
+    and the interface can access several gpios at once.  A control sharing
+    bits with a control already in the batch ends it, as the batch would
+    apply only the last of their sets.  Sets can't follow gets as they would
+    be applied before the gets are read.
+
+    Args:
+      cmds: list of control[:value] to get or set.
+      sets: boolean, whether sets may be batched.  They then take effect
+          together, ignoring the order of the controls in cmds.
 
-      # Delete tmpdir. May throw exception if 'umount' failed.
+    Returns:
+      tuple (batch, fields_func) where:
+        batch: list of (name, value, params, drv) tuples, value being None
+            for gets.
+        fields_func: function accessing the fields of the batch controls, see
+            drv.gpio.gpio.get_fields_func.
+    """
+    gpio_class = self._get_drv_class('gpio')
+    batch = []
+    fields_func = None
+    batch_mask = 0
+    for cmd in cmds:
+      if ':' in cmd:
+        (name, value) = cmd.split(':')
+        if not sets or any(entry[1] is None for entry in batch):
+          break
+      else:
+        (name, value) = (cmd, None)
+      if name == 'serialname':
+        break
       try:
-        os.rmdir(tmpdir)
-      except OSError as e:
-        self._logger.error("Failed to remove temp directory %s : %s",
-                           tmpdir, str(e))
-        return False
-      except BaseException as e:
-        self._logger.error("Unexpected Exception removing tempdir %s : %s",
-                           tmpdir, str(e))
-        return False
-    else:
-      self._logger.error("Failed to create temp directory.")
-      return False
-    return result
+        (params, drv) = self._get_param_drv(name, value is None)
+      except (NameError, ServodError):
+        # Reported when the control is accessed on its own.
+        break
+      if type(drv) is not gpio_class or 'subtype' in params:
+        break
+      func = drv.get_fields_func()
+      if func is None or (fields_func is not None and func != fields_func):
+        break
+      (offset, width, _, _) = drv.field()
+      mask = ((1 << width) - 1) << offset
+      if batch_mask & mask:
+        break
+      batch_mask |= mask
+      fields_func = func
+      batch.append((name, value, params, drv))
+    return batch, fields_func
+
+  def _set_get_gpio_batch(self, batch, fields_func):
+    """Set &| get gpio controls in one transaction of their interface.
+
+    Args:
+      batch: see _get_gpio_batch.
+      fields_func: see _get_gpio_batch.
+
+    Returns:
+      list of responses, as returned by the get or set methods.
+    """
+    fields = []
+    for name, value, params, drv in batch:
+      if value is None:
+        fields.append(drv.field())
+      else:
+        self._before_set(name, value)
+        fields.append(drv.field(self._syscfg.resolve_val(params, value)))
+    self._logger.debug("gpio batch %s", [entry[0] for entry in batch])
+    values = fields_func(fields)
+    rv = []
+    for (name, value, params, drv), val in zip(batch, values):
+      if value is None:
+        rv.append(self._syscfg.reformat_val(params, val))
+      else:
+        rv.append(True)
+    return rv
 
   def set_get_all(self, cmds):
     """Set &| get one or more control values.
 
+    Controls are accessed in order.  Consecutive gpio gets of an interface
+    able to access several gpios at once read its pins once.  See
+    set_get_atomic to set several gpios together.
+
     Args:
       cmds: list of control[:value] to get or set.
 
@@ -884,7 +1138,16 @@ class Servod(object):
       rv: list of responses from calling get or set methods.
     """
     rv = []
-    for cmd in cmds:
+    i = 0
+    while i < len(cmds):
+      with self._lock:
+        (batch, fields_func) = self._get_gpio_batch(cmds[i:])
+        if len(batch) > 1:
+          rv.extend(self._set_get_gpio_batch(batch, fields_func))
+          i += len(batch)
+          continue
+      cmd = cmds[i]
+      i += 1
       if ':' in cmd:
         (control, value) = cmd.split(':')
         rv.append(self.set(control, value))
@@ -892,6 +1155,30 @@ class Servod(object):
         rv.append(self.get(cmd))
     return rv
 
+  def set_get_atomic(self, cmds):
+    """Set &| get gpio controls in one transaction of their interface.
+
+    Sets take effect together, without glitches between them, then gets read
+    the pins once.  Unlike set_get_all, the order of the sets is lost.
+
+    Args:
+      cmds: list of control[:value] to get or set.  Gpio controls of one
+          interface able to access several gpios at once, with sets before
+          gets and no two controls sharing bits.
+
+    Returns:
+      rv: list of responses from calling get or set methods.
+
+    Raises:
+      ServodError: if cmds can't be accessed in one transaction.
+    """
+    with self._lock:
+      (batch, fields_func) = self._get_gpio_batch(cmds, sets=True)
+      if not cmds or len(batch) != len(cmds):
+        raise ServodError("Can't access %s in one transaction" %
+                          cmds[len(batch):])
+      return self._set_get_gpio_batch(batch, fields_func)
+
   def get(self, name):
     """Get control value.
 
@@ -910,18 +1197,40 @@ class Servod(object):
       if self._serialnames[self.MAIN_SERIAL]:
         return self._serialnames[self.MAIN_SERIAL]
       return 'unknown'
-    (param, drv) = self._get_param_drv(name)
-    try:
-      val = drv.get()
-      rd_val = self._syscfg.reformat_val(param, val)
-      self._logger.debug("%s = %s" % (name, rd_val))
-      return rd_val
-    except AttributeError, error:
-      self._logger.error("Getting %s: %s" % (name, error))
-      raise
-    except HwDriverError:
-      self._logger.error("Getting %s" % (name))
-      raise
+    with self._lock:
+      (param, drv) = self._get_param_drv(name)
+      try:
+        val = drv.get()
+        rd_val = self._syscfg.reformat_val(param, val)
+        self._logger.debug("%s = %s" % (name, rd_val))
+        return rd_val
+      except AttributeError, error:
+        self._logger.error("Getting %s: %s" % (name, error))
+        raise
+      except HwDriverError:
+        self._logger.error("Getting %s" % (name))
+        raise
+
+  @contextlib.contextmanager
+  def _gpio_snapshot(self):
+    """Read the pins of each gpio interface at most once in the context.
+
+    The controls of an interface sharing its port, the first control accessed
+    reads the port and the others reuse that read, their writes being
+    reflected in it.  The lock is held so that no other request sees the
+    snapshot.  Contexts with delays (e.g. sleep controls) must not use it, as
+    input pins would not be read again after the delays.
+    """
+    with self._lock:
+      interfaces = [interface for interface in self._interface_list
+                    if hasattr(interface, 'begin_snapshot')]
+      for interface in interfaces:
+        interface.begin_snapshot()
+      try:
+        yield
+      finally:
+        for interface in interfaces:
+          interface.end_snapshot()
 
   def get_all(self, verbose):
     """Get all controls values.
@@ -934,19 +1243,28 @@ class Servod(object):
       error attempting access to control, response is 'ERR'.
     """
     rsp = []
-    for name in self._syscfg.syscfg_dict['control']:
-      self._logger.debug("name = %s" %name)
-      try:
-        value = self.get(name)
-      except Exception:
-        value = "ERR"
-        pass
-      if verbose:
-        rsp.append("GET %s = %s :: %s" % (name, value, self.doc(name)))
-      else:
-        rsp.append("%s:%s" % (name, value))
+    with self._gpio_snapshot():
+      for name in self._syscfg.syscfg_dict['control']:
+        self._logger.debug("name = %s" %name)
+        try:
+          value = self.get(name)
+        except Exception:
+          value = "ERR"
+          pass
+        if verbose:
+          rsp.append("GET %s = %s :: %s" % (name, value, self.doc(name)))
+        else:
+          rsp.append("%s:%s" % (name, value))
     return '\n'.join(sorted(rsp))
 
+  def _before_set(self, name, wr_val_str):
+    """Invalidate what setting a control makes stale."""
+    if name == self._USB_J3 and wr_val_str == self._USB_J3_TO_DUT:
+      # The DUT may write to the USB stick from now on.
+      self._usbkey_manifest_valid = False
+    if name in (self._USB_J3, self._USB_J3_PWR):
+      self._usbkey_dev = ''
+
   def set(self, name, wr_val_str):
     """Set control.
 
@@ -959,18 +1277,87 @@ class Servod(object):
       HwDriverError: Error occurred while using driver
     """
     self._logger.debug("name(%s) wr_val(%s)" % (name, wr_val_str))
-    (params, drv) = self._get_param_drv(name, False)
-    wr_val = self._syscfg.resolve_val(params, wr_val_str)
-    try:
-      drv.set(wr_val)
-    except HwDriverError:
-      self._logger.error("Setting %s -> %s" % (name, wr_val_str))
-      raise
+    self._before_set(name, wr_val_str)
+    with self._lock:
+      (params, drv) = self._get_param_drv(name, False)
+      wr_val = self._syscfg.resolve_val(params, wr_val_str)
+      try:
+        drv.set(wr_val)
+      except HwDriverError:
+        self._logger.error("Setting %s -> %s" % (name, wr_val_str))
+        raise
     # TODO(tbroch) Figure out why despite allow_none=True for both xmlrpc server
     # & client I still have to return something to appease the
     # marshall/unmarshall
     return True
 
+  def subscribe(self, controls, interval_secs=0.1,
+                predicate=subscription.PREDICATE_CHANGE, threshold=None):
+    """Have servod poll controls and queue their changes for the client.
+
+    Use wait_subscription() to receive the changes instead of calling get() in
+    a loop.
+
+    Args:
+      controls: list of control names to poll.
+      interval_secs: seconds between two polls of the controls.
+      predicate: 'change' to queue the first value and every change of a
+          control, or 'above', 'below' or 'equal' to queue a value each time
+          it starts satisfying the comparison against threshold.
+      threshold: value compared against for predicates other than 'change'.
+
+    Returns:
+      integer id of the subscription.
+
+    Raises:
+      NameError: if fails to locate a control.
+      ServodError: invalid arguments.
+    """
+    for name in controls:
+      if name != 'serialname' and not self._syscfg.is_control(name):
+        raise NameError("No control %s" % name)
+    try:
+      return self._subscriptions.subscribe(controls, interval_secs, predicate,
+                                           threshold)
+    except subscription.SubscriptionError as e:
+      raise ServodError(str(e))
+
+  def wait_subscription(self, sub_id, timeout_secs=10):
+    """Long-poll the changes queued for a subscription.
+
+    Subscriptions not waited on for subscription.LEASE_SECS are dropped.
+
+    Args:
+      sub_id: id returned by subscribe().
+      timeout_secs: maximum seconds to wait for a change.
+
+    Returns:
+      list of [control, value, timestamp] changes, oldest first. Empty if none
+      occurred before timeout_secs.
+
+    Raises:
+      ServodError: unknown subscription.
+    """
+    try:
+      return self._subscriptions.wait(sub_id, timeout_secs)
+    except subscription.SubscriptionError as e:
+      raise ServodError(str(e))
+
+  def unsubscribe(self, sub_id):
+    """Stop polling the controls of a subscription.
+
+    Args:
+      sub_id: id returned by subscribe().
+
+    Raises:
+      ServodError: unknown subscription.
+    """
+    try:
+      self._subscriptions.unsubscribe(sub_id)
+    except subscription.SubscriptionError as e:
+      raise ServodError(str(e))
+    return True
+
   def hwinit(self, verbose=False):
     """Initialize all controls.
 
@@ -991,17 +1378,18 @@ class Servod(object):
       something unless transferring 'none' across is allowed. Hence adding a
       dummy return value to make things simpler.
     """
-    for control_name, value in self._syscfg.hwinit:
-      try:
-        # Workaround for bug chrome-os-partner:42349. Without this check, the
-        # gpio will briefly pulse low if we set it from high to high.
-        if self.get(control_name) != value:
-          self.set(control_name, value)
-        if verbose:
-          self._logger.info('Initialized %s to %s', control_name, value)
-      except Exception as e:
-        self._logger.error("Problem initializing %s -> %s :: %s",
-                           control_name, value, str(e))
+    with self._gpio_snapshot():
+      for control_name, value in self._syscfg.hwinit:
+        try:
+          # Workaround for bug chrome-os-partner:42349. Without this check, the
+          # gpio will briefly pulse low if we set it from high to high.
+          if self.get(control_name) != value:
+            self.set(control_name, value)
+          if verbose:
+            self._logger.info('Initialized %s to %s', control_name, value)
+        except Exception as e:
+          self._logger.error("Problem initializing %s -> %s :: %s",
+                             control_name, value, str(e))
 
     # Init keyboard after all the intefaces are up.
     self._keyboard = self._init_keyboard_handler(self, self._board)
@@ -0,0 +1,144 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the batching of gpio controls by Servod."""
+import logging
+import threading
+import unittest
+
+import ftdi_common
+import servo_server
+
+
+class FakeInterface(object):
+  """Gpio interface counting its transactions."""
+
+  def __init__(self):
+    self.port = 0
+    self.transactions = 0
+
+  def wr_rd_fields(self, fields):
+    self.transactions += 1
+    gpio = ftdi_common.Gpio()
+    if ftdi_common.merge_gpio_fields(gpio, fields):
+      self.port = (self.port & ~gpio.mask) | (gpio.value & gpio.mask)
+    return [(self.port >> offset) & ((1 << width) - 1)
+            for offset, width, _, _ in fields]
+
+
+class FakeGpio(object):
+  """Gpio driver of a control at offset of an interface."""
+
+  def __init__(self, interface, offset, width=1):
+    self._interface = interface
+    self._offset = offset
+    self._width = width
+
+  def get(self):
+    return self._interface.wr_rd_fields([self.field()])[0]
+
+  def set(self, value):
+    self._interface.wr_rd_fields([self.field(value)])
+
+  def get_fields_func(self):
+    return self._interface.wr_rd_fields
+
+  def field(self, value=None):
+    if value is None:
+      return (self._offset, self._width, None, None)
+    return (self._offset, self._width, 1, value)
+
+
+class FakeSysCfg(object):
+  """Syscfg with integer control values."""
+
+  def resolve_val(self, params, value):
+    return int(value)
+
+  def reformat_val(self, params, value):
+    return value
+
+
+class TestMergeGpioFields(unittest.TestCase):
+
+  def test_read_only(self):
+    gpio = ftdi_common.Gpio()
+    self.assertFalse(ftdi_common.merge_gpio_fields(gpio, [(0, 1, None, None)]))
+    self.assertEqual(gpio.mask, 0)
+
+  def test_later_fields_override(self):
+    gpio = ftdi_common.Gpio()
+    self.assertTrue(ftdi_common.merge_gpio_fields(
+        gpio, [(0, 2, 1, 3), (1, 1, 0, 0), (4, 1, None, None)]))
+    self.assertEqual(gpio.mask, 0x3)
+    self.assertEqual(gpio.direction, 0x1)
+    self.assertEqual(gpio.value, 0x1)
+
+
+class TestGpioBatch(unittest.TestCase):
+
+  def setUp(self):
+    self._interface = FakeInterface()
+    other = FakeInterface()
+    self._drvs = {
+        'a': FakeGpio(self._interface, 0),
+        'b': FakeGpio(self._interface, 1),
+        'ab': FakeGpio(self._interface, 0, 2),
+        'other': FakeGpio(other, 2),
+    }
+    self._servod = object.__new__(servo_server.Servod)
+    self._servod._logger = logging.getLogger('Servod')
+    self._servod._lock = threading.RLock()
+    self._servod._syscfg = FakeSysCfg()
+    self._servod._get_drv_class = lambda name: FakeGpio
+    self._servod._get_param_drv = lambda name, is_get=True: (
+        {}, self._drvs[name])
+    self._servod._before_set = lambda name, value: None
+    self._servod.set = self._set
+    self._servod.get = lambda name: self._drvs[name].get()
+
+  def _set(self, name, value):
+    self._drvs[name].set(int(value))
+    return True
+
+  def _batch_names(self, cmds, sets=False):
+    (batch, _) = self._servod._get_gpio_batch(cmds, sets)
+    return [entry[0] for entry in batch]
+
+  def test_gets(self):
+    self.assertEqual(self._batch_names(['a', 'b', 'other']), ['a', 'b'])
+
+  def test_sets_only_when_asked(self):
+    self.assertEqual(self._batch_names(['a:1', 'b:1']), [])
+    self.assertEqual(self._batch_names(['a:1', 'b:1'], True), ['a', 'b'])
+
+  def test_set_after_get(self):
+    self.assertEqual(self._batch_names(['a', 'b:1'], True), ['a'])
+
+  def test_shared_bits(self):
+    self.assertEqual(self._batch_names(['a:1', 'a:0'], True), ['a'])
+    self.assertEqual(self._batch_names(['b:1', 'ab:0'], True), ['b'])
+    self.assertEqual(self._batch_names(['a', 'a']), ['a'])
+
+  def test_set_get_all_in_order(self):
+    self.assertEqual(self._servod.set_get_all(['a:1', 'a:0', 'a', 'b']),
+                     [True, True, 0, 0])
+    # Two sets, then one transaction for both gets.
+    self.assertEqual(self._interface.transactions, 3)
+
+  def test_set_get_atomic(self):
+    self.assertEqual(self._servod.set_get_atomic(['a:1', 'b:1']),
+                     [True, True])
+    self.assertEqual(self._interface.port, 3)
+    self.assertEqual(self._interface.transactions, 1)
+
+  def test_set_get_atomic_error(self):
+    self.assertRaises(servo_server.ServodError, self._servod.set_get_atomic,
+                      ['a:1', 'a:0'])
+    self.assertRaises(servo_server.ServodError, self._servod.set_get_atomic,
+                      ['a:1', 'other:1'])
+    self.assertEqual(self._interface.transactions, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -12,22 +12,24 @@ import pkg_resources
 import select
 import SimpleXMLRPCServer
 import socket
+import SocketServer
 import sys
-import usb
+import threading
 
+import binrpc
 import drv.loglevel
 import ftdi_common
 import multiservo
 import servo_interfaces
 import servo_server
+import supervisor
 import system_config
 import terminal_freezer
+import usb_discovery
 
 
 VERSION = pkg_resources.require('servo')[0].version
 
-MAX_ISERIAL_STR = 128
-
 # If user does not specify a port to use, try ports in this range. Traverse
 # the range from high to low addresses to maintain backwards compatibility
 # (the first checked default port is 9999, the range is such that all possible
@@ -63,6 +65,141 @@ class ServodError(Exception):
   """Exception class for servod server."""
 
 
+class ServodRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+  """XMLRPC request handler keeping connections open between requests.
+
+  HTTP/1.1 lets clients (see client.KeepAliveTransport) reuse their
+  connection instead of connecting for every call.  Connections opened by
+  binary protocol clients (see binrpc) are served by binrpc instead.
+  """
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  # Seconds an idle connection is kept, so gone clients don't pin threads.
+  timeout = 600
+
+  def handle(self):
+    if not binrpc.is_binrpc(self.connection):
+      SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle(self)
+      return
+    try:
+      binrpc.serve_connection(self.rfile, self.connection,
+                              self.server._dispatch)
+    except (binrpc.BinaryRPCError, socket.error) as e:
+      self.log_error('Binary RPC connection closed: %s', e)
+
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn,
+                           SimpleXMLRPCServer.SimpleXMLRPCServer):
+  """Threaded SimpleXMLRPCServer.
+
+  Long-polling clients (see Servod.wait_subscription) must not block others.
+  Servod serializes control accesses itself.
+  """
+  daemon_threads = True
+
+  def __init__(self, addr, requestHandler=ServodRequestHandler, **kwargs):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(
+        self, addr, requestHandler=requestHandler, **kwargs)
+    self._unix_server = None
+    self._unix_thread = None
+
+  def add_unix_socket(self, logger, path):
+    """Also serve local clients on a Unix domain socket.
+
+    Failures are only logged, TCP still works.
+
+    Args:
+      logger: a logging instance used by this servod driver
+      path: path of the socket
+    """
+    try:
+      self._unix_server = UnixXMLRPCServer(path, self)
+      logger.info("Listening on %s", path)
+    except (OSError, socket.error) as e:
+      logger.warning("Not listening on %s: %s", path, e)
+
+  def serve_forever(self, poll_interval=0.5):
+    if self._unix_server:
+      self._unix_thread = threading.Thread(
+          target=self._unix_server.serve_forever, name='unix_server')
+      self._unix_thread.daemon = True
+      self._unix_thread.start()
+    SimpleXMLRPCServer.SimpleXMLRPCServer.serve_forever(self, poll_interval)
+
+  def shutdown(self):
+    if self._unix_thread:
+      self._unix_server.shutdown()
+    SimpleXMLRPCServer.SimpleXMLRPCServer.shutdown(self)
+
+  def server_close(self):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.server_close(self)
+    if self._unix_server:
+      self._unix_server.server_close()
+
+
+class UnixRequestHandler(ServodRequestHandler):
+  """ServodRequestHandler for Unix domain socket connections."""
+  disable_nagle_algorithm = False
+
+  def address_string(self):
+    return 'unix'
+
+
+class UnixXMLRPCServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+  """Serves XMLRPC requests from a Unix domain socket.
+
+  Local clients skip the TCP/IP stack.  Requests are dispatched to the
+  functions registered on a ThreadedXMLRPCServer.
+  """
+  daemon_threads = True
+  logRequests = False
+
+  def __init__(self, path, dispatcher):
+    """Constructor.
+
+    Args:
+      path: path of the socket.  A stale socket left by a dead servod is
+          replaced.
+      dispatcher: SimpleXMLRPCServer the requests are dispatched to.
+
+    Raises:
+      socket.error: if another servod listens on path.
+      OSError: if the socket directory can't be trusted, see
+          multiservo.make_socket_dir.
+    """
+    self._dispatcher = dispatcher
+    multiservo.make_socket_dir()
+    if os.path.exists(path):
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        probe.connect(path)
+        raise socket.error(errno.EADDRINUSE, 'Socket in use')
+      except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+          raise
+        os.remove(path)
+      finally:
+        probe.close()
+    SocketServer.UnixStreamServer.__init__(self, path, UnixRequestHandler)
+    # Local clients of any user may use TCP anyways.  Only the directory
+    # needs protecting, against other users planting a socket.
+    os.chmod(path, 0666)
+
+  def _marshaled_dispatch(self, *args, **kwargs):
+    return self._dispatcher._marshaled_dispatch(*args, **kwargs)
+
+  def _dispatch(self, method, params):
+    return self._dispatcher._dispatch(method, params)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    try:
+      os.remove(self.server_address)
+    except OSError:
+      pass
+
+
 # TODO(tbroch) merge w/ parse_common_args properly
 def _parse_args():
   """Parse commandline arguments.
@@ -121,57 +258,14 @@ def _parse_args():
                     "have built in keyboards. Used in FAFT tests. "
                     "(Optional), e.g. /dev/ttyUSB0")
 
+  parser.add_option("--supervisor", action="store_true", default=False,
+                    help="serve all servos of the rc file from this process, "
+                    "starting and stopping their servods as they are "
+                    "plugged and unplugged")
   multiservo.add_multiservo_parser_options(parser)
   parser.set_usage(parser.get_usage() + examples)
   return parser.parse_args()
 
-def usb_get_iserial(device):
-  """Get USB device's iSerial string
-
-  Args:
-    device: usb.Device object
-
-  Returns:
-    iserial: USB devices iSerial string or empty string if the device has
-             no serial number.
-  """
-  device_handle = device.open()
-  # The device has no serial number string descriptor.
-  if device.iSerialNumber == 0:
-    return ""
-  iserial = ""
-  try:
-    iserial = device_handle.getString(device.iSerialNumber, MAX_ISERIAL_STR)
-  except usb.USBError, e:
-    # TODO(tbroch) other non-FTDI devices on my host cause following msg
-    #   usb.USBError: error sending control message: Broken pipe
-    # Need to investigate further
-    pass
-  return iserial
-
-def usb_find(vendor, product, serialname):
-  """Find USB devices based on vendor, product and serial identifiers.
-
-  Locates all USB devices that match the criteria of the arguments.  In the
-  case where input arguments are 'None' that argument is a don't care
-
-  Args:
-    vendor: USB vendor id (integer)
-    product: USB product id (integer)
-    serial: USB serial id (string)
-
-  Returns:
-    matched_devices : list of pyusb devices matching input args
-  """
-  matched_devices = []
-  for bus in usb.busses():
-    for device in bus.devices:
-      if (not vendor or device.idVendor == vendor) and \
-            (not product or device.idProduct == product) and \
-            (not serialname or usb_get_iserial(device).endswith(serialname)):
-        matched_devices.append(device)
-  return matched_devices
-
 def find_servod_match(logger, options, all_servos, servodrc):
   """Find a servo matching one of servodrc lines
 
@@ -200,7 +294,7 @@ def find_servod_match(logger, options, all_servos, servodrc):
 
   for servo in all_servos:
     logger.info("Found servo, vid: 0x%04x pid: 0x%04x sid: %s", servo.idVendor,
-                servo.idProduct, usb_get_iserial(servo))
+                servo.idProduct, servo.serial)
 
   # If user specified servod name in the command line - match it to the serial
   # number.
@@ -223,7 +317,7 @@ def find_servod_match(logger, options, all_servos, servodrc):
     return None
 
   for servo in all_servos:
-    servo_sn = usb_get_iserial(servo)
+    servo_sn = servo.serial
     if servo_sn != options.serialname:
       continue
 
@@ -264,7 +358,7 @@ def choose_servo(logger, all_servos):
   logger.info("")
   for i, servo in enumerate(all_servos):
     logger.info("Press '%d' for servo, vid: 0x%04x pid: 0x%04x sid: %s", i,
-                servo.idVendor, servo.idProduct, usb_get_iserial(servo))
+                servo.idVendor, servo.idProduct, servo.serial)
 
   (rlist, _, _) = select.select([sys.stdin], [], [], 10)
   if not rlist:
@@ -286,7 +380,7 @@ def choose_servo(logger, all_servos):
   servo = all_servos[rsp]
   logging.info("Chose %d ... starting servod on servo "
                "vid: 0x%04x pid: 0x%04x sid: %s",
-               rsp, servo.idVendor, servo.idProduct, usb_get_iserial(servo))
+               rsp, servo.idVendor, servo.idProduct, servo.serial)
   logging.info("")
   return servo
 
@@ -318,12 +412,13 @@ def discover_servo(logger, options, servodrc):
 
   vendor, product, serialname = (options.vendor, options.product,
                                  options.serialname)
-  all_servos = []
-  for (vid, pid) in servo_interfaces.SERVO_ID_DEFAULTS:
-    if (vendor and vendor != vid) or \
-          (product and product != pid):
-      continue
-    all_servos.extend(usb_find(vid, pid, serialname))
+  # Enumerate once, serial numbers are only needed for servo candidates.
+  servo_ids = servo_interfaces.SERVO_ID_DEFAULTS
+  all_servos = [d for d in usb_discovery.find_devices(vendor, product)
+                if (d.idVendor, d.idProduct) in servo_ids]
+  if serialname:
+    all_servos = [d for d in all_servos if d.serial.endswith(serialname)]
+  all_servos.sort(key=lambda d: servo_ids.index((d.idVendor, d.idProduct)))
 
   if not all_servos:
     logger.error("No servos found")
@@ -379,13 +474,13 @@ def get_lot_id(logger, servo):
   """Get lot_id for a given servo.
 
   Args:
-    servo: usb.Device object
+    servo: usb_discovery.UsbDevice object
 
   Returns:
     lot_id of the servo device.
   """
   lot_id = None
-  iserial = usb_get_iserial(servo)
+  iserial = servo.serial
   logger.debug('iserial = %s', iserial)
   if not iserial:
     logger.warn("Servo device has no iserial value")
@@ -411,42 +506,32 @@ def get_auto_configs(logger, board_version):
     return []
   return ftdi_common.SERVO_CONFIG_DEFAULTS[board_version]
 
-def main_function():
-  (options, args) = _parse_args()
-  if options.debug:
-    level = 'debug'
-  else:
-    level = drv.loglevel.DEFAULT_LOGLEVEL
+def build_config(logger, servo_device, board='', configs=None,
+                 noautoconfig=False):
+  """Build the system config of a servo.
 
-  loglevel, format = drv.loglevel.LOGLEVEL_MAP[level]
-  logging.basicConfig(level=loglevel, format=format)
-
-  # Servod needs to be running in the chroot without PID namespaces in order to
-  # freeze terminals when reading from the UARTs.
-  terminal_freezer.CheckForPIDNamespace()
-
-  logger = logging.getLogger(os.path.basename(sys.argv[0]))
-  logger.info("Start")
-  multiservo.get_env_options(logger, options)
-
-  if options.name and options.serialname:
-    logger.error("Mutually exclusive '--name' or '--serialname' is allowed")
-    sys.exit(-1)
+  Args:
+    logger: a logging instance used by this servod driver
+    servo_device: usb_discovery.UsbDevice object of the servo
+    board: string, name of the board overlay to load, if any
+    configs: list of additional XML config files to load
+    noautoconfig: if True, don't load the configs of the servo version
 
-  servo_device = discover_servo(logger, options,
-                                multiservo.parse_rc(logger, options.rcfile))
-  if not servo_device:
-    sys.exit(-1)
+  Returns:
+    tuple (SystemConfig object, board version string or None)
 
+  Raises:
+    ServodError: if no config is found
+  """
   lot_id = get_lot_id(logger, servo_device)
   board_version = get_board_version(lot_id, servo_device.idProduct)
   logger.debug('board_version = %s', board_version)
   all_configs = []
-  if not options.noautoconfig:
+  if not noautoconfig:
     all_configs += get_auto_configs(logger, board_version)
 
-  if options.config:
-    for config in options.config:
+  if configs:
+    for config in configs:
       # quietly ignore duplicate configs for backwards compatibility
       if config not in all_configs:
         all_configs.append(config)
@@ -457,60 +542,149 @@ def main_function():
 
   scfg = system_config.SystemConfig()
 
-  if options.board:
-    board_config = "servo_" + options.board + "_overlay.xml"
+  if board:
+    board_config = "servo_" + board + "_overlay.xml"
     if not scfg.find_cfg_file(board_config):
-      logger.error("No XML overlay for board %s", options.board)
-      sys.exit(-1)
+      raise ServodError("No XML overlay for board %s" % board)
 
-    logger.info("Found XML overlay for board %s", options.board)
+    logger.info("Found XML overlay for board %s", board)
     all_configs.append(board_config)
 
   for cfg_file in all_configs:
     scfg.add_cfg_file(cfg_file)
 
   logger.debug("\n" + scfg.display_config())
+  return scfg, board_version
 
-  logger.debug("Servo is vid:0x%04x pid:0x%04x sid:%s" % \
-                 (servo_device.idVendor, servo_device.idProduct,
-                  usb_get_iserial(servo_device)))
+def open_server(logger, host, port=None):
+  """Open the XMLRPC server socket.
+
+  Args:
+    logger: a logging instance used by this servod driver
+    host: hostname to listen on
+    port: port to listen on, None to pick a free one in DEFAULT_PORT_RANGE
+
+  Returns:
+    tuple (ThreadedXMLRPCServer object, port)
 
-  if options.port:
-    start_port = options.port
-    end_port = options.port
+  Raises:
+    ServodError: if no port could be opened
+  """
+  if port:
+    start_port = port
+    end_port = port
   else:
     end_port, start_port = DEFAULT_PORT_RANGE
   for servo_port in xrange(start_port, end_port - 1, -1):
     try:
-      server = SimpleXMLRPCServer.SimpleXMLRPCServer(
-        (options.host, servo_port), logRequests=False)
-      break
+      server = ThreadedXMLRPCServer((host, servo_port), logRequests=False)
+      return server, servo_port
     except socket.error as e:
       if e.errno == errno.EADDRINUSE:
         continue   # Port taken, see if there is another one next to it.
       logger.fatal("Problem opening Server's socket: %s", e)
-      sys.exit(-1)
+      raise ServodError("Problem opening Server's socket: %s" % e)
+  if port:
+    err_msg = ("Port %d is busy" %  port)
   else:
-    if options.port:
-      err_msg = ("Port %d is busy" %  options.port)
-    else:
-      err_msg = ("Could not find a free port in %d..%d range" %  (
-          end_port, start_port))
+    err_msg = ("Could not find a free port in %d..%d range" %  (
+        end_port, start_port))
+  logger.fatal(err_msg)
+  raise ServodError(err_msg)
 
-    logger.fatal(err_msg)
-    sys.exit(-1)
+def start_servod(logger, servo_device, host, port=None, board='',
+                 configs=None, noautoconfig=False, interfaces=None,
+                 usbkm232=None):
+  """Create and initialize the servod of a servo, ready to be served.
+
+  Args:
+    logger: a logging instance used by this servod driver
+    servo_device: usb_discovery.UsbDevice object of the servo
+    host: hostname to listen on
+    port: port to listen on, None to pick a free one in DEFAULT_PORT_RANGE
+    board: see build_config()
+    configs: see build_config()
+    noautoconfig: see build_config()
+    interfaces: list of interface types, None for the servo defaults
+    usbkm232: see servo_server.Servod
+
+  Returns:
+    tuple (ThreadedXMLRPCServer object, port)
 
-  servod = servo_server.Servod(scfg, vendor=servo_device.idVendor,
-                               product=servo_device.idProduct,
-                               serialname=usb_get_iserial(servo_device),
-                               interfaces=options.interfaces.split(),
-                               board=options.board,
-                               version=board_version,
-                               usbkm232=options.usbkm232)
-  servod.hwinit(verbose=True)
+  Raises:
+    ServodError: if the servod can't be started
+  """
+  scfg, board_version = build_config(logger, servo_device, board, configs,
+                                     noautoconfig)
+
+  logger.debug("Servo is vid:0x%04x pid:0x%04x sid:%s" % \
+                 (servo_device.idVendor, servo_device.idProduct,
+                  servo_device.serial))
+
+  server, servo_port = open_server(logger, host, port)
+  try:
+    servod = servo_server.Servod(scfg, vendor=servo_device.idVendor,
+                                 product=servo_device.idProduct,
+                                 serialname=servo_device.serial,
+                                 interfaces=interfaces,
+                                 board=board,
+                                 version=board_version,
+                                 usbkm232=usbkm232)
+    servod.hwinit(verbose=True)
+  except:
+    server.server_close()
+    raise
   server.register_introspection_functions()
   server.register_multicall_functions()
   server.register_instance(servod)
+  server.add_unix_socket(logger, multiservo.get_socket_path(servo_port))
+  return server, servo_port
+
+def main_function():
+  (options, args) = _parse_args()
+  if options.debug:
+    level = 'debug'
+  else:
+    level = drv.loglevel.DEFAULT_LOGLEVEL
+
+  loglevel, format = drv.loglevel.LOGLEVEL_MAP[level]
+  logging.basicConfig(level=loglevel, format=format)
+
+  # Servod needs to be running in the chroot without PID namespaces in order to
+  # freeze terminals when reading from the UARTs.
+  terminal_freezer.CheckForPIDNamespace()
+
+  logger = logging.getLogger(os.path.basename(sys.argv[0]))
+  logger.info("Start")
+
+  if options.supervisor:
+    def start_func(name, servo_device, rc_config):
+      return start_servod(logging.getLogger(name), servo_device, options.host,
+                          rc_config['port'], rc_config['board'] or '',
+                          options.config, options.noautoconfig,
+                          options.interfaces.split(), options.usbkm232)
+    try:
+      supervisor.Supervisor(options.rcfile, start_func).run()
+    except supervisor.SupervisorError as e:
+      raise ServodError(str(e))
+    return
+
+  multiservo.get_env_options(logger, options)
+
+  if options.name and options.serialname:
+    logger.error("Mutually exclusive '--name' or '--serialname' is allowed")
+    sys.exit(-1)
+
+  servo_device = discover_servo(logger, options,
+                                multiservo.parse_rc(logger, options.rcfile))
+  if not servo_device:
+    sys.exit(-1)
+
+  server, servo_port = start_servod(logger, servo_device, options.host,
+                                    options.port, options.board,
+                                    options.config, options.noautoconfig,
+                                    options.interfaces.split(),
+                                    options.usbkm232)
   logger.info("Listening on %s port %s" % (options.host, servo_port))
   server.serve_forever()
 
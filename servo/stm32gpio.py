@@ -63,6 +63,10 @@ class Sgpio(gpio_interface.GpioInterface):
     """Sgpio destructor."""
     self._logger.debug("Close")
 
+  def close(self):
+    """Release the stm32 usb endpoint workers."""
+    self._susb.close()
+
   def wr_rd(self, offset, width=1, dir_val=None, wr_val=None, chip=None,
             muxfile=None):
     """Write and/or read GPIO bit.
@@ -81,27 +85,47 @@ class Sgpio(gpio_interface.GpioInterface):
     self._logger.debug("Sgpio.wr_rd(offset="
         "%s, width=%s, dir_val=%s, wr_val=%s)" % (
         offset, width, dir_val, wr_val))
-    # Read preexisting values for debug output.
-    ret = self._susb._read_ep.read(4, self._susb.TIMEOUT_MS)
-    read_mask = struct.unpack("<I", ret)[0]
-    self._logger.debug("Read mask: 0x%08x" % read_mask)
+    return self.wr_rd_fields([(offset, width, dir_val, wr_val)])[0]
 
-    width_mask = (1 << width) - 1
+  def wr_rd_fields(self, fields):
+    """Write and/or read several GPIO fields in one transaction.
+
+    The set and clear masks of all the fields written are sent in a single
+    USB write, so they change together, then the pins are read once for all
+    the fields.
+
+    Args:
+      fields: list of (offset, width, dir_val, wr_val) tuples, see wr_rd.
+          Fields whose wr_val is None are only read.
+
+    Returns:
+      list of integer values read from the fields ( masked & aligned )
+    """
     set_mask = 0
     clear_mask = 0
-
-    if wr_val != None:
-      set_mask = (wr_val & width_mask) << offset;
-      clear_mask = (~wr_val & width_mask) << offset;
+    for offset, width, _, wr_val in fields:
+      if wr_val is None:
+        continue
+      width_mask = (1 << width) - 1
+      # Later fields override earlier ones.
+      set_mask &= ~(width_mask << offset)
+      clear_mask &= ~(width_mask << offset)
+      set_mask |= (wr_val & width_mask) << offset
+      clear_mask |= (~wr_val & width_mask) << offset
 
     byte_str = struct.pack("<II", set_mask, clear_mask)
-    ret = self._susb._write_ep.write(byte_str, self._susb.TIMEOUT_MS)
-    if (ret != len(byte_str)):
-      raise SgpioError("Wrote %d bytes, expected %d" % (ret, len(byte_str)))
-
-    # GPIO cached values update on read,
-    ret = self._susb._read_ep.read(4, self._susb.TIMEOUT_MS)
-    ret = self._susb._read_ep.read(4, self._susb.TIMEOUT_MS)
+    # The read of the preexisting values (for debug output) overlaps the
+    # write.
+    (before, wrote) = stm32usb.wait_all([self._susb.read_async(4),
+                                         self._susb.write_async(byte_str)])
+    self._logger.debug("Read mask: 0x%08x" % struct.unpack("<I", before)[0])
+    if (wrote != len(byte_str)):
+      raise SgpioError("Wrote %d bytes, expected %d" % (wrote, len(byte_str)))
+
+    # GPIO cached values update on read, so only the second read after the
+    # write returns them.
+    (_, ret) = stm32usb.wait_all([self._susb.read_async(4),
+                                  self._susb.read_async(4)])
     if len(ret) != 4:
       raise SgpioError(
           "Read error: expected 4 bytes, got %d [%s]" % (len(ret), ret))
@@ -109,9 +133,10 @@ class Sgpio(gpio_interface.GpioInterface):
     read_mask = struct.unpack("<I", ret)[0]
     self._logger.debug("Read mask: 0x%08x" % read_mask)
 
-    readvalue = (read_mask >> offset) & width_mask
-    self._logger.debug("Read value: 0x%x" % readvalue)
-    return readvalue
+    values = [(read_mask >> offset) & ((1 << width) - 1)
+              for offset, width, _, _ in fields]
+    self._logger.debug("Read values: %s" % values)
+    return values
 
 
 def test():
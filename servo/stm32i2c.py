@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 import array
+import collections
 import logging
 import usb
 
@@ -25,6 +26,22 @@ class Si2cError(Exception):
     self.value = value
 
 
+class Si2cBatchError(Si2cError):
+  """Class for exceptions of Si2cBus.wr_rd_batch."""
+  def __init__(self, msg, index, results):
+    """Si2cBatchError constructor.
+
+    Args:
+      msg: string, message describing error in detail
+      index: integer, index of the first failed transaction
+      results: list of the bytes read by each transaction, None for those
+          which failed, whose outcome is unknown or which weren't made.
+    """
+    super(Si2cBatchError, self).__init__(msg)
+    self.index = index
+    self.results = results
+
+
 class Si2cBus(object):
   """I2C bus class to access devices on the bus.
 
@@ -40,6 +57,9 @@ class Si2cBus(object):
     _port: stm32 i2c controller index
     _susb: stm32 usb class
   """
+  # Maximum number of transactions in flight in wr_rd_batch.
+  BATCH_DEPTH = 8
+
   def __init__(self, vendor=0x18d1, product=0x501a,
       interface=1, port=0, serialname=None):
     self._logger = logging.getLogger("Si2c")
@@ -57,6 +77,10 @@ class Si2cBus(object):
     """Si2c destructor."""
     self._logger.debug("Close")
 
+  def close(self):
+    """Release the stm32 usb endpoint workers."""
+    self._susb.close()
+
   def wr_rd(self, slave_address, write_list, read_count=None):
     """Implements hdctools wr_rd() interface.
 
@@ -82,6 +106,20 @@ class Si2cBus(object):
         "port=%d, slave_address=0x%x, write_list=%s, read_count=%s)" % (
           self._port, slave_address, write_list, read_count))
 
+    (transfers, read_count) = self._submit(slave_address, write_list,
+                                           read_count)
+    (_, bytes) = stm32usb.wait_all(transfers)
+    return self._response(bytes, read_count)
+
+  def _submit(self, slave_address, write_list, read_count):
+    """Queue the command of a transaction and the read of its response.
+
+    The read is queued with the command, so that it is pending by the time
+    the stm32 answers.
+
+    Returns:
+      tuple ([command write, response read] transfers, read count).
+    """
     # Clean up args from python style to correct types.
     if not write_list:
       write_list = []
@@ -89,11 +127,17 @@ class Si2cBus(object):
     read_count = max(0, read_count)
 
     # Send wr_rd command to stm32.
-    cmd = [self._port, slave_address, write_length, read_count] + write_list
-    ret = self._susb._write_ep.write(cmd, self._susb.TIMEOUT_MS)
+    cmd = [self._port, slave_address, write_length, read_count] + list(
+        write_list)
+    return ([self._susb.write_async(cmd),
+             self._susb.read_async(read_count + 4)], read_count)
+
+  def _response(self, bytes, read_count):
+    """Return the bytes read by a transaction from its response.
 
-    # Read back response if necessary.
-    bytes = self._susb._read_ep.read(read_count + 4, self._susb.TIMEOUT_MS)
+    Raises:
+      Si2cError if the transaction failed.
+    """
     if len(bytes) < (read_count + 4):
       raise Si2cError("Read status failed.")
 
@@ -102,3 +146,96 @@ class Si2cBus(object):
 
     self._logger.debug("Si2c.wr_rd result 0x%02x%02x, read %s" % (bytes[1], bytes[0], bytes[4:]))
     return bytes[4:]
+
+  def wr_rd_batch(self, transactions, retry=False):
+    """Write and/or read slave i2c devices, several transactions in flight.
+
+    The commands of up to BATCH_DEPTH transactions are queued back to back,
+    and their responses matched to them in order, as the stm32 answers the
+    commands one by one.  Once a transaction fails, no more commands are
+    queued, but the ones in flight are still run by the stm32 and waited for.
+    Their results are kept unless the failure was a USB error: the responses
+    can then no longer be matched to the commands, so the outcome of the
+    transactions in flight is unknown, and the read endpoint is drained of
+    stale responses.
+
+    Without retry, the batch then fails.  With retry, each failed or unknown
+    transaction is made again on its own through wr_rd, and the batch
+    resumes with the next transaction not sent yet.  A retried transaction
+    thus runs after the ones in flight behind it, and one of unknown outcome
+    may run twice.  Completed transactions are never sent again.
+
+    Args:
+      transactions: list of (slave_address, write_list, read_count) tuples,
+          see wr_rd.
+      retry: if True, retry the failed transactions instead of failing.
+
+    Returns:
+      list of the bytes read by each transaction.
+
+    Raises:
+      Si2cBatchError: if a transaction fails without retry.
+      Si2cError, usb.core.USBError: if a retried transaction fails again.
+    """
+    self._logger.debug("Si2c.wr_rd_batch(port=%d, %d transactions)",
+                       self._port, len(transactions))
+    results = [None] * len(transactions)
+    index = 0
+    while index < len(transactions):
+      (index, failed, error) = self._run_batch(transactions, index, results)
+      if not failed:
+        continue
+      if not retry:
+        raise Si2cBatchError("Transaction %d failed: %s" % (failed[0], error),
+                             failed[0], results)
+      for i in failed:
+        results[i] = self.wr_rd(*transactions[i])
+    return results
+
+  def _run_batch(self, transactions, index, results):
+    """Make transactions from index until one fails.
+
+    Args:
+      transactions: see wr_rd_batch.
+      index: index of the first transaction to make.
+      results: list in which the bytes read by each transaction are stored.
+
+    Returns:
+      tuple (index of the first transaction not sent, list of the indexes of
+      the failed or unknown transactions, exception of the first failure).
+    """
+    pending = collections.deque()
+    failed = []
+    error = None
+    # False once the responses can no longer be matched to the commands.
+    in_sync = True
+    while pending or (index < len(transactions) and not failed):
+      if (index < len(transactions) and not failed and
+          len(pending) < self.BATCH_DEPTH):
+        pending.append((index, self._submit(*transactions[index])))
+        index += 1
+        continue
+      (i, (transfers, read_count)) = pending.popleft()
+      try:
+        (_, bytes) = stm32usb.wait_all(transfers)
+        if in_sync:
+          results[i] = self._response(bytes, read_count)
+          continue
+      except (usb.core.USBError, Si2cError) as e:
+        self._logger.debug("Si2c.wr_rd_batch transaction %d failed: %s", i, e)
+        error = error or e
+        if isinstance(e, usb.core.USBError):
+          in_sync = False
+      failed.append(i)
+    if not in_sync:
+      self._drain()
+    return (index, failed, error)
+
+  def _drain(self):
+    """Read and drop responses until the read endpoint times out."""
+    while True:
+      try:
+        bytes = self._susb.read(64)
+      except usb.core.USBError:
+        return
+      self._logger.debug("Si2c.wr_rd_batch dropped stale response %s", bytes)
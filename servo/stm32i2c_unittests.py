@@ -0,0 +1,140 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the batched transactions of the stm32 i2c bus."""
+import collections
+import logging
+import sys
+import unittest
+
+import usb
+
+import stm32i2c
+import stm32usb
+
+
+class FakeSusb(object):
+  """Stm32 usb endpoints answering each i2c command in order.
+
+  The response to the nth command sent has status 1 if n is in nacks, and
+  read_count bytes of value n.  The response to the nth command only arrives
+  once a read timed out waiting for it if n is in late.
+  """
+
+  def __init__(self, nacks=(), late=()):
+    self.commands = []
+    self._nacks = nacks
+    self._late = list(late)
+    self._responses = collections.deque()
+    self._late_response = None
+
+  def write_async(self, data, callback=None, timeout_ms=None):
+    n = len(self.commands)
+    self.commands.append(data)
+    status = 1 if n in self._nacks else 0
+    response = [status, 0, 0, 0] + [n] * data[3]
+    if n in self._late:
+      self._late.remove(n)
+      self._late_response = response
+    else:
+      self._responses.append(response)
+    return self._transfer(len(data))
+
+  def read_async(self, size, callback=None, timeout_ms=None):
+    try:
+      return self._transfer(self.read(size))
+    except usb.core.USBError:
+      return self._transfer(exc_info=sys.exc_info())
+
+  def read(self, size, timeout_ms=None):
+    if self._responses:
+      return self._responses.popleft()
+    if self._late_response:
+      self._responses.append(self._late_response)
+      self._late_response = None
+    raise usb.core.USBError('Operation timed out')
+
+  def _transfer(self, result=None, exc_info=None):
+    transfer = stm32usb.SusbTransfer()
+    transfer.complete(result, exc_info)
+    return transfer
+
+
+class TestWrRdBatch(unittest.TestCase):
+
+  def _bus(self, **kwargs):
+    bus = object.__new__(stm32i2c.Si2cBus)
+    bus._logger = logging.getLogger('Si2c')
+    bus._port = 0
+    bus._susb = FakeSusb(**kwargs)
+    return bus
+
+  def _transactions(self, count):
+    return [(0x40, [n], 1) for n in range(count)]
+
+  def _sent(self, bus):
+    return [command[4] for command in bus._susb.commands]
+
+  def _responses(self, bus, count):
+    """Return the response to the last command of each transaction."""
+    sent = self._sent(bus)
+    return [[len(sent) - 1 - sent[::-1].index(n)] for n in range(count)]
+
+  def test_order(self):
+    bus = self._bus()
+    count = 3 * bus.BATCH_DEPTH + 1
+    results = bus.wr_rd_batch(self._transactions(count))
+    self.assertEqual(results, [[n] for n in range(count)])
+    self.assertEqual(self._sent(bus), range(count))
+
+  def test_failure(self):
+    bus = self._bus(nacks=[2])
+    count = 3 * bus.BATCH_DEPTH
+    in_flight = 2 + bus.BATCH_DEPTH
+    try:
+      bus.wr_rd_batch(self._transactions(count))
+      self.fail('Si2cBatchError not raised')
+    except stm32i2c.Si2cBatchError as e:
+      self.assertEqual(e.index, 2)
+      # The transactions in flight completed, the later ones weren't made.
+      self.assertEqual(e.results, [[0], [1], None] +
+                       [[n] for n in range(3, in_flight)] +
+                       [None] * (count - in_flight))
+    self.assertEqual(self._sent(bus), range(in_flight))
+
+  def test_failure_retry(self):
+    bus = self._bus(nacks=[2])
+    count = 3 * bus.BATCH_DEPTH
+    in_flight = 2 + bus.BATCH_DEPTH
+    results = bus.wr_rd_batch(self._transactions(count), retry=True)
+    self.assertEqual(results, self._responses(bus, count))
+    # Only the failed transaction is sent again, after those in flight.
+    self.assertEqual(self._sent(bus),
+                     range(in_flight) + [2] + range(in_flight, count))
+
+  def test_stale_response(self):
+    bus = self._bus(late=[2])
+    count = 3 * bus.BATCH_DEPTH
+    try:
+      bus.wr_rd_batch(self._transactions(count))
+      self.fail('Si2cBatchError not raised')
+    except stm32i2c.Si2cBatchError as e:
+      self.assertEqual(e.index, 2)
+      # The responses after the late one don't match their commands.
+      self.assertEqual(e.results, [[0], [1]] + [None] * (count - 2))
+    # The stale response was drained.
+    self.assertRaises(usb.core.USBError, bus._susb.read, 64)
+
+  def test_stale_response_retry(self):
+    bus = self._bus(late=[2])
+    count = 3 * bus.BATCH_DEPTH
+    in_flight = 2 + bus.BATCH_DEPTH
+    results = bus.wr_rd_batch(self._transactions(count), retry=True)
+    # The retried transactions got their own responses.
+    self.assertEqual(results, self._responses(bus, count))
+    self.assertEqual(self._sent(bus), range(in_flight) +
+                     range(2, in_flight) + range(in_flight, count))
+
+
+if __name__ == '__main__':
+  unittest.main()
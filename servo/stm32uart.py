@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 """Allow creation of uart/console interface via stm32 usb endpoint."""
+import collections
 import errno
 import exceptions
 import logging
@@ -36,6 +37,9 @@ class SuartError(Exception):
 
 class Suart(uart.Uart):
   """Provide interface to stm32 serial usb endpoint."""
+  # Number of reads of the endpoint kept queued by the rx thread.
+  RX_QUEUE_DEPTH = 4
+
   def __init__(self, vendor=0x18d1, product=0x501a, interface=0,
                serialname=None, ftdi_context=None):
     """Suart contstructor.
@@ -60,6 +64,10 @@ class Suart(uart.Uart):
 
     self._susb = stm32usb.Susb(vendor=vendor, product=product,
         interface=interface, serialname=serialname, logger=self._logger)
+    self._rx_thread = None
+    self._tx_thread = None
+    # Set to end the rx and tx threads.
+    self._stop = threading.Event()
 
     self._logger.debug("Set up stm32 uart")
 
@@ -67,17 +75,45 @@ class Suart(uart.Uart):
     """Suart destructor."""
     self._logger.debug('')
 
+  def close(self):
+    """Stop the rx and tx threads and release the stm32 usb endpoints."""
+    self._logger.debug('')
+    self._stop.set()
+    for thread in (self._rx_thread, self._tx_thread):
+      if thread:
+        thread.join()
+    self._susb.close()
+    if self._rx_thread:
+      os.close(self._ptym)
+      self._rx_thread = self._tx_thread = None
+
+  def _drain_rx(self, pending):
+    """Wait for the queued reads, dropping what they read."""
+    while pending:
+      try:
+        r = pending.popleft().wait()
+        if r:
+          self._logger.debug("rx %s: dropped %d bytes while hung up",
+                             self.get_pty(), len(r))
+      except Exception:
+        pass
+
   def run_rx_thread(self):
     self._logger.debug('rx thread started on %s' % self.get_pty())
 
     ep = select.epoll()
     ep.register(self._ptym, select.EPOLLHUP)
-    while True:
+    # Reads kept queued on the endpoint, so that the next one is issued as
+    # soon as one completes rather than after the pty write.
+    pending = collections.deque()
+    while not self._stop.is_set():
       events = ep.poll(0)
       # Check if the pty is connected to anything, or hungup.
       if not events:
+        while len(pending) < self.RX_QUEUE_DEPTH:
+          pending.append(self._susb.read_async(64))
         try:
-          r = self._susb._read_ep.read(64, self._susb.TIMEOUT_MS)
+          r = pending.popleft().wait()
           if r:
             os.write(self._ptym, r)
 
@@ -87,21 +123,30 @@ class Suart(uart.Uart):
           if type(e) not in [exceptions.OSError, usb.core.USBError]:
             self._logger.debug("rx %s: %s" % (self.get_pty(), e))
       else:
+        # Queue no reads while the pty is hung up, so that the device keeps
+        # its data until someone listens; only the reads already queued
+        # complete.
+        self._drain_rx(pending)
         time.sleep(.1)
+    self._drain_rx(pending)
 
   def run_tx_thread(self):
     self._logger.debug("tx thread started on %s" % self.get_pty())
 
     ep = select.epoll()
     ep.register(self._ptym, select.EPOLLHUP)
-    while True:
+    while not self._stop.is_set():
       events = ep.poll(0)
       # Check if the pty is connected to anything, or hungup.
       if not events:
         try:
+          # Time out to notice close().
+          readable, _, _ = select.select([self._ptym], [], [], .1)
+          if not readable:
+            continue
           r = os.read(self._ptym, 64)
           if r:
-            self._susb._write_ep.write(r, self._susb.TIMEOUT_MS)
+            self._susb.write(r)
 
         except Exception as e:
           self._logger.debug("tx %s: %s" % (self.get_pty(), e))
@@ -5,6 +5,9 @@
 """Allows creation of an interface via stm32 usb."""
 
 import logging
+import Queue
+import sys
+import threading
 import usb
 
 
@@ -22,6 +25,129 @@ class SusbError(Exception):
     self.value = value
 
 
+class SusbTransfer(object):
+  """Pending transfer on a stm32 USB endpoint, completed by its worker.
+
+  Instance Variables:
+  _event: threading.Event set once the transfer is complete
+  _callback: function called with the transfer once complete, or None
+  _result: value returned by the transfer
+  _exc_info: sys.exc_info() of the exception raised by the transfer, or None
+  """
+
+  def __init__(self, callback=None):
+    self._event = threading.Event()
+    self._callback = callback
+    self._result = None
+    self._exc_info = None
+
+  def done(self):
+    """Return True if the transfer is complete."""
+    return self._event.is_set()
+
+  def complete(self, result=None, exc_info=None):
+    """Record the outcome of the transfer and wake up its waiters."""
+    self._result = result
+    self._exc_info = exc_info
+    self._event.set()
+    if self._callback:
+      self._callback(self)
+
+  def wait(self, timeout=None):
+    """Wait for the transfer to complete.
+
+    Args:
+      timeout: seconds to wait, None to wait until the transfer itself times
+          out.  A transfer not completed in timeout stays queued.
+
+    Returns:
+      value returned by the transfer: the bytes read for a read, the count of
+      bytes written for a write.
+
+    Raises:
+      SusbError: if the transfer didn't complete in timeout.
+      usb.core.USBError: or any exception raised by the transfer.
+    """
+    if not self._event.wait(timeout):
+      raise SusbError("Transfer not completed in %s secs" % timeout)
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+def wait_all(transfers):
+  """Wait for several transfers, e.g. a request and the read of its response.
+
+  All the transfers are waited for even if one fails, so that no read is
+  still pending that could take the data meant for a later one.
+
+  Returns:
+    list of the results of the transfers.
+
+  Raises:
+    the exception of the first failed transfer, see SusbTransfer.wait.
+  """
+  results = []
+  exc_info = None
+  for transfer in transfers:
+    try:
+      results.append(transfer.wait())
+    except Exception:
+      if not exc_info:
+        exc_info = sys.exc_info()
+  if exc_info:
+    raise exc_info[0], exc_info[1], exc_info[2]
+  return results
+
+
+class _EndpointWorker(object):
+  """Thread running the transfers queued on an endpoint, in order.
+
+  pyusb only offers synchronous transfers.  Queuing them lets callers submit
+  several transfers at once and overlap transfers of different endpoints:
+  e.g. a response is read as soon as its request is written.
+  """
+  # Queued in place of a transfer to end the thread.
+  _STOP = None
+
+  def __init__(self, name, logger):
+    self._logger = logger
+    self._queue = Queue.Queue()
+    self._thread = threading.Thread(target=self._run, name=name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, func, args, callback=None):
+    """Queue func(*args) and return its SusbTransfer."""
+    transfer = SusbTransfer(callback)
+    self._queue.put((transfer, func, args))
+    return transfer
+
+  def stop(self):
+    """End the thread once the transfers already queued are done."""
+    self._queue.put(self._STOP)
+    self._thread.join()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is self._STOP:
+        return
+      (transfer, func, args) = item
+      try:
+        result = func(*args)
+      except Exception:
+        outcome = {'exc_info': sys.exc_info()}
+      else:
+        outcome = {'result': result}
+      # A failing callback must not end the thread, or the transfers queued
+      # after this one would never complete.
+      try:
+        transfer.complete(**outcome)
+      except Exception as e:
+        self._logger.error("Transfer callback failed: %s", e)
+
+
 class Susb():
   """Provide stm32 USB functionality.
 
@@ -30,6 +156,8 @@ class Susb():
   _dev: pyUSB device object
   _read_ep: pyUSB read endpoint for this interface
   _write_ep: pyUSB write endpoint for this interface
+  _read_worker: _EndpointWorker of _read_ep, started on first use
+  _write_worker: _EndpointWorker of _write_ep, started on first use
   """
   READ_ENDPOINT = 0x81
   WRITE_ENDPOINT = 0x1
@@ -100,8 +228,80 @@ class Susb():
     self._write_ep = write_ep
     self._logger.debug("Writer endpoint: 0x%x" % write_ep.bEndpointAddress)
 
+    self._read_worker = None
+    self._write_worker = None
+    self._worker_lock = threading.Lock()
+
     self._logger.debug("Set up stm32 usb")
 
   def __del__(self):
     """Sgpio destructor."""
     self._logger.debug("Close")
+
+  def close(self):
+    """Stop the endpoint workers once their queued transfers are done.
+
+    Workers are started again if the endpoints are used afterwards.
+    """
+    with self._worker_lock:
+      workers = (self._read_worker, self._write_worker)
+      self._read_worker = self._write_worker = None
+    for worker in workers:
+      if worker:
+        worker.stop()
+
+  def _get_workers(self):
+    """Return the (read, write) workers, starting them if needed."""
+    with self._worker_lock:
+      if not self._read_worker:
+        number = self._intf.bInterfaceNumber
+        self._read_worker = _EndpointWorker("susb-rd%d" % number, self._logger)
+        self._write_worker = _EndpointWorker("susb-wr%d" % number,
+                                             self._logger)
+    return (self._read_worker, self._write_worker)
+
+  def read_async(self, size, callback=None, timeout_ms=None):
+    """Queue a read of the endpoint.
+
+    Reads are made in the order they are queued, each one as soon as the
+    previous one completes.
+
+    Args:
+      size: maximum number of bytes to read.
+      callback: function called with the SusbTransfer once complete, from the
+          worker thread.  It must not wait for other transfers.
+      timeout_ms: timeout of the read, TIMEOUT_MS by default.
+
+    Returns:
+      SusbTransfer whose result is the array of bytes read.
+    """
+    if timeout_ms is None:
+      timeout_ms = self.TIMEOUT_MS
+    return self._get_workers()[0].submit(self._read_ep.read,
+                                         (size, timeout_ms), callback)
+
+  def write_async(self, data, callback=None, timeout_ms=None):
+    """Queue a write of the endpoint.
+
+    Writes are made in the order they are queued.
+
+    Args:
+      data: string or list of bytes to write.
+      callback: see read_async.
+      timeout_ms: timeout of the write, TIMEOUT_MS by default.
+
+    Returns:
+      SusbTransfer whose result is the number of bytes written.
+    """
+    if timeout_ms is None:
+      timeout_ms = self.TIMEOUT_MS
+    return self._get_workers()[1].submit(self._write_ep.write,
+                                         (data, timeout_ms), callback)
+
+  def read(self, size, timeout_ms=None):
+    """Read the endpoint after the reads already queued."""
+    return self.read_async(size, timeout_ms=timeout_ms).wait()
+
+  def write(self, data, timeout_ms=None):
+    """Write the endpoint after the writes already queued."""
+    return self.write_async(data, timeout_ms=timeout_ms).wait()
@@ -0,0 +1,270 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Server-side polling of control values on behalf of clients.
+
+Clients waiting for a DUT state change register the controls they care about
+once and then long-poll for events, instead of calling get() in a loop. The
+controls are polled by a single scheduler thread inside servod and only value
+changes (or predicate transitions) are queued to the client.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+# Predicates a subscription may use to filter values.
+PREDICATE_CHANGE = 'change'
+PREDICATE_ABOVE = 'above'
+PREDICATE_BELOW = 'below'
+PREDICATE_EQUAL = 'equal'
+PREDICATES = [PREDICATE_CHANGE, PREDICATE_ABOVE, PREDICATE_BELOW,
+              PREDICATE_EQUAL]
+
+# Smallest polling interval allowed, to keep servod responsive to other
+# clients.
+MIN_INTERVAL_SECS = 0.01
+
+# Subscriptions not waited on for this long are dropped, as their client has
+# most likely gone away.
+LEASE_SECS = 60
+
+# Maximum number of events queued per subscription; oldest are dropped.
+MAX_EVENTS = 1024
+
+
+class SubscriptionError(Exception):
+  """Exception class for subscriptions."""
+
+
+class Subscription(object):
+  """Controls polled on behalf of one client and their pending events.
+
+  Attributes:
+    sub_id: integer id of the subscription.
+    controls: list of control names.
+    interval: seconds between two polls of the controls.
+    predicate: value in PREDICATES.
+    threshold: value compared against for predicates other than 'change', a
+        float for 'above' and 'below'.
+    events: list of [control, value, timestamp] not yet delivered.
+    last_values: dict of control name to last polled value.
+    last_matches: dict of control name to last predicate result.
+    last_wait: time the client last waited on the subscription.
+  """
+
+  def __init__(self, sub_id, controls, interval, predicate, threshold):
+    self.sub_id = sub_id
+    self.controls = controls
+    self.interval = interval
+    self.predicate = predicate
+    self.threshold = threshold
+    self.events = []
+    self.last_values = {}
+    self.last_matches = {}
+    self.last_wait = time.time()
+
+  def _matches(self, value):
+    """Returns whether value satisfies the threshold predicate."""
+    if self.predicate == PREDICATE_EQUAL:
+      return str(value) == str(self.threshold)
+    try:
+      value = float(value)
+    except (TypeError, ValueError):
+      return False
+    if self.predicate == PREDICATE_ABOVE:
+      return value > self.threshold
+    return value < self.threshold
+
+  def update(self, control, value, timestamp):
+    """Records a polled value, queueing an event if the client wants it.
+
+    For 'change' subscriptions, the first value and every change are queued.
+    For the other predicates, a value is queued each time the predicate turns
+    true.
+
+    Returns:
+      True if an event was queued.
+    """
+    first = control not in self.last_values
+    changed = first or self.last_values[control] != value
+    self.last_values[control] = value
+    if self.predicate == PREDICATE_CHANGE:
+      queue = changed
+    else:
+      match = self._matches(value)
+      queue = match and not self.last_matches.get(control, False)
+      self.last_matches[control] = match
+    if queue:
+      self.events.append([control, value, timestamp])
+      del self.events[:-MAX_EVENTS]
+    return queue
+
+
+class SubscriptionManager(object):
+  """Schedules the polling of all subscriptions of one servod."""
+
+  def __init__(self, get_func):
+    """Constructor.
+
+    Args:
+      get_func: function taking a control name and returning its value.
+    """
+    self._logger = logging.getLogger('SubscriptionManager')
+    self._get = get_func
+    self._subscriptions = {}
+    self._ids = itertools.count(1)
+    # Heap of (next poll time, subscription id).
+    self._schedule = []
+    self._cond = threading.Condition()
+    self._thread = None
+    self._stopped = False
+
+  def _start_thread(self):
+    """Starts the scheduler thread if not already running. Holds _cond."""
+    if self._thread or self._stopped:
+      return
+    self._thread = threading.Thread(target=self._run, name='subscriptions')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    """Main loop of the scheduler thread."""
+    while True:
+      with self._cond:
+        while not self._schedule and not self._stopped:
+          self._cond.wait()
+        if self._stopped:
+          return
+        next_time, sub_id = self._schedule[0]
+        now = time.time()
+        if next_time > now:
+          self._cond.wait(next_time - now)
+          continue
+        heapq.heappop(self._schedule)
+        sub = self._subscriptions.get(sub_id)
+        if not sub:
+          continue
+        if now - sub.last_wait > LEASE_SECS:
+          self._logger.info('Dropping subscription %d not waited on for %ds',
+                            sub_id, LEASE_SECS)
+          del self._subscriptions[sub_id]
+          continue
+        heapq.heappush(self._schedule,
+                       (max(next_time + sub.interval, now), sub_id))
+      # Poll without holding _cond so waiters are not blocked by hardware.
+      values = []
+      for control in sub.controls:
+        try:
+          values.append((control, self._get(control), time.time()))
+        except Exception as e:
+          self._logger.debug('Polling %s for subscription %d: %s', control,
+                             sub_id, e)
+      with self._cond:
+        queued = False
+        for value in values:
+          try:
+            queued |= sub.update(*value)
+          except Exception as e:
+            self._logger.error('Updating subscription %d with %s: %s',
+                               sub_id, value, e)
+        if queued:
+          self._cond.notifyAll()
+
+  def subscribe(self, controls, interval, predicate, threshold):
+    """Registers controls to poll.
+
+    Args:
+      controls: list of control names.
+      interval: seconds between two polls.
+      predicate: value in PREDICATES.
+      threshold: value compared against for predicates other than 'change'.
+
+    Returns:
+      integer id of the subscription.
+
+    Raises:
+      SubscriptionError: invalid arguments, or stop() was called.
+    """
+    if not controls:
+      raise SubscriptionError('No control to subscribe to')
+    if predicate not in PREDICATES:
+      raise SubscriptionError('Unknown predicate %s, expected one of %s' %
+                              (predicate, ', '.join(PREDICATES)))
+    if predicate != PREDICATE_CHANGE and threshold is None:
+      raise SubscriptionError('Predicate %s needs a threshold' % predicate)
+    if predicate in (PREDICATE_ABOVE, PREDICATE_BELOW):
+      try:
+        threshold = float(threshold)
+      except (TypeError, ValueError):
+        raise SubscriptionError('Predicate %s needs a numeric threshold, got '
+                                '%r' % (predicate, threshold))
+    try:
+      interval = max(float(interval), MIN_INTERVAL_SECS)
+    except (TypeError, ValueError):
+      raise SubscriptionError('Invalid interval %r' % interval)
+    with self._cond:
+      if self._stopped:
+        raise SubscriptionError('Subscriptions stopped')
+      sub_id = self._ids.next()
+      self._subscriptions[sub_id] = Subscription(sub_id, list(controls),
+                                                 interval, predicate,
+                                                 threshold)
+      heapq.heappush(self._schedule, (time.time(), sub_id))
+      self._start_thread()
+      self._cond.notifyAll()
+    self._logger.debug('Subscription %d: %s every %.3fs on %s', sub_id,
+                       predicate, interval, controls)
+    return sub_id
+
+  def wait(self, sub_id, timeout):
+    """Waits for events of a subscription.
+
+    Args:
+      sub_id: integer id of the subscription.
+      timeout: maximum seconds to wait.
+
+    Returns:
+      list of [control, value, timestamp] events, oldest first. Empty if none
+      occurred before timeout.
+
+    Raises:
+      SubscriptionError: unknown subscription.
+    """
+    deadline = time.time() + timeout
+    with self._cond:
+      while True:
+        sub = self._subscriptions.get(sub_id)
+        if not sub:
+          raise SubscriptionError('No subscription %d' % sub_id)
+        sub.last_wait = time.time()
+        remaining = deadline - sub.last_wait
+        if sub.events or remaining <= 0:
+          events, sub.events = sub.events, []
+          return events
+        self._cond.wait(remaining)
+
+  def stop(self):
+    """Drops all subscriptions and ends the scheduler thread."""
+    with self._cond:
+      self._stopped = True
+      self._subscriptions.clear()
+      self._cond.notifyAll()
+      thread = self._thread
+    if thread:
+      thread.join()
+
+  def unsubscribe(self, sub_id):
+    """Stops polling for a subscription.
+
+    Raises:
+      SubscriptionError: unknown subscription.
+    """
+    with self._cond:
+      if sub_id not in self._subscriptions:
+        raise SubscriptionError('No subscription %d' % sub_id)
+      del self._subscriptions[sub_id]
+      self._cond.notifyAll()
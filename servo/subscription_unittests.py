@@ -0,0 +1,89 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Tests the server-side polling of control values."""
+import time
+import unittest
+
+import subscription
+
+
+class TestSubscription(unittest.TestCase):
+
+  def _updates(self, predicate, threshold, values):
+    sub = subscription.Subscription(1, ['ctl'], 0.1, predicate, threshold)
+    return [sub.update('ctl', value, 0) for value in values]
+
+  def test_change(self):
+    self.assertEqual(self._updates('change', None, [0, 0, 1, 1, 0]),
+                     [True, False, True, False, True])
+
+  def test_above(self):
+    self.assertEqual(self._updates('above', 1.5, [1, 2, 3, 1, 2]),
+                     [False, True, False, False, True])
+
+  def test_below(self):
+    self.assertEqual(self._updates('below', 1.5, ['2', '1', 'on', '1']),
+                     [False, True, False, True])
+
+  def test_equal(self):
+    self.assertEqual(self._updates('equal', 'on', ['off', 'on', 'on', 'off',
+                                                   'on']),
+                     [False, True, False, False, True])
+
+
+class TestSubscriptionManager(unittest.TestCase):
+
+  def setUp(self):
+    self._values = {'ctl': 0}
+    self._manager = subscription.SubscriptionManager(self._get)
+    self._lease_secs = subscription.LEASE_SECS
+
+  def tearDown(self):
+    subscription.LEASE_SECS = self._lease_secs
+
+  def _get(self, control):
+    return self._values[control]
+
+  def test_invalid_arguments(self):
+    subscribe = self._manager.subscribe
+    self.assertRaises(subscription.SubscriptionError, subscribe, [], 0.1,
+                      'change', None)
+    self.assertRaises(subscription.SubscriptionError, subscribe, ['ctl'], 0.1,
+                      'rising', None)
+    self.assertRaises(subscription.SubscriptionError, subscribe, ['ctl'], 0.1,
+                      'above', None)
+    self.assertRaises(subscription.SubscriptionError, subscribe, ['ctl'], 0.1,
+                      'above', 'high')
+    self.assertRaises(subscription.SubscriptionError, subscribe, ['ctl'],
+                      'often', 'change', None)
+
+  def test_wait(self):
+    sub_id = self._manager.subscribe(['ctl'], 0.01, 'change', None)
+    self.assertEqual([e[:2] for e in self._manager.wait(sub_id, 1)],
+                     [['ctl', 0]])
+    self._values['ctl'] = 1
+    self.assertEqual([e[:2] for e in self._manager.wait(sub_id, 1)],
+                     [['ctl', 1]])
+    self._manager.unsubscribe(sub_id)
+    self.assertRaises(subscription.SubscriptionError, self._manager.wait,
+                      sub_id, 0)
+
+  def test_lease_expiry(self):
+    subscription.LEASE_SECS = 0.05
+    sub_id = self._manager.subscribe(['ctl'], 0.01, 'change', None)
+    time.sleep(0.3)
+    self.assertRaises(subscription.SubscriptionError, self._manager.wait,
+                      sub_id, 0)
+
+  def test_stop(self):
+    sub_id = self._manager.subscribe(['ctl'], 0.01, 'change', None)
+    self._manager.stop()
+    self.assertRaises(subscription.SubscriptionError, self._manager.wait,
+                      sub_id, 0)
+    self.assertRaises(subscription.SubscriptionError, self._manager.subscribe,
+                      ['ctl'], 0.01, 'change', None)
+
+
+if __name__ == '__main__':
+  unittest.main()
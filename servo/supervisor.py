@@ -0,0 +1,173 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Supervisor hosting the servods of all servos of a host in one process.
+
+Lab hosts run one servod per servo, each paying for the Python startup, the
+parsing of the same XML configs and the import of the drivers.  In supervisor
+mode, a single process serves every servo listed in the servodrc file, each
+from its own XMLRPC server thread and port, and shares the parsed configs and
+driver classes between them.
+
+Servos are started when they are plugged and stopped when they are
+unplugged, as reported by kernel uevents (or periodic rescans).  A servo
+failing to start doesn't affect the others and is retried later.
+"""
+
+import logging
+import select
+import threading
+import time
+
+import multiservo
+import servo_interfaces
+import uevent
+import usb_discovery
+
+
+# Seconds between two rescans when no uevent arrives.
+RESCAN_SECS = 30
+# Seconds to let a plugged device enumerate before rescanning.
+SETTLE_SECS = 1
+# Seconds before retrying to start a servo which failed to.
+RETRY_SECS = 60
+
+
+class SupervisorError(Exception):
+  """Exception class for Supervisor."""
+
+
+class ServoInstance(object):
+  """Servod of one servo, served from its own thread.
+
+  Attributes:
+    name: symbolic servo name from the rc file.
+    serial: serial number of the servo.
+    port: port the servod listens on.
+  """
+
+  def __init__(self, name, serial, server, port):
+    self.name = name
+    self.serial = serial
+    self.port = port
+    self._server = server
+    self._thread = threading.Thread(target=server.serve_forever,
+                                    name='servod-%s' % name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def is_alive(self):
+    return self._thread.is_alive()
+
+  def stop(self):
+    """Stops serving, releases the port and closes the servod."""
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+    # The servod is the instance registered with the XMLRPC server.
+    servod = getattr(self._server, 'instance', None)
+    if servod:
+      servod.close()
+
+
+class Supervisor(object):
+  """Starts and stops the servods of the servos of an rc file."""
+
+  def __init__(self, rc_file, start_func):
+    """Constructor.
+
+    Args:
+      rc_file: path of the servodrc file listing the servos.
+      start_func: function taking (name, usb_discovery.UsbDevice,
+          rc config dict) and returning (server, port) of a started servod,
+          server being a SocketServer ready to serve_forever().
+    """
+    self._logger = logging.getLogger('Supervisor')
+    self._rc_file = rc_file
+    self._start = start_func
+    # Running ServoInstance objects by name.
+    self._instances = {}
+    # Time of the last failed start by name.
+    self._failures = {}
+    try:
+      self._monitor = uevent.UeventMonitor(['usb'])
+    except uevent.UeventError as e:
+      self._logger.warning('Rescanning every %ds: %s', RESCAN_SECS, e)
+      self._monitor = None
+
+  def _get_servo_devices(self):
+    """Returns the servos plugged in, as a dict of serial to UsbDevice."""
+    return dict((d.serial, d) for d in usb_discovery.find_devices()
+                if (d.idVendor, d.idProduct) in
+                servo_interfaces.SERVO_ID_DEFAULTS and d.serial)
+
+  def scan(self):
+    """Brings the running servods in line with the rc file and the servos."""
+    servodrc = multiservo.parse_rc(self._logger, self._rc_file)
+    devices = self._get_servo_devices()
+
+    for name, instance in self._instances.items():
+      config = servodrc.get(name)
+      if (instance.is_alive() and config and
+          config['sn'] == instance.serial and instance.serial in devices):
+        continue
+      self._logger.info('Stopping servod of %s on port %d', name,
+                        instance.port)
+      try:
+        instance.stop()
+      except Exception as e:
+        self._logger.error('Failed to stop servod of %s: %s', name, e)
+      del self._instances[name]
+
+    now = time.time()
+    for name, config in sorted(servodrc.iteritems()):
+      if name in self._instances or config['sn'] not in devices:
+        continue
+      if now - self._failures.get(name, 0) < RETRY_SECS:
+        continue
+      self._logger.info('Starting servod of %s (sid: %s)', name, config['sn'])
+      try:
+        server, port = self._start(name, devices[config['sn']], config)
+      except Exception:
+        # Whatever happened, the other servos must keep being served.
+        self._logger.exception('Failed to start servod of %s, retrying in '
+                               '%ds', name, RETRY_SECS)
+        self._failures[name] = now
+        continue
+      self._failures.pop(name, None)
+      self._instances[name] = ServoInstance(name, config['sn'], server, port)
+      self._logger.info('Servod of %s listening on port %d', name, port)
+
+  def _wait(self):
+    """Waits for a USB uevent or the rescan period."""
+    if not self._monitor:
+      time.sleep(RESCAN_SECS)
+      return
+    deadline = time.time() + RESCAN_SECS
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return
+      readable, _, _ = select.select([self._monitor], [], [], remaining)
+      if readable and self._monitor.changed():
+        # Let the device enumerate and coalesce the burst of events.
+        time.sleep(SETTLE_SECS)
+        self._monitor.changed()
+        return
+
+  def run(self):
+    """Serves the servos until interrupted.
+
+    Raises:
+      SupervisorError: if the rc file lists no servo.
+    """
+    if not multiservo.parse_rc(self._logger, self._rc_file):
+      raise SupervisorError('No servo in %s' % self._rc_file)
+    try:
+      while True:
+        self.scan()
+        self._wait()
+    finally:
+      for name, instance in self._instances.items():
+        self._logger.info('Stopping servod of %s', name)
+        instance.stop()
@@ -5,6 +5,7 @@
 import collections
 import logging
 import os
+import threading
 import xml.etree.ElementTree
 
 
@@ -12,6 +13,32 @@ import xml.etree.ElementTree
 SYSCFG_TAG_LIST = ["map", "control"]
 ALLOWABLE_INPUT_TYPES = {"float": float, "int": int, "str": str}
 
+# Parsed XML files shared by all SystemConfig objects of the process, as
+# {path: (mtime, root element)}.  A servod supervisor builds one config per
+# servo, mostly from the same files.
+_xml_cache = {}
+_xml_cache_lock = threading.Lock()
+
+
+def _parse_xml(filename):
+  """Parse an XML file, reusing the result while the file is unchanged.
+
+  Args:
+    filename: string of path to XML file
+
+  Returns:
+    root Element of the file.  It is shared and must not be modified.
+  """
+  mtime = os.path.getmtime(filename)
+  with _xml_cache_lock:
+    cached = _xml_cache.get(filename)
+  if cached and cached[0] == mtime:
+    return cached[1]
+  root = xml.etree.ElementTree.parse(filename).getroot()
+  with _xml_cache_lock:
+    _xml_cache[filename] = (mtime, root)
+  return root
+
 class SystemConfigError(Exception):
   """Error class for SystemConfig."""
 
@@ -156,7 +183,7 @@ class SystemConfig(object):
     self._loaded_xml_files.append(filename)
 
     self._logger.info("Loading XML config %s", filename)
-    root = xml.etree.ElementTree.parse(filename).getroot()
+    root = _parse_xml(filename)
     for element in root.findall('include'):
       self.add_cfg_file(element.find('name').text)
     for tag in SYSCFG_TAG_LIST:
@@ -207,17 +234,18 @@ class SystemConfig(object):
               if get_dict:
                 raise SystemConfigError("%s %s multiple get params defined\n%s"
                                         % (tag, name, element_str))
-              get_dict = params.attrib
+              get_dict = dict(params.attrib)
             elif cmd == 'set':
               if set_dict:
                 raise SystemConfigError("%s %s multiple set params defined\n%s"
                                         % (tag, name, element_str))
-              set_dict = params.attrib
+              set_dict = dict(params.attrib)
             else:
               raise SystemConfigError("%s %s cmd of 'get'|'set' not found\n%s"
                                       % (tag, name, element_str))
         elif len(params_list) == 1:
-          get_dict = params_list[0].attrib
+          # Copied, as clobbering controls update them in place.
+          get_dict = dict(params_list[0].attrib)
           set_dict = get_dict
         else:
           raise SystemConfigError("%s %s has illegal number of params %d\n%s"
@@ -0,0 +1,87 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Detection of device changes from kernel uevents.
+
+A UeventMonitor subscribes to the kernel uevent netlink group, the one udev
+itself listens to, without a thread: events simply queue in the socket until
+the owner asks whether any of interest happened since it last checked. This
+lets servod cache what it learned about devices (e.g. which block device is
+the servo USB stick) until the kernel reports a change.
+"""
+
+import errno
+import logging
+import socket
+
+
+# From linux/netlink.h.
+NETLINK_KOBJECT_UEVENT = 15
+_KERNEL_GROUP = 1
+_RECV_SIZE = 16384
+
+
+class UeventError(Exception):
+  """Exception class for UeventMonitor."""
+
+
+class UeventMonitor(object):
+  """Reports whether devices of given subsystems were added or removed."""
+
+  def __init__(self, subsystems):
+    """Constructor.
+
+    Args:
+      subsystems: list of kernel subsystems of interest, e.g. ['block'].
+
+    Raises:
+      UeventError: if the uevent socket can't be opened.
+    """
+    self._logger = logging.getLogger('UeventMonitor')
+    self._subsystems = set(subsystems)
+    try:
+      self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, socket.error) as e:
+      raise UeventError('Failed to open uevent socket: %s' % e)
+    try:
+      self._sock.bind((0, _KERNEL_GROUP))
+      self._sock.setblocking(False)
+    except socket.error as e:
+      self._sock.close()
+      raise UeventError('Failed to listen to uevents: %s' % e)
+
+  def changed(self):
+    """Drains the pending events.
+
+    Returns:
+      True if a device of one of the subsystems was added, removed or changed
+      since the last call, or if events were lost.
+    """
+    changed = False
+    while True:
+      try:
+        data = self._sock.recv(_RECV_SIZE)
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return changed
+        # ENOBUFS: the socket overflowed, events were lost.
+        self._logger.debug('Lost uevents: %s', e)
+        changed = True
+        continue
+      # Kernel events are 'action@devpath' followed by KEY=value fields,
+      # all NUL separated.
+      fields = data.split('\0')
+      for field in fields[1:]:
+        if (field.startswith('SUBSYSTEM=') and
+            field[len('SUBSYSTEM='):] in self._subsystems):
+          self._logger.debug('uevent %s', fields[0])
+          changed = True
+          break
+
+  def fileno(self):
+    """Returns the socket file descriptor, readable when events are pending."""
+    return self._sock.fileno()
+
+  def close(self):
+    self._sock.close()
@@ -0,0 +1,164 @@
+# Copyright 2016 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Discovery of USB devices without opening them.
+
+Enumerating USB devices through pyusb and reading their serial numbers opens
+every candidate device, which is slow on hosts with many servos and contends
+with the servods already using them. The kernel exports the same identifiers
+in sysfs, so devices are enumerated from there. pyusb is only used when sysfs
+is not available, in which case serial numbers are memoized per device so a
+device is opened at most once.
+"""
+
+import logging
+import os
+import re
+
+import usb
+
+
+USB_SYSFS_PATH = '/sys/bus/usb/devices'
+# Device directories, e.g. '1-2' or '1-2.4', as opposed to interfaces
+# ('1-2.4:1.0') and root hubs ('usb1').
+DEVICE_RE = re.compile(r'\d+-\d+(\.\d+)*\Z')
+MAX_ISERIAL_STR = 128
+
+# Serial numbers read through pyusb, by (bus, address, vendor, product) of the
+# devices enumerated last.
+_serials = {}
+
+
+class UsbDevice(object):
+  """Identifiers of a USB device.
+
+  The attribute names follow pyusb so the objects can be used in place of
+  usb.core.Device ones where only identifiers are needed.
+
+  Attributes:
+    idVendor: USB vendor id (integer).
+    idProduct: USB product id (integer).
+    bus: bus number (integer).
+    address: device address on the bus (integer).
+    usb_path: USB sysfs path, e.g. '1-2.4', or None without sysfs.
+    serial: serial number string, empty if the device has none.
+  """
+
+  def __init__(self, vendor, product, bus, address, usb_path=None,
+               serial=None, pyusb_device=None):
+    self.idVendor = vendor
+    self.idProduct = product
+    self.bus = bus
+    self.address = address
+    self.usb_path = usb_path
+    self._serial = serial
+    self._pyusb_device = pyusb_device
+
+  @property
+  def serial(self):
+    if self._serial is None:
+      self._serial = _get_pyusb_serial(self._pyusb_device)
+    return self._serial
+
+  def __repr__(self):
+    return 'UsbDevice(vid=0x%04x, pid=0x%04x, bus=%d, address=%d, sid=%s)' % (
+        self.idVendor, self.idProduct, self.bus, self.address, self.serial)
+
+
+def _get_pyusb_key(device):
+  """Return the key of a pyusb device in _serials."""
+  return (device.bus, device.address, device.idVendor, device.idProduct)
+
+
+def _get_pyusb_serial(device):
+  """Read the serial number of a pyusb device, memoized unless it fails."""
+  key = _get_pyusb_key(device)
+  if key not in _serials:
+    serial = ''
+    if device.iSerialNumber:
+      try:
+        serial = usb.util.get_string(device, MAX_ISERIAL_STR,
+                                     device.iSerialNumber) or ''
+      except (usb.core.USBError, ValueError) as e:
+        # E.g. busy or still enumerating: read it again next time.
+        logging.debug('Failed to read serial of %d-%d: %s', device.bus,
+                      device.address, e)
+        return ''
+    _serials[key] = serial
+  return _serials[key]
+
+
+def _read_attr(usb_dir, attr):
+  """Return the stripped content of a sysfs attribute, or None."""
+  try:
+    with open(os.path.join(USB_SYSFS_PATH, usb_dir, attr), 'r') as f:
+      return f.read().strip()
+  except IOError:
+    return None
+
+
+def _find_sysfs_devices():
+  """Enumerate USB devices from sysfs.
+
+  Returns:
+    list of UsbDevice.
+  """
+  devices = []
+  for usb_dir in os.listdir(USB_SYSFS_PATH):
+    if not DEVICE_RE.match(usb_dir):
+      continue
+    try:
+      vendor = int(_read_attr(usb_dir, 'idVendor'), 16)
+      product = int(_read_attr(usb_dir, 'idProduct'), 16)
+      bus = int(_read_attr(usb_dir, 'busnum'))
+      address = int(_read_attr(usb_dir, 'devnum'))
+    except (TypeError, ValueError):
+      # Unplugged while enumerating.
+      continue
+    # The kernel only exports the serial of devices which have one.
+    serial = _read_attr(usb_dir, 'serial') or ''
+    devices.append(UsbDevice(vendor, product, bus, address, usb_dir, serial))
+  return devices
+
+
+def _find_pyusb_devices():
+  """Enumerate USB devices through pyusb, reading serials lazily.
+
+  The memoized serials of the devices no longer enumerated are dropped.
+
+  Returns:
+    list of UsbDevice.
+  """
+  pyusb_devices = list(usb.core.find(find_all=True) or [])
+  keys = set(_get_pyusb_key(d) for d in pyusb_devices)
+  for key in _serials.keys():
+    if key not in keys:
+      del _serials[key]
+  return [UsbDevice(d.idVendor, d.idProduct, d.bus, d.address,
+                    pyusb_device=d)
+          for d in pyusb_devices]
+
+
+def find_devices(vendor=None, product=None, serialname=None):
+  """Find USB devices based on vendor, product and serial identifiers.
+
+  Arguments which are None are don't cares.
+
+  Args:
+    vendor: USB vendor id (integer).
+    product: USB product id (integer).
+    serialname: suffix of the USB serial number (string).
+
+  Returns:
+    list of UsbDevice matching the arguments, sorted by bus and address.
+  """
+  if os.path.isdir(USB_SYSFS_PATH):
+    devices = _find_sysfs_devices()
+  else:
+    devices = _find_pyusb_devices()
+  matched_devices = [
+      d for d in devices
+      if (not vendor or d.idVendor == vendor) and
+      (not product or d.idProduct == product) and
+      (not serialname or d.serial.endswith(serialname))]
+  return sorted(matched_devices, key=lambda d: (d.bus, d.address))